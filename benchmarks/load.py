@@ -0,0 +1,335 @@
+"""
+End-to-end HTTP load benchmark
+
+Starts main.app with uvicorn against a seeded database (a temporary
+SQLite file unless --database-url is given), drives concurrent
+authenticated traffic per scenario and reports throughput, p50/p95/p99
+latency and database queries per request.
+
+    python -m benchmarks.load --save benchmarks/results/baseline.json
+    python -m benchmarks.load --baseline benchmarks/results/baseline.json
+
+Exits with status 1 when a scenario fails requests, exceeds its p95
+budget or regresses against the baseline beyond the tolerance.
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+BUDGETS_FILE = Path(__file__).with_name("budgets.json")
+# Scenario name: (method, path template)
+SCENARIOS = {
+    "token": ("POST", "/token"),
+    "projects": ("GET", "/projects/"),
+    "project": ("GET", "/projects/{project_id}"),
+    "project_summary": ("GET", "/projects/{project_id}/summary"),
+    "accounts": ("GET", "/accounts/{project_id}"),
+    "account": ("GET", "/accounts/{project_id}/{account_id}"),
+    "partners": ("GET", "/accounts/partners/{project_id}/{account_id}"),
+    "ledger": ("GET", "/accounts/ledger/{project_id}/{account_id}"),
+    "search": ("GET", "/search/accounts?q={query}&project_id={project_id}"),
+}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _fixtures(engine, users: int, password: str) -> list[dict]:
+    """
+    Pick up to users synthetic users owning at least one account, with
+    their projects and accounts
+    """
+    from sqlmodel import Session, select
+    from models import Account, Project, User
+
+    statement = (
+        select(User.username, Project.id, Account.id, Account.name)
+        .join(Project, Project.owner_id == User.id)
+        .join(Account, Account.project_id == Project.id)
+        .filter(User.username.like("s%-user-%"))
+        .order_by(User.id, Project.id, Account.id)
+    )
+    fixtures = {}
+    with Session(engine) as session:
+        for username, project_id, account_id, name in session.execute(
+            statement
+        ):
+            if username not in fixtures:
+                if len(fixtures) == users:
+                    break
+                fixtures[username] = {
+                    "username": username,
+                    "password": password,
+                    "accounts": [],
+                }
+            fixtures[username]["accounts"].append(
+                (project_id, account_id, name)
+            )
+    return list(fixtures.values())
+
+
+async def _login(client, fixture: dict) -> str:
+    response = await client.post(
+        "/token",
+        data={
+            "username": fixture["username"],
+            "password": fixture["password"],
+            "scope": "me",
+        },
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def _request(scenario: str, fixture: dict, rng: random.Random) -> dict:
+    method, template = SCENARIOS[scenario]
+    project_id, account_id, name = rng.choice(fixture["accounts"])
+    request = {
+        "method": method,
+        "url": template.format(
+            project_id=project_id, account_id=account_id, query=name[-4:]
+        ),
+    }
+    if scenario == "token":
+        request["data"] = {
+            "username": fixture["username"],
+            "password": fixture["password"],
+            "scope": "me",
+        }
+    else:
+        request["headers"] = {"Authorization": f"Bearer {fixture['token']}"}
+    return request
+
+
+async def run_scenario(
+    client,
+    scenario: str,
+    fixtures: list[dict],
+    counter: QueryCounter,
+    requests: int,
+    concurrency: int,
+    warmup: int,
+    seed: int,
+) -> dict:
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        await client.request(**_request(scenario, rng.choice(fixtures), rng))
+
+    pending = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def worker(number: int):
+        nonlocal errors
+        worker_rng = random.Random(seed * 1000 + number)
+        for _ in pending:
+            fixture = worker_rng.choice(fixtures)
+            request = _request(scenario, fixture, worker_rng)
+            started = time.perf_counter()
+            response = await client.request(**request)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    queries = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(number) for number in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    queries = counter.count - queries
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "queries_per_request": round(queries / requests, 2),
+    }
+
+
+def compare(
+    results: dict, baseline: dict, budgets: dict, tolerance: float
+) -> list[str]:
+    """
+    Return one message per failed check: request errors, p95 over
+    budget, or a regression against the baseline beyond tolerance
+    (latency up, throughput down or more queries per request)
+    """
+    failures = []
+    for scenario, result in results.items():
+        if result["errors"]:
+            failures.append(f"{scenario}: {result['errors']} failed requests")
+        budget = budgets.get(scenario)
+        if budget is not None and result["p95_ms"] > budget:
+            failures.append(
+                f"{scenario}: p95 {result['p95_ms']}ms over budget {budget}ms"
+            )
+        previous = baseline.get(scenario)
+        if not previous:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if result[key] > previous[key] * (1 + tolerance):
+                failures.append(
+                    f"{scenario}: {key} {result[key]} vs baseline "
+                    f"{previous[key]}"
+                )
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            failures.append(
+                f"{scenario}: throughput {result['throughput']} vs baseline "
+                f"{previous['throughput']}"
+            )
+        if result["queries_per_request"] > previous["queries_per_request"]:
+            failures.append(
+                f"{scenario}: {result['queries_per_request']} queries per "
+                f"request vs baseline {previous['queries_per_request']}"
+            )
+    return failures
+
+
+async def _drive(args, base_url: str, fixtures, counter) -> dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+        for fixture in fixtures:
+            fixture["token"] = await _login(client, fixture)
+        results = {}
+        for scenario in args.scenarios:
+            results[scenario] = await run_scenario(
+                client,
+                scenario,
+                fixtures,
+                counter,
+                # Password hashing makes logins far slower than reads
+                max(1, args.requests // 10)
+                if scenario == "token"
+                else args.requests,
+                args.concurrency,
+                args.warmup,
+                args.seed,
+            )
+            print(json.dumps({scenario: results[scenario]}), flush=True)
+        return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--database-url",
+        default=None,
+        help="benchmark an existing database instead of a temporary "
+        "SQLite file (it must contain a synthetic dataset)",
+    )
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--dataset-users", type=int, default=200)
+    parser.add_argument("--password", default="synthetic")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument(
+        "--scenarios", nargs="*", default=list(SCENARIOS), metavar="SCENARIO"
+    )
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--save", type=Path, default=None)
+    parser.add_argument("--budgets", type=Path, default=BUDGETS_FILE)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    directory = None
+    if args.database_url is None:
+        directory = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite:///{directory.name}/benchmark.db"
+    # settings reads DATABASE_URL when first imported
+    os.environ["DATABASE_URL"] = args.database_url
+
+    import uvicorn
+    from sqlalchemy import event
+    from sqlmodel import SQLModel
+    from database import engine
+    from main import app
+
+    engine.echo = False
+    if directory is not None:
+        from populate.synthetic import generate
+
+        SQLModel.metadata.create_all(engine)
+        print(json.dumps(generate(
+            engine,
+            users=args.dataset_users,
+            seed=args.seed,
+            password=args.password,
+        )), flush=True)
+    fixtures = _fixtures(engine, args.users, args.password)
+    if not fixtures:
+        parser.error("the database has no synthetic users with accounts")
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    port = _free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        results = asyncio.run(
+            _drive(args, f"http://127.0.0.1:{port}", fixtures, counter)
+        )
+    finally:
+        server.should_exit = True
+        thread.join()
+        if directory is not None:
+            engine.dispose()
+            directory.cleanup()
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps(results, indent=2) + "\n")
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else {}
+    budgets = json.loads(args.budgets.read_text()) if args.budgets else {}
+    failures = compare(results, baseline, budgets, args.tolerance)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
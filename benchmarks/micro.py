@@ -0,0 +1,231 @@
+"""
+Microbenchmarks of the per-request building blocks
+
+Times token creation and decoding, get_current_user, password
+verification, a rate limit check, response model validation of
+Account/Project lists and ORM hydration of accounts at several row
+counts, against a temporary SQLite database seeded with a synthetic
+dataset.
+
+    python -m benchmarks.micro                # run, append to history
+    python -m benchmarks.micro --compare      # and compare with last run
+    python -m benchmarks.micro --report       # compare the last two runs
+
+Results are appended to benchmarks/results/micro.jsonl.
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+
+HISTORY_FILE = Path(__file__).with_name("results") / "micro.jsonl"
+ROW_COUNTS = (10, 100, 1000, 5000)
+
+
+def measure(function, repeat: int, min_time: float) -> dict:
+    """
+    Time function with timeit: calls per round are picked so a round
+    takes at least min_time, then the best and median of repeat rounds
+    are reported per call
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    rounds = [value / number for value in timer.repeat(repeat, number)]
+    return {
+        "number": number,
+        "min_us": round(min(rounds) * 1e6, 3),
+        "median_us": round(statistics.median(rounds) * 1e6, 3),
+    }
+
+
+def benchmarks(engine) -> dict:
+    """
+    Benchmark name: zero argument callable
+    """
+    from fastapi.security import SecurityScopes
+    from jose import jwt
+    from pydantic import TypeAdapter
+    from sqlmodel import Session, select
+    from models import Account, Project, User
+    from ratelimit import Limit, MemoryBackend
+    import security
+
+    with Session(engine) as session:
+        user = session.exec(
+            select(User).filter(User.username.like("s%-user-%"))
+        ).first()
+    data = {"sub": user.username, "scopes": ["me"]}
+    token = security.create_user_access_token(data)
+    scopes = SecurityScopes(scopes=["me"])
+    password_hash = security.get_password_hash("synthetic")
+    buckets = MemoryBackend()
+    # Never runs out, so every call refills and takes a token
+    limit = Limit(10 ** 9, 1)
+
+    cases = {
+        "create_access_token": lambda: security.create_user_access_token(
+            data
+        ),
+        "jwt_decode": lambda: jwt.decode(
+            token, security.SECRET_KEY, algorithms=[security.ALGORITHM]
+        ),
+        "get_current_user": lambda: security.get_current_user(scopes, token),
+        "verify_password": lambda: security.verify_password(
+            "synthetic", password_hash
+        ),
+        "rate_limit_take": lambda: buckets.take(f"user:{user.id}", limit),
+    }
+
+    accounts = TypeAdapter(list[Account])
+    projects = TypeAdapter(list[Project])
+    for rows in ROW_COUNTS:
+        with Session(engine) as session:
+            loaded_accounts = session.exec(select(Account).limit(rows)).all()
+            loaded_projects = session.exec(select(Project).limit(rows)).all()
+
+        def hydrate(rows=rows):
+            with Session(engine) as session:
+                return session.exec(select(Account).limit(rows)).all()
+
+        # Smaller datasets than rows would be timed under a wrong label
+        if len(loaded_accounts) == rows:
+            cases[f"validate_accounts[{rows}]"] = (
+                lambda loaded=loaded_accounts: accounts.dump_python(
+                    accounts.validate_python(loaded, from_attributes=True),
+                    mode="json",
+                )
+            )
+            cases[f"hydrate_accounts[{rows}]"] = hydrate
+        if len(loaded_projects) == rows:
+            cases[f"validate_projects[{rows}]"] = (
+                lambda loaded=loaded_projects: projects.dump_python(
+                    projects.validate_python(loaded, from_attributes=True),
+                    mode="json",
+                )
+            )
+    return cases
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines() if line]
+
+
+def report(previous: dict, current: dict, tolerance: float) -> list[str]:
+    """
+    Print a comparison table of two runs and return the names of the
+    benchmarks whose median got slower by more than tolerance
+    """
+    print(
+        f"{'benchmark':32} {previous.get('commit') or '?':>12} "
+        f"{current.get('commit') or '?':>12} {'change':>8}"
+    )
+    regressions = []
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            print(f"{name:32} {'-':>12} {result['median_us']:>12}")
+            continue
+        change = result["median_us"] / before["median_us"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = " !"
+        print(
+            f"{name:32} {before['median_us']:>12} {result['median_us']:>12} "
+            f"{change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--history", type=Path, default=HISTORY_FILE)
+    parser.add_argument(
+        "--filter", default=None, help="only run benchmarks containing this"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05)
+    parser.add_argument("--dataset-users", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--compare", action="store_true", help="compare with the last run"
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="only compare the last two runs in the history",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    history = load_history(args.history)
+    if args.report:
+        if len(history) < 2:
+            parser.error("the history needs at least two runs")
+        regressions = report(history[-2], history[-1], args.tolerance)
+        raise SystemExit(1 if regressions else 0)
+
+    directory = tempfile.TemporaryDirectory()
+    # settings reads DATABASE_URL when first imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{directory.name}/micro.db"
+    from sqlmodel import SQLModel
+    from database import engine
+    from populate.synthetic import generate
+
+    engine.echo = False
+    SQLModel.metadata.create_all(engine)
+    generate(engine, users=args.dataset_users, seed=args.seed)
+
+    results = {}
+    for name, function in benchmarks(engine).items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(function, args.repeat, args.min_time)
+        print(json.dumps({name: results[name]}), flush=True)
+    engine.dispose()
+    directory.cleanup()
+
+    run = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if not args.no_save:
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with args.history.open("a") as history_file:
+            history_file.write(json.dumps(run) + "\n")
+    if args.compare and history:
+        regressions = report(history[-1], run, args.tolerance)
+        raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
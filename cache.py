@@ -0,0 +1,618 @@
+import fcntl
+import hashlib
+import importlib
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from settings import (
+    CACHE_BACKEND,
+    CACHE_MMAP_PATH,
+    CACHE_MMAP_SLOT_SIZE,
+    CACHE_MMAP_SLOTS,
+    CACHE_URL,
+)
+
+
+# Messages kept by the invalidation channel of the shared backends
+CHANNEL_SIZE = 1024
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache with per-entry expiry, evicting the
+    least recently used entries beyond maxsize. Counts hits and misses.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def _store(self, key, value, ttl: float) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl: float | None = None) -> bool:
+        """
+        Set key only when it holds no live entry. Returns whether it did.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return False
+            if ttl > 0:
+                self._store(key, value, ttl)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class LocalBackend:
+    """
+    In-process stand-in for a network backend, with the interface of
+    every shared backend: get, set, add and pop of bytes values with a
+    ttl in seconds, clear and count by key prefix, and publish and poll
+    of channel messages. Tests use it in place of RedisBackend.
+    """
+
+    def __init__(self, channel_size: int = CHANNEL_SIZE):
+        self.channel_size = channel_size
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._messages = []
+        self._sequence = 0
+
+    def _live(self, key: bytes, now: float):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key: bytes) -> bytes | None:
+        with self._lock:
+            entry = self._live(key, time.time())
+        return None if entry is None else entry[0]
+
+    def set(self, key: bytes, value: bytes, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+
+    def add(self, key: bytes, value: bytes, ttl: float) -> bool:
+        with self._lock:
+            now = time.time()
+            if self._live(key, now) is not None:
+                return False
+            if ttl > 0:
+                self._entries[key] = (value, now + ttl)
+            return True
+
+    def pop(self, key: bytes) -> bytes | None:
+        with self._lock:
+            entry = self._live(key, time.time())
+            self._entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def clear(self, prefix: bytes) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                if key.startswith(prefix):
+                    del self._entries[key]
+
+    def count(self, prefix: bytes) -> int:
+        now = time.time()
+        with self._lock:
+            return sum(
+                1
+                for key, (_, expires) in self._entries.items()
+                if key.startswith(prefix) and expires > now
+            )
+
+    def publish(self, message: bytes) -> None:
+        with self._lock:
+            self._sequence += 1
+            self._messages.append(message)
+            del self._messages[:-self.channel_size]
+
+    def poll(self, cursor: int | None) -> tuple[int, list[bytes] | None]:
+        """
+        The new cursor and the messages published after cursor, None
+        instead of the messages when some of them were dropped already
+        """
+        with self._lock:
+            if cursor is None:
+                return self._sequence, []
+            missed = self._sequence - cursor
+            if missed > len(self._messages):
+                return self._sequence, None
+            start = len(self._messages) - missed
+            return self._sequence, self._messages[start:]
+
+
+class MmapBackend:
+    """
+    Shared memory store of the workers of a host: a file under /dev/shm
+    mapped by every worker, holding slot_size byte slots in sets of
+    WAYS where a key can go, evicting the least recently used slot of
+    its set. Values too big for a slot are not stored. Processes lock
+    the bytes they use with fcntl, threads of a process a shared lock.
+    Every worker must use the same path, slots and slot_size.
+    """
+
+    MAGIC = b"fasbcch1"
+    WAYS = 8
+    # magic, slots, slot size, channel sequence
+    HEADER = struct.Struct("<8sQQQ")
+    # sequence, length; followed by the message
+    MESSAGE = struct.Struct("<QH")
+    MESSAGE_SIZE = 64
+    # key hash (0 when free), expiry, last use, key and value lengths;
+    # followed by the key and the value
+    SLOT = struct.Struct("<QddII")
+    _thread_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: str = CACHE_MMAP_PATH,
+        slots: int = CACHE_MMAP_SLOTS,
+        slot_size: int = CACHE_MMAP_SLOT_SIZE,
+        channel_size: int = CHANNEL_SIZE,
+    ):
+        self.slots = max(self.WAYS, slots - slots % self.WAYS)
+        self.slot_size = slot_size
+        self.channel_size = channel_size
+        self._channel = self.HEADER.size
+        self._base = self._channel + channel_size * self.MESSAGE_SIZE
+        size = self._base + self.slots * slot_size
+        header = (self.MAGIC, self.slots, slot_size)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked(0, self.HEADER.size):
+            current = os.pread(self._fd, self.HEADER.size, 0)
+            if (
+                os.fstat(self._fd).st_size != size
+                or len(current) < self.HEADER.size
+                or self.HEADER.unpack(current)[:3] != header
+            ):
+                # New or laid out for other settings, start empty
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self.HEADER.pack(*header, 0), 0)
+        self._map = mmap.mmap(self._fd, size)
+
+    @contextmanager
+    def _locked(self, start: int, length: int):
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def _hash(self, key: bytes) -> int:
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _set_of(self, digest: int) -> tuple[int, int]:
+        start = self._base + (
+            digest % (self.slots // self.WAYS)
+        ) * self.WAYS * self.slot_size
+        return start, self.WAYS * self.slot_size
+
+    def _find(self, key: bytes, digest: int, now: float):
+        """
+        Offset of the live slot of key, or None and the offset of the
+        slot to store key in
+        """
+        start, length = self._set_of(digest)
+        victim, victim_used = start, float("inf")
+        for offset in range(start, start + length, self.slot_size):
+            slot_hash, expires, used, key_length, _ = self.SLOT.unpack_from(
+                self._map, offset
+            )
+            if slot_hash == 0 or expires <= now:
+                used = -1.0
+            elif slot_hash == digest:
+                stored = offset + self.SLOT.size
+                if self._map[stored:stored + key_length] == key:
+                    return offset, offset
+            if used < victim_used:
+                victim, victim_used = offset, used
+        return None, victim
+
+    def _value(self, offset: int) -> bytes:
+        _, _, _, key_length, value_length = self.SLOT.unpack_from(
+            self._map, offset
+        )
+        start = offset + self.SLOT.size + key_length
+        return self._map[start:start + value_length]
+
+    def _write(
+        self, offset: int, key: bytes, value: bytes, digest: int,
+        expires: float, now: float,
+    ) -> None:
+        self.SLOT.pack_into(
+            self._map, offset, digest, expires, now, len(key), len(value)
+        )
+        start = offset + self.SLOT.size
+        self._map[start:start + len(key) + len(value)] = key + value
+
+    def _fits(self, key: bytes, value: bytes) -> bool:
+        return self.SLOT.size + len(key) + len(value) <= self.slot_size
+
+    def get(self, key: bytes) -> bytes | None:
+        digest = self._hash(key)
+        now = time.time()
+        with self._locked(*self._set_of(digest)):
+            offset, _ = self._find(key, digest, now)
+            if offset is None:
+                return None
+            # Last use, for the eviction
+            struct.pack_into("<d", self._map, offset + 16, now)
+            return self._value(offset)
+
+    def set(self, key: bytes, value: bytes, ttl: float) -> None:
+        digest = self._hash(key)
+        now = time.time()
+        with self._locked(*self._set_of(digest)):
+            offset, victim = self._find(key, digest, now)
+            if self._fits(key, value):
+                self._write(victim, key, value, digest, now + ttl, now)
+            elif offset is not None:
+                # Never leave an outdated value behind
+                self.SLOT.pack_into(self._map, offset, 0, 0, 0, 0, 0)
+
+    def add(self, key: bytes, value: bytes, ttl: float) -> bool:
+        digest = self._hash(key)
+        now = time.time()
+        with self._locked(*self._set_of(digest)):
+            offset, victim = self._find(key, digest, now)
+            if offset is not None:
+                return False
+            if ttl > 0 and self._fits(key, value):
+                self._write(victim, key, value, digest, now + ttl, now)
+            return True
+
+    def pop(self, key: bytes) -> bytes | None:
+        digest = self._hash(key)
+        with self._locked(*self._set_of(digest)):
+            offset, _ = self._find(key, digest, time.time())
+            if offset is None:
+                return None
+            value = self._value(offset)
+            self.SLOT.pack_into(self._map, offset, 0, 0, 0, 0, 0)
+            return value
+
+    def _slots(self, prefix: bytes, now: float):
+        for offset in range(
+            self._base, len(self._map), self.slot_size
+        ):
+            slot_hash, expires, _, key_length, _ = self.SLOT.unpack_from(
+                self._map, offset
+            )
+            stored = offset + self.SLOT.size
+            if (
+                slot_hash != 0
+                and expires > now
+                and self._map[stored:stored + key_length].startswith(prefix)
+            ):
+                yield offset
+
+    def clear(self, prefix: bytes) -> None:
+        with self._locked(self._base, len(self._map) - self._base):
+            for offset in list(self._slots(prefix, time.time())):
+                self.SLOT.pack_into(self._map, offset, 0, 0, 0, 0, 0)
+
+    def count(self, prefix: bytes) -> int:
+        with self._locked(self._base, len(self._map) - self._base):
+            return sum(1 for _ in self._slots(prefix, time.time()))
+
+    def _sequence(self) -> int:
+        return struct.unpack_from("<Q", self._map, self._channel - 8)[0]
+
+    def publish(self, message: bytes) -> None:
+        if self.MESSAGE.size + len(message) > self.MESSAGE_SIZE:
+            raise ValueError("Channel message too long")
+        with self._locked(0, self._base):
+            sequence = self._sequence() + 1
+            offset = (
+                self._channel
+                + sequence % self.channel_size * self.MESSAGE_SIZE
+            )
+            self.MESSAGE.pack_into(self._map, offset, sequence, len(message))
+            start = offset + self.MESSAGE.size
+            self._map[start:start + len(message)] = message
+            struct.pack_into("<Q", self._map, self._channel - 8, sequence)
+
+    def poll(self, cursor: int | None) -> tuple[int, list[bytes] | None]:
+        """
+        The new cursor and the messages published after cursor, None
+        instead of the messages when some of them were overwritten
+        """
+        with self._locked(0, self._base):
+            sequence = self._sequence()
+            if cursor is None or cursor == sequence:
+                return sequence, []
+            if not 0 < sequence - cursor <= self.channel_size:
+                return sequence, None
+            messages = []
+            for number in range(cursor + 1, sequence + 1):
+                offset = (
+                    self._channel
+                    + number % self.channel_size * self.MESSAGE_SIZE
+                )
+                stored, length = self.MESSAGE.unpack_from(self._map, offset)
+                if stored != number:
+                    return sequence, None
+                start = offset + self.MESSAGE.size
+                messages.append(self._map[start:start + length])
+            return sequence, messages
+
+
+class RedisBackend:
+    """
+    Network store shared by the workers of every host, on Redis with
+    the optional redis package, or on client when given. The channel is
+    a capped stream. Values are pickles, so only trusted clients may
+    write to the server.
+    """
+
+    CHANNEL = b"cache:channel"
+
+    def __init__(
+        self,
+        url: str = CACHE_URL,
+        channel_size: int = CHANNEL_SIZE,
+        client=None,
+    ):
+        if client is None:
+            try:
+                import redis
+            except ImportError as error:
+                raise RuntimeError(
+                    "The redis cache backend needs the redis package"
+                ) from error
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.channel_size = channel_size
+
+    def get(self, key: bytes) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: bytes, value: bytes, ttl: float) -> None:
+        self.client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    def add(self, key: bytes, value: bytes, ttl: float) -> bool:
+        if ttl <= 0:
+            return not self.client.exists(key)
+        return bool(
+            self.client.set(key, value, px=max(1, int(ttl * 1000)), nx=True)
+        )
+
+    def pop(self, key: bytes) -> bytes | None:
+        return self.client.getdel(key)
+
+    def _keys(self, prefix: bytes):
+        # Prefixes are cache names, free of glob characters
+        return self.client.scan_iter(match=prefix + b"*", count=1000)
+
+    def clear(self, prefix: bytes) -> None:
+        keys = list(self._keys(prefix))
+        if keys:
+            self.client.unlink(*keys)
+
+    def count(self, prefix: bytes) -> int:
+        return sum(1 for _ in self._keys(prefix))
+
+    def publish(self, message: bytes) -> None:
+        self.client.xadd(
+            self.CHANNEL,
+            {b"message": message},
+            maxlen=self.channel_size,
+            approximate=True,
+        )
+
+    def poll(self, cursor: bytes | None) -> tuple[bytes, list[bytes] | None]:
+        """
+        The new cursor and the messages published after cursor, None
+        when the stream was trimmed past cursor and some may be lost
+        """
+        if cursor is None:
+            last = self.client.xrevrange(self.CHANNEL, count=1)
+            return (last[0][0] if last else b"0-0"), []
+        latest = cursor
+        messages = []
+        for _, entries in self.client.xread({self.CHANNEL: cursor}) or ():
+            for latest, fields in entries:
+                messages.append(fields[b"message"])
+        # After reading, so trimming during the read counts as well
+        first = self.client.xrange(self.CHANNEL, count=1)
+        if first and _stream_id(first[0][0]) > _stream_id(cursor):
+            return latest, None
+        return latest, messages
+
+
+def _stream_id(entry_id: bytes) -> tuple[int, int]:
+    milliseconds, _, sequence = entry_id.partition(b"-")
+    return int(milliseconds), int(sequence or 0)
+
+
+BACKENDS = {
+    "local": LocalBackend,
+    "mmap": MmapBackend,
+    "redis": RedisBackend,
+}
+
+
+def load_backend(name: str):
+    """
+    Shared backend by name, None for "memory" (caches of each worker),
+    or "module:Class" of a custom backend with the interface of
+    LocalBackend
+    """
+    if name == "memory":
+        return None
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    module, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module), attribute)()
+
+
+backend = load_backend(CACHE_BACKEND)
+
+
+class SharedCache:
+    """
+    TTLCache interface on a shared backend, so every worker sees the
+    same entries. Keys and values are pickled, keys are prefixed with
+    the cache name. The backend bounds the size, maxsize is unused.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        backend,
+        maxsize: int = 1024,
+        ttl: float = 300.0,
+    ):
+        self.name = name
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._prefix = f"{name}:".encode()
+
+    def _key(self, key) -> bytes:
+        return self._prefix + pickle.dumps(key)
+
+    def get(self, key, default=None):
+        value = self.backend.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.backend.set(self._key(key), pickle.dumps(value), ttl)
+
+    def add(self, key, value, ttl: float | None = None) -> bool:
+        """
+        Set key only when it holds no live entry. Returns whether it did.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        return self.backend.add(
+            self._key(key), pickle.dumps(value), max(ttl, 0)
+        )
+
+    def pop(self, key, default=None):
+        value = self.backend.pop(self._key(key))
+        return default if value is None else pickle.loads(value)
+
+    def clear(self) -> None:
+        self.backend.clear(self._prefix)
+
+    def __len__(self) -> int:
+        return self.backend.count(self._prefix)
+
+
+def make_cache(name: str, maxsize: int = 1024, ttl: float = 300.0):
+    """
+    Cache named name on the CACHE_BACKEND shared backend, or a TTLCache
+    of this worker when there is none
+    """
+    if backend is None:
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    return SharedCache(name, backend, maxsize=maxsize, ttl=ttl)
+
+
+class Channel:
+    """
+    Invalidation messages between the workers sharing a backend. Each
+    worker receives the messages of the others once, in order, polling
+    for them; without a backend there is no one to tell.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._pid = None
+        self._cursor = None
+        if backend is not None:
+            self._cursor = backend.poll(None)[0]
+
+    def _sender(self) -> bytes:
+        # Forked workers get a sender of their own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._id = os.urandom(8)
+        return self._id
+
+    def publish(self, message: str) -> None:
+        if self.backend is not None:
+            self.backend.publish(self._sender() + message.encode())
+
+    def receive(self) -> list[str] | None:
+        """
+        Messages of the other workers since the last call, None when
+        some were lost and everything derived from them is suspect
+        """
+        if self.backend is None:
+            return []
+        sender = self._sender()
+        with self._lock:
+            self._cursor, messages = self.backend.poll(self._cursor)
+        if messages is None:
+            return None
+        return [
+            message[8:].decode()
+            for message in messages
+            if message[:8] != sender
+        ]
+
+
+channel = Channel(backend)
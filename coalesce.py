@@ -0,0 +1,80 @@
+import asyncio
+from fastapi import Response
+from pydantic import TypeAdapter
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+import metrics
+
+
+coalesced = metrics.Counter(
+    "coalesced_requests_total",
+    "Reads answered by a call already in flight, by name.",
+    ("name",),
+)
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time in the threadpool. Callers asking
+    for a key while its call is in flight wait for it and share its
+    result or error, unless the caller that started it was cancelled,
+    in which case one of them starts over.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, function, *args):
+        while key in self._calls:
+            call = self._calls[key]
+            coalesced.inc((self.name,))
+            try:
+                return await asyncio.shield(call)
+            except asyncio.CancelledError:
+                if not call.cancelled() or asyncio.current_task().cancelling():
+                    raise
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        try:
+            result = await run_in_threadpool(function, *args)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as error:
+            call.set_exception(error)
+            # Followers, if any, get it; do not warn when there are none
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            del self._calls[key]
+        return result
+
+
+def read_key(session: Session, user_id: int | None, *query) -> tuple:
+    """
+    Key of a read: the query, who may see it (None for superusers) and
+    the database it runs on, so replica and primary reads stay apart
+    """
+    return (*query, user_id, getattr(session.bind, "engine", session.bind))
+
+
+def serialize(model, value) -> bytes:
+    return TypeAdapter(model).dump_json(value)
+
+
+def json_response(response: Response, body: bytes) -> Response:
+    """
+    Response for a shared body, keeping the headers the handler and its
+    dependencies set on response
+    """
+    shared = Response(body, media_type="application/json")
+    for name, value in response.headers.items():
+        if name != "content-length":
+            shared.headers.append(name, value)
+    return shared
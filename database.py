@@ -1,12 +1,60 @@
-from sqlmodel import Session, create_engine
+from fastapi import Request
+from sqlalchemy import update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session, SQLModel, create_engine, select
 
 
-from settings import DATABASE_URL
+from settings import DATABASE_URL, DATABASE_REPLICA_URLS, SHARD_URLS
 
 
-engine = create_engine(DATABASE_URL, echo=True)
+def _connect_args(url: str) -> dict:
+    if url.startswith("sqlite"):
+        return {"check_same_thread": False}
+    return {}
+
+
+engine = create_engine(
+    DATABASE_URL, echo=True, connect_args=_connect_args(DATABASE_URL)
+)
 # change to False for production
 
+replica_engines = [
+    create_engine(
+        url,
+        echo=engine.echo,
+        connect_args=_connect_args(url),
+        pool_pre_ping=True,
+    )
+    for url in DATABASE_REPLICA_URLS
+]
+
+# Shard engines by name, in SHARD_URLS order
+shard_engines = {
+    f"shard{number}": create_engine(
+        url, echo=engine.echo, connect_args=_connect_args(url)
+    )
+    for number, url in enumerate(SHARD_URLS)
+}
+
+# Writes use INSERT ... ON CONFLICT, see dialect_insert
+ON_CONFLICT_DIALECTS = ("postgresql", "sqlite")
+
+
+def check_dialects(engines) -> None:
+    """
+    Refuse databases without INSERT ... ON CONFLICT at startup rather
+    than on the first write
+    """
+    for checked in engines:
+        if checked.dialect.name not in ON_CONFLICT_DIALECTS:
+            raise ValueError(
+                f"Unsupported database {checked.dialect.name}, "
+                f"use one of {', '.join(ON_CONFLICT_DIALECTS)}"
+            )
+
+
+check_dialects([engine, *replica_engines, *shard_engines.values()])
+
 
 def init_db(session: Session) -> None:
     """
@@ -19,6 +67,77 @@ def init_db(session: Session) -> None:
 
 
 # @contextmanager
-def get_session() -> Session:
-    with Session(engine) as session:
+def get_session(request: Request) -> Session:
+    if shard_engines:
+        from sharding import get_shard_session
+        yield from get_shard_session(request)
+        return
+    # Handlers serialize their results right after committing, keep the
+    # loaded state instead of reloading every row
+    with Session(engine, expire_on_commit=False) as session:
         yield session
+
+
+def dialect_insert(session: Session, model: type[SQLModel]):
+    """
+    insert() construct of the session's dialect, with ON CONFLICT support
+    """
+    dialect = session.get_bind(model).dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(f"ON CONFLICT not supported on {dialect}")
+
+
+def insert_unique(session: Session, instance: SQLModel) -> SQLModel | None:
+    """
+    Insert instance with a single INSERT ... ON CONFLICT DO NOTHING
+    RETURNING statement. Returns the stored row, or None when it
+    conflicts with an existing row on any unique constraint.
+    """
+    model = type(instance)
+    values = {}
+    for column in model.__table__.columns:
+        value = getattr(instance, column.name)
+        if column.primary_key and value is None:
+            continue
+        values[column.name] = value
+    statement = (
+        dialect_insert(session, model)
+        .values(**values)
+        .on_conflict_do_nothing()
+        .returning(model)
+    )
+    return session.scalars(statement).first()
+
+
+def update_returning(
+    session: Session,
+    model: type[SQLModel],
+    values: dict,
+    *where,
+    versions: list[int] | None = None,
+) -> SQLModel | None:
+    """
+    Apply values to the row matching where with a single
+    UPDATE ... WHERE ... RETURNING statement. Authorization predicates
+    belong in where. Models with a version column get it incremented,
+    and versions restricts the update to rows still at one of them.
+    Returns the updated row, or None when nothing matched.
+    """
+    versioned = "version" in model.__table__.c
+    if versioned and versions is not None:
+        where = (*where, model.version.in_(versions))
+    if not values:
+        return session.exec(select(model).where(*where)).first()
+    if versioned:
+        values = {**values, "version": model.version + 1}
+    statement = update(model).where(*where).values(**values).returning(model)
+    return session.scalars(
+        statement,
+        execution_options={
+            "synchronize_session": False,
+            "populate_existing": True,
+        },
+    ).first()
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import Engine, event
+from sqlalchemy.orm import Session
+from settings import REQUEST_TIMEOUT, REQUEST_TIMEOUT_MAX, ROUTE_TIMEOUTS
+import metrics
+
+
+HEADER = b"x-request-timeout"
+# SQLite virtual machine steps between two deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+
+current: ContextVar["Deadline | None"] = ContextVar("deadline", default=None)
+
+expired_requests = metrics.Counter(
+    "request_deadline_exceeded_total",
+    "Requests stopped by their deadline or a client disconnect.",
+    ("reason",),
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_timeouts(value: str) -> dict[str, float]:
+    """
+    {route template: seconds} from "/accounts/{project_id}=10,..."
+    """
+    timeouts = {}
+    for item in value.split(","):
+        if item.strip():
+            path, _, seconds = item.rpartition("=")
+            timeouts[path.strip()] = float(seconds)
+    return timeouts
+
+
+route_timeouts = parse_timeouts(ROUTE_TIMEOUTS)
+
+
+def longest_budget() -> float:
+    """
+    Longest time any request may run: the largest of the default, the
+    route timeouts and the cap of the header
+    """
+    return max(REQUEST_TIMEOUT, REQUEST_TIMEOUT_MAX, *route_timeouts.values())
+
+
+def _interrupt(dbapi_connection) -> None:
+    # psycopg2 cancels the running statement, sqlite3 interrupts it
+    for name in ("cancel", "interrupt"):
+        method = getattr(dbapi_connection, name, None)
+        if method is not None:
+            method()
+            return
+
+
+class Deadline:
+    """
+    Time budget of a request: the header override, or the timeout of
+    its route template once routed, or REQUEST_TIMEOUT
+    """
+
+    def __init__(self, scope, timeout: float | None = None):
+        self.scope = scope
+        self.timeout = timeout
+        self.start = time.monotonic()
+        self.cancelled = False
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    def budget(self) -> float:
+        if self.timeout is not None:
+            return self.timeout
+        route = getattr(self.scope.get("route"), "path", None)
+        return route_timeouts.get(route, REQUEST_TIMEOUT)
+
+    def remaining(self) -> float:
+        return self.start + self.budget() - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.cancelled or self.remaining() <= 0
+
+    def attach(self, dbapi_connection) -> None:
+        with self._lock:
+            self.connections.add(dbapi_connection)
+
+    def detach(self, dbapi_connection) -> None:
+        with self._lock:
+            self.connections.discard(dbapi_connection)
+
+    def cancel(self) -> None:
+        """
+        Interrupt the statements running on the request's connections
+        """
+        self.cancelled = True
+        with self._lock:
+            connections = list(self.connections)
+        for dbapi_connection in connections:
+            _interrupt(dbapi_connection)
+
+
+@event.listens_for(Session, "after_begin")
+def _after_begin(session, transaction, connection) -> None:
+    # Push the remaining budget down to the database for the transaction
+    deadline = current.get()
+    if deadline is None:
+        return
+    remaining = deadline.remaining()
+    if deadline.cancelled or remaining <= 0:
+        raise DeadlineExceeded
+    dbapi_connection = connection.connection.dbapi_connection
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {max(1, int(remaining * 1000))}"
+        )
+    elif connection.dialect.name == "sqlite":
+        dbapi_connection.set_progress_handler(
+            deadline.expired, SQLITE_PROGRESS_STEPS
+        )
+    deadline.attach(dbapi_connection)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Refuse statements of expired requests and forget the request's
+    connections when they return to the pool
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, *args) -> None:
+        deadline = current.get()
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record) -> None:
+        deadline = current.get()
+        if deadline is not None:
+            deadline.detach(dbapi_connection)
+        if engine.dialect.name == "sqlite":
+            dbapi_connection.set_progress_handler(None, 0)
+
+
+def _header_timeout(scope) -> float | None:
+    for key, value in scope["headers"]:
+        if key == HEADER:
+            try:
+                timeout = float(value)
+            except ValueError:
+                return None
+            return min(max(timeout, 0.0), REQUEST_TIMEOUT_MAX)
+    return None
+
+
+async def _timeout_response(send) -> None:
+    body = json.dumps({"detail": "Request deadline exceeded"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 504,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class DeadlineMiddleware:
+    """
+    Pure ASGI middleware giving each request a Deadline, answering 504
+    when it fails after its deadline and cancelling it when the client
+    disconnects. The request body is read upfront so the disconnect can
+    be watched while the handler runs.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        deadline = Deadline(scope, _header_timeout(scope))
+        messages = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            messages.append(message)
+            if not message.get("more_body"):
+                break
+        disconnected = asyncio.Event()
+
+        async def receive_wrapper():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        started = False
+        # Set once the last body message is sent, servers report the
+        # request as disconnected from then on
+        completed = False
+
+        async def send_wrapper(message):
+            nonlocal started, completed
+            if message["type"] == "http.response.start":
+                started = True
+            elif (
+                message["type"] == "http.response.body"
+                and not message.get("more_body")
+            ):
+                completed = True
+            await send(message)
+
+        token = current.set(deadline)
+        handler = asyncio.create_task(
+            self.app(scope, receive_wrapper, send_wrapper)
+        )
+        current.reset(token)
+
+        async def watch():
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                # Work after the response (profile reports, background
+                # tasks) is not abandoned by the client
+                if not completed and not handler.done():
+                    expired_requests.inc(("disconnect",))
+                    deadline.cancel()
+                    handler.cancel()
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not deadline.cancelled:
+                # The server cancelled this request
+                handler.cancel()
+                raise
+        except Exception:
+            if started or not deadline.expired() or deadline.cancelled:
+                raise
+            expired_requests.inc(("timeout",))
+            await _timeout_response(send)
+        finally:
+            watcher.cancel()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+from cache import SharedCache, TTLCache, make_cache
+from security import token_subject
+from settings import IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL
+import deadlines
+import metrics
+
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+# Placeholder stored while the first request with a key is running
+IN_FLIGHT = "in-flight"
+# Rejections a retry can get past (rate limited, conflicting, stale), not
+# stored so the retry runs the request
+RETRYABLE = {409, 412, 429}
+
+responses = make_cache(
+    "idempotency", maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL
+)
+
+replays = metrics.Counter(
+    "idempotent_requests_total",
+    "POST requests with an Idempotency-Key by outcome.",
+    ("outcome",),
+)
+
+
+async def _error(send, status: int, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    Pure ASGI middleware answering retried POST requests from the first
+    response sent for the same user and Idempotency-Key, without running
+    the handler again. Reusing a key for a different request is a 422, a
+    retry while the first request still runs a 409. Server errors and
+    RETRYABLE rejections are not stored so the request can be retried.
+    """
+
+    def __init__(self, app, store: TTLCache | SharedCache = responses):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        key = headers.get(HEADER)
+        user = token_subject(
+            headers.get(b"authorization", b"").decode("latin-1")
+        )
+        if key is None or user is None:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await _error(send, 400, "Idempotency-Key is too long")
+            return
+
+        messages = []
+        body = hashlib.sha256()
+        while True:
+            message = await receive()
+            messages.append(message)
+            body.update(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        fingerprint = (scope["path"], scope["query_string"], body.digest())
+        store_key = (user, key)
+
+        # The marker only outlives a crashed worker until the request
+        # could have reached its deadline, the response is kept longer
+        if not self.store.add(
+            store_key,
+            (IN_FLIGHT, fingerprint),
+            ttl=deadlines.longest_budget(),
+        ):
+            stored = self.store.get(store_key)
+            if stored is None:
+                # Expired in between, treat it as a retry in flight
+                stored = (IN_FLIGHT, fingerprint)
+            if stored[1] != fingerprint:
+                replays.inc(("mismatch",))
+                await _error(
+                    send, 422, "Idempotency-Key was used for another request"
+                )
+            elif stored[0] == IN_FLIGHT:
+                replays.inc(("in_flight",))
+                await _error(
+                    send, 409, "A request with this Idempotency-Key is running"
+                )
+            else:
+                replays.inc(("replayed",))
+                status, response_headers, response_body = stored[0]
+                await send({
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        *response_headers,
+                        (b"idempotent-replayed", b"true"),
+                    ],
+                })
+                await send({
+                    "type": "http.response.body",
+                    "body": response_body,
+                })
+            return
+
+        replays.inc(("stored",))
+
+        async def replay_receive():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        response = {}
+        chunks = []
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        saved = False
+        try:
+            await self.app(scope, replay_receive, send_wrapper)
+            status = response.get("status", 500)
+            if status < 500 and status not in RETRYABLE:
+                stored = (
+                    response["status"],
+                    response["headers"],
+                    b"".join(chunks),
+                )
+                self.store.set(store_key, (stored, fingerprint))
+                saved = True
+        finally:
+            if not saved:
+                self.store.pop(store_key)
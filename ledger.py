@@ -0,0 +1,204 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from sqlalchemy import and_, delete, func, insert
+from sqlmodel import Session, select
+from models import Account, BalanceSnapshot, BalancePoint, LedgerEntry
+from settings import LEDGER_SNAPSHOT_INTERVAL
+
+
+INTERVALS = ("day", "month")
+MAX_PERIODS = 1000
+
+
+def record_movement(
+    session: Session,
+    account: Account,
+    amount: Decimal,
+    description: str | None = None,
+) -> None:
+    """
+    Append a movement to the account ledger. account.amount must
+    already hold the balance after the movement and the account row must
+    be locked (or new), so checkpoints record a consistent balance.
+    """
+    now = datetime.now()
+    statement = (
+        insert(LedgerEntry)
+        .values(
+            account_id=account.id,
+            project_id=account.project_id,
+            amount=amount,
+            posted_at=now,
+            description=description,
+        )
+        .returning(LedgerEntry.id)
+    )
+    entry_id = session.execute(statement).scalar_one()
+
+    last_snapshot = (
+        select(func.coalesce(func.max(BalanceSnapshot.entry_id), 0))
+        .filter(BalanceSnapshot.account_id == account.id)
+        .scalar_subquery()
+    )
+    statement = select(func.count(LedgerEntry.id)).filter(
+        LedgerEntry.account_id == account.id,
+        LedgerEntry.id > last_snapshot,
+    )
+    if session.exec(statement).one() >= LEDGER_SNAPSHOT_INTERVAL:
+        session.execute(
+            insert(BalanceSnapshot).values(
+                account_id=account.id,
+                entry_id=entry_id,
+                posted_at=now,
+                balance=account.amount,
+            )
+        )
+
+
+def delete_account_ledger(session: Session, account_id: int) -> None:
+    session.execute(
+        delete(BalanceSnapshot).where(BalanceSnapshot.account_id == account_id)
+    )
+    session.execute(
+        delete(LedgerEntry).where(LedgerEntry.account_id == account_id)
+    )
+
+
+def balances_at(
+    session: Session,
+    account_ids: list[int],
+    at: datetime,
+    inclusive: bool = True,
+) -> dict[int, Decimal]:
+    """
+    Balance of each account at a point in time: the latest snapshot
+    taken by then plus the entries posted after it, at most
+    LEDGER_SNAPSHOT_INTERVAL of them per account.
+    """
+    if not account_ids:
+        return {}
+    if inclusive:
+        snapshot_posted = BalanceSnapshot.posted_at <= at
+        entry_posted = LedgerEntry.posted_at <= at
+    else:
+        snapshot_posted = BalanceSnapshot.posted_at < at
+        entry_posted = LedgerEntry.posted_at < at
+
+    latest = (
+        select(
+            BalanceSnapshot.account_id,
+            func.max(BalanceSnapshot.entry_id).label("entry_id"),
+        )
+        .filter(BalanceSnapshot.account_id.in_(account_ids), snapshot_posted)
+        .group_by(BalanceSnapshot.account_id)
+        .subquery()
+    )
+    snapshots = select(
+        BalanceSnapshot.account_id, BalanceSnapshot.balance
+    ).join(
+        latest,
+        and_(
+            BalanceSnapshot.account_id == latest.c.account_id,
+            BalanceSnapshot.entry_id == latest.c.entry_id,
+        ),
+    )
+    tails = (
+        select(LedgerEntry.account_id, func.sum(LedgerEntry.amount))
+        .outerjoin(latest, LedgerEntry.account_id == latest.c.account_id)
+        .filter(
+            LedgerEntry.account_id.in_(account_ids),
+            LedgerEntry.id > func.coalesce(latest.c.entry_id, 0),
+            entry_posted,
+        )
+        .group_by(LedgerEntry.account_id)
+    )
+
+    balances = {account_id: Decimal(0) for account_id in account_ids}
+    for account_id, balance in session.execute(snapshots):
+        balances[account_id] += Decimal(balance)
+    for account_id, amount in session.execute(tails):
+        balances[account_id] += Decimal(amount or 0)
+    return balances
+
+
+def _period(moment: datetime | date, interval: str) -> date:
+    day = moment.date() if isinstance(moment, datetime) else moment
+    if interval == "month":
+        return day.replace(day=1)
+    return day
+
+
+def _periods(start: date, end: date, interval: str) -> list[date]:
+    periods = []
+    current = _period(start, interval)
+    while current <= end:
+        periods.append(current)
+        if interval == "month":
+            current = (current + timedelta(days=32)).replace(day=1)
+        else:
+            current += timedelta(days=1)
+    return periods
+
+
+def balance_series(
+    session: Session,
+    accounts: list[Account],
+    start: date,
+    end: date,
+    interval: str = "day",
+) -> list[BalancePoint]:
+    """
+    Closing balance per period between start and end, summed per
+    currency over the given accounts.
+    """
+    if interval not in INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+    if end < start:
+        raise ValueError("end must not be before start")
+    periods = _periods(start, end, interval)
+    if len(periods) > MAX_PERIODS:
+        raise ValueError(f"At most {MAX_PERIODS} periods per series")
+
+    currencies = {account.id: account.currency_id for account in accounts}
+    opening = balances_at(
+        session,
+        list(currencies),
+        datetime.combine(periods[0], time.min),
+        inclusive=False,
+    )
+    statement = (
+        select(
+            LedgerEntry.account_id, LedgerEntry.posted_at, LedgerEntry.amount
+        )
+        .filter(
+            LedgerEntry.account_id.in_(list(currencies)),
+            LedgerEntry.posted_at >= datetime.combine(periods[0], time.min),
+            LedgerEntry.posted_at < datetime.combine(
+                end + timedelta(days=1), time.min
+            ),
+        )
+        .order_by(LedgerEntry.posted_at, LedgerEntry.id)
+    )
+    movements = {}
+    for account_id, posted_at, amount in session.execute(statement):
+        key = (_period(posted_at, interval), currencies[account_id])
+        movements[key] = movements.get(key, Decimal(0)) + Decimal(amount)
+
+    running = {}
+    for account_id, balance in opening.items():
+        currency_id = currencies[account_id]
+        running[currency_id] = running.get(currency_id, Decimal(0)) + balance
+    points = []
+    for period in periods:
+        for currency_id in sorted(running):
+            running[currency_id] += movements.get(
+                (period, currency_id), Decimal(0)
+            )
+            points.append(
+                BalancePoint(
+                    period=period,
+                    currency_id=currency_id,
+                    balance=running[currency_id],
+                )
+            )
+    return points
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import re
+import time
+from collections import deque
+from settings import (
+    CONCURRENCY_INITIAL,
+    CONCURRENCY_LATENCY_TARGET,
+    CONCURRENCY_MAX,
+    CONCURRENCY_MIN,
+    CONCURRENCY_QUEUE_SIZE,
+    CONCURRENCY_QUEUE_TIMEOUT,
+)
+import metrics
+
+
+EXEMPT = "exempt"
+CRITICAL = "critical"
+NORMAL = "normal"
+BULK = "bulk"
+# Served outside the limit: health checks and scrapes are cheap and must
+# keep working under overload
+EXEMPT_PATHS = {"/ping", "/metrics"}
+# Counted against the limit but admitted before anything else: logins
+# hash passwords, so they cannot be unlimited
+CRITICAL_PATHS = {"/token"}
+# GET endpoints listing many rows, admitted only into BULK_SHARE of the
+# limit and after queued normal requests
+BULK_PATTERNS = [
+    re.compile(pattern)
+    for pattern in (
+        r"^/projects/?$",
+        r"^/accounts/\d+/?$",
+        r"^/accounts/partners/\d+/\d+/?$",
+        r"^/accounts/ledger/\d+/(series|\d+)/?$",
+        r"^/search/",
+        r"^/admin/users/?$",
+        r"^/(banks|countries|currencies)/?$",
+    )
+]
+BULK_SHARE = 0.5
+
+
+def classify(scope) -> str:
+    path = scope["path"]
+    if path in EXEMPT_PATHS:
+        return EXEMPT
+    if path in CRITICAL_PATHS:
+        return CRITICAL
+    if scope["method"] == "GET" and any(
+        pattern.match(path) for pattern in BULK_PATTERNS
+    ):
+        return BULK
+    return NORMAL
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit adapted with AIMD: it grows by about one for every
+    limit requests completed within latency_target while the limit is
+    in use, and shrinks by backoff when a request is slower or fails, at
+    most once per latency_target. Requests beyond the limit wait in a
+    queue of queue_size for up to queue_timeout seconds, and get their
+    slot critical first, then normal, then bulk.
+    """
+
+    def __init__(
+        self,
+        initial: int = CONCURRENCY_INITIAL,
+        minimum: int = CONCURRENCY_MIN,
+        maximum: int = CONCURRENCY_MAX,
+        latency_target: float = CONCURRENCY_LATENCY_TARGET,
+        queue_size: int = CONCURRENCY_QUEUE_SIZE,
+        queue_timeout: float = CONCURRENCY_QUEUE_TIMEOUT,
+        backoff: float = 0.9,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.in_flight = {CRITICAL: 0, NORMAL: 0, BULK: 0}
+        self.queues = {CRITICAL: deque(), NORMAL: deque(), BULK: deque()}
+        self._decreased = 0.0
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _ahead(self, priority: str) -> int:
+        # Waiters of the same or a higher priority
+        ahead = 0
+        for level in (CRITICAL, NORMAL, BULK):
+            ahead += len(self.queues[level])
+            if level == priority:
+                return ahead
+
+    def _has_room(self, priority: str) -> bool:
+        if sum(self.in_flight.values()) >= int(self.limit):
+            return False
+        return (
+            priority != BULK
+            or self.in_flight[BULK] < max(1, int(self.limit * BULK_SHARE))
+        )
+
+    async def acquire(self, priority: str) -> None:
+        """
+        Take a slot, waiting in the queue when the limit is reached.
+        Raises Overloaded when the queue is full or the wait times out.
+        """
+        if not self._ahead(priority) and self._has_room(priority):
+            self.in_flight[priority] += 1
+            return
+        if self.queued() >= self.queue_size:
+            raise Overloaded
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues[priority].append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter in self.queues[priority]:
+                self.queues[priority].remove(waiter)
+            raise Overloaded
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over already, give it back
+                self._free(priority)
+            elif waiter in self.queues[priority]:
+                self.queues[priority].remove(waiter)
+            raise
+
+    def release(self, priority: str, latency: float, failed: bool) -> None:
+        if failed or latency > self.latency_target:
+            now = time.monotonic()
+            if now - self._decreased >= self.latency_target:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._decreased = now
+        elif sum(self.in_flight.values()) >= self.limit / 2:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._free(priority)
+
+    def _free(self, priority: str) -> None:
+        self.in_flight[priority] -= 1
+        # By priority, each waiter is handed a slot directly
+        for level in (CRITICAL, NORMAL, BULK):
+            queue = self.queues[level]
+            while queue and self._has_room(level):
+                waiter = queue.popleft()
+                if not waiter.done():
+                    self.in_flight[level] += 1
+                    waiter.set_result(None)
+
+
+limiter = AdaptiveLimiter()
+
+metrics.Gauge(
+    "concurrency_limit",
+    "Adaptive concurrency limit of this worker.",
+    function=lambda: limiter.limit,
+)
+metrics.Gauge(
+    "concurrency_in_flight",
+    "Requests holding a concurrency slot by priority.",
+    ("priority",),
+    function=lambda: {
+        (priority,): count for priority, count in limiter.in_flight.items()
+    },
+)
+metrics.Gauge(
+    "concurrency_queued",
+    "Requests waiting for a concurrency slot.",
+    function=lambda: limiter.queued(),
+)
+shed = metrics.Counter(
+    "requests_shed_total",
+    "Requests rejected with 503 because the worker is overloaded.",
+    ("priority",),
+)
+
+
+class LoadSheddingMiddleware:
+    """
+    Pure ASGI middleware admitting requests through an AdaptiveLimiter
+    and answering 503 with Retry-After when it is overloaded. Exempt
+    paths skip the limiter.
+    """
+
+    def __init__(self, app, limiter: AdaptiveLimiter = limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        level = classify(scope)
+        if level == EXEMPT:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.limiter.acquire(level)
+        except Overloaded:
+            shed.inc((level,))
+            body = json.dumps({"detail": "Server overloaded"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"1"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.limiter.release(
+                level, time.perf_counter() - start, status >= 500
+            )
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+import metrics
+from settings import LOOP_LAG_THRESHOLD, LOOP_STRICT
+
+
+logger = logging.getLogger(__name__)
+# Route label of stalls while no request was running on the loop
+IDLE = "none"
+STACK_DEPTH = 20
+
+loop_lag = metrics.Histogram(
+    "event_loop_lag_seconds",
+    "Delay of the event loop heartbeat past its schedule.",
+)
+loop_stalls = metrics.Counter(
+    "event_loop_stalls_total",
+    "Event loop stalls longer than the threshold by route template.",
+    ("route",),
+)
+loop_stall_duration = metrics.Histogram(
+    "event_loop_stall_seconds",
+    "Duration of event loop stalls by route template.",
+    ("route",),
+)
+
+
+def _route(scope) -> str:
+    if scope is None:
+        return IDLE
+    route = scope.get("route")
+    return getattr(route, "path", None) or metrics.UNMATCHED
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag with a heartbeat task. A monitor thread
+    notices when the heartbeat stops for longer than threshold, captures
+    the loop thread's stack and the request whose task was running, and
+    reports the stall as metrics and a log warning once the loop
+    resumes. In strict mode those requests fail with a 500.
+    """
+
+    def __init__(
+        self,
+        threshold: float = LOOP_LAG_THRESHOLD,
+        strict: bool = LOOP_STRICT,
+    ):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.strict = strict
+        self.running = False
+        self.requests = {}
+        self.blocking = set()
+        self._beat = time.perf_counter()
+        self._stop = threading.Event()
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._beat = time.perf_counter()
+        self._stop.clear()
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+        self.running = True
+
+    async def stop(self) -> None:
+        self.running = False
+        self._stop.set()
+        self._heartbeat.cancel()
+        await asyncio.to_thread(self._thread.join)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = time.perf_counter()
+            loop_lag.observe(max(0.0, self._beat - expected))
+
+    def _monitor(self) -> None:
+        stall = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if stall is not None and stall["beat"] != beat:
+                self._report(stall, beat - stall["beat"] - self.interval)
+                stall = None
+            if stall is None and time.perf_counter() - beat > self.threshold:
+                stall = self._capture(beat)
+
+    def _capture(self, beat: float) -> dict:
+        frame = sys._current_frames().get(self.loop_thread)
+        task = asyncio.current_task(self.loop)
+        scope = self.requests.get(task)
+        if scope is not None:
+            self.blocking.add(task)
+        return {
+            "beat": beat,
+            "route": _route(scope),
+            "path": scope["path"] if scope else None,
+            "stack": traceback.format_stack(frame)[-STACK_DEPTH:]
+            if frame
+            else [],
+        }
+
+    def _report(self, stall: dict, duration: float) -> None:
+        loop_stalls.inc((stall["route"],))
+        loop_stall_duration.observe(duration, (stall["route"],))
+        logger.warning(
+            "Event loop blocked for %.3fs by %s\n%s",
+            duration,
+            stall["path"] or IDLE,
+            "".join(stall["stack"]),
+        )
+
+
+class LoopMonitorMiddleware:
+    """
+    Pure ASGI middleware mapping each request's task to its scope for
+    stall attribution, and failing blocking requests in strict mode
+    """
+
+    def __init__(self, app, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.monitor.running:
+            await self.app(scope, receive, send)
+            return
+        monitor = self.monitor
+        task = asyncio.current_task()
+        failed = False
+
+        async def send_wrapper(message):
+            nonlocal failed
+            if failed:
+                return
+            if (
+                monitor.strict
+                and message["type"] == "http.response.start"
+                and task in monitor.blocking
+            ):
+                failed = True
+                body = json.dumps({
+                    "detail": "Request blocked the event loop for more "
+                    f"than {monitor.threshold}s"
+                }).encode()
+                await send({
+                    "type": "http.response.start",
+                    "status": 500,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                    ],
+                })
+                await send({"type": "http.response.body", "body": body})
+                return
+            await send(message)
+
+        monitor.requests[task] = scope
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            monitor.requests.pop(task, None)
+            monitor.blocking.discard(task)
@@ -2,6 +2,7 @@ from fastapi import FastAPI, status, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.openapi.utils import get_openapi
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from routes.user import router as user_router
 from routes.country import router as country_router
 from routes.currency import router as currency_router
@@ -9,10 +10,25 @@ from routes.bank import router as bank_router
 from routes.project import router as project_router
 from routes.account import router as account_router
 from routes.partner import router as partner_router
+from routes.search import router as search_router
+from routes.ledger import router as ledger_router
+from routes.transfer import router as transfer_router
+from routes.seed import router as seed_router
+from routes.memory import router as memory_router
 from contextlib import asynccontextmanager
+import metrics
+from loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from load_shedding import LoadSheddingMiddleware
+import deadlines
+import profiling
+from idempotency import IdempotencyMiddleware, responses
+from database import engine, replica_engines, shard_engines
+from ratelimit import rate_limit
+from replicas import ReadYourWritesMiddleware
 from populate.first_user import create_first_user
 from security import (
     Token,
+    token_cache,
     get_authenticated_user,
     create_user_access_token,
 )
@@ -29,14 +45,29 @@ origins = [
 
 
 
+loop_monitor = LoopMonitor()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_first_user()
+    await loop_monitor.start()
     yield
+    await loop_monitor.stop()
 
 
 app = FastAPI(lifespan=lifespan)
 
+metrics.instrument_engine(engine)
+metrics.instrument_cache("auth_token", token_cache)
+metrics.instrument_cache("idempotency", responses)
+profiling.instrument_engine(engine)
+deadlines.instrument_engine(engine)
+for replica_engine in [*replica_engines, *shard_engines.values()]:
+    metrics.count_queries(replica_engine)
+    profiling.instrument_engine(replica_engine)
+    deadlines.instrument_engine(replica_engine)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -44,6 +75,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(LoopMonitorMiddleware, monitor=loop_monitor)
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(deadlines.DeadlineMiddleware)
+app.add_middleware(LoadSheddingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(user_router)
 app.include_router(country_router)
@@ -52,6 +90,11 @@ app.include_router(bank_router)
 app.include_router(project_router)
 app.include_router(account_router)
 app.include_router(partner_router)
+app.include_router(search_router)
+app.include_router(ledger_router)
+app.include_router(transfer_router)
+app.include_router(seed_router)
+app.include_router(memory_router)
 
 
 @app.get("/ping")
@@ -59,7 +102,16 @@ def ping():
     return {"ping": "pong"}
 
 
-@app.post("/token", response_model=Token)
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post(
+    "/token",
+    response_model=Token,
+    dependencies=[Depends(rate_limit("token"))],
+)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
 ) -> Token:
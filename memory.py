@@ -0,0 +1,167 @@
+import gc
+import itertools
+import os
+import threading
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+from sqlmodel import Session, SQLModel
+
+
+# Snapshots kept in memory, the oldest are dropped first
+MAX_SNAPSHOTS = 10
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+_lock = threading.Lock()
+_snapshots = OrderedDict()
+_ids = itertools.count(1)
+
+
+def start_tracing(frames: int = 1) -> dict:
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+    return tracing_status()
+
+
+def stop_tracing() -> dict:
+    tracemalloc.stop()
+    return tracing_status()
+
+
+def tracing_status() -> dict:
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "frames": tracemalloc.get_traceback_limit(),
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+    }
+
+
+def _summary(snapshot_id: int, taken_at: datetime, snapshot) -> dict:
+    statistics = snapshot.statistics("filename")
+    return {
+        "id": snapshot_id,
+        "taken_at": taken_at,
+        "size": sum(stat.size for stat in statistics),
+        "count": sum(stat.count for stat in statistics),
+    }
+
+
+def take_snapshot() -> dict:
+    """
+    Snapshot the allocations traced so far. Raises RuntimeError when
+    tracemalloc is not running.
+    """
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not running")
+    snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    taken_at = datetime.now()
+    with _lock:
+        snapshot_id = next(_ids)
+        _snapshots[snapshot_id] = (taken_at, snapshot)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return _summary(snapshot_id, taken_at, snapshot)
+
+
+def list_snapshots() -> list[dict]:
+    with _lock:
+        snapshots = list(_snapshots.items())
+    return [
+        _summary(snapshot_id, taken_at, snapshot)
+        for snapshot_id, (taken_at, snapshot) in snapshots
+    ]
+
+
+def clear_snapshots() -> None:
+    with _lock:
+        _snapshots.clear()
+
+
+def _traceback(stat) -> list[str]:
+    return [
+        f"{frame.filename}:{frame.lineno}" for frame in stat.traceback
+    ]
+
+
+def top_allocations(
+    snapshot_id: int, group_by: str = "lineno", limit: int = 20
+) -> list[dict]:
+    """
+    Largest allocation sites of a snapshot. Raises KeyError for an
+    unknown snapshot.
+    """
+    with _lock:
+        snapshot = _snapshots[snapshot_id][1]
+    return [
+        {"size": stat.size, "count": stat.count, "site": _traceback(stat)}
+        for stat in snapshot.statistics(group_by)[:limit]
+    ]
+
+
+def compare_snapshots(
+    first_id: int, second_id: int, group_by: str = "lineno", limit: int = 20
+) -> list[dict]:
+    """
+    Allocation sites that grew the most from the first snapshot to the
+    second. Raises KeyError for an unknown snapshot.
+    """
+    with _lock:
+        first = _snapshots[first_id][1]
+        second = _snapshots[second_id][1]
+    return [
+        {
+            "size_diff": stat.size_diff,
+            "count_diff": stat.count_diff,
+            "size": stat.size,
+            "count": stat.count,
+            "site": _traceback(stat),
+        }
+        for stat in second.compare_to(first, group_by)[:limit]
+    ]
+
+
+def _rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def live_objects() -> dict:
+    """
+    Live instances of each table model and the identity map size of
+    every open session, found by walking the garbage collector
+    """
+    models = {mapper.class_ for mapper in SQLModel._sa_registry.mappers}
+    instances = {model.__name__: 0 for model in models}
+    sessions = []
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls in models:
+            instances[cls.__name__] += 1
+        elif isinstance(obj, Session):
+            sessions.append({
+                "identity_map": len(obj.identity_map),
+                "new": len(obj.new),
+                "dirty": len(obj.dirty),
+                "in_transaction": obj.in_transaction(),
+            })
+    sessions.sort(key=lambda session: -session["identity_map"])
+    return {
+        "rss_bytes": _rss_bytes(),
+        "gc_counts": gc.get_count(),
+        "instances": dict(sorted(instances.items())),
+        "sessions": sessions,
+    }
@@ -0,0 +1,282 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import Engine, event
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+# Route label of requests that did not match any route, so unknown
+# paths cannot grow the number of series
+UNMATCHED = "unmatched"
+
+REGISTRY = []
+# Queries issued while serving the current request
+_request_queries: ContextVar[list | None] = ContextVar(
+    "request_queries", default=None
+)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    Base of the collectors. A function returning {label values: value}
+    (or a single value without labels) is evaluated at render time
+    instead of storing values.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        function=None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def value(self, labels: tuple = ()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        if self.function is None:
+            with self._lock:
+                values = dict(self._values)
+        else:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in values.items():
+            yield self.name, _format_labels(self.labels, labels), value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per bucket counts, then the +Inf count and the sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {
+                labels: list(state) for labels, state in self._values.items()
+            }
+        names = self.labels + ("le",)
+        for labels, state in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state[:-1]):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(names, labels + (bound,)),
+                    cumulative,
+                )
+            label_text = _format_labels(self.labels, labels)
+            yield f"{self.name}_sum", label_text, state[-1]
+            yield f"{self.name}_count", label_text, cumulative
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+requests_total = Counter(
+    "http_requests_total",
+    "HTTP requests by route template and status code.",
+    ("method", "route", "status"),
+)
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template.",
+    ("method", "route"),
+)
+requests_in_flight = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being served.",
+)
+request_queries = Histogram(
+    "http_request_db_queries",
+    "Database queries issued per HTTP request by route template.",
+    ("method", "route"),
+    buckets=QUERY_BUCKETS,
+)
+db_queries_total = Counter(
+    "db_queries_total",
+    "Database statements executed.",
+)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request count, latency and queries
+    per route template (the path of the matched route, not the raw URL)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        queries = [0]
+        token = _request_queries.set(queries)
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            requests_in_flight.dec()
+            _request_queries.reset(token)
+            route = scope.get("route")
+            labels = (
+                scope["method"],
+                getattr(route, "path", None) or UNMATCHED,
+            )
+            requests_total.inc(labels + (status_code,))
+            request_duration.observe(elapsed, labels)
+            request_queries.observe(queries[0], labels)
+
+
+def _count_query(*args) -> None:
+    db_queries_total.inc()
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+def count_queries(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", _count_query)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Count the engine's statements and expose its connection pool usage
+    """
+    count_queries(engine)
+    pool = engine.pool
+
+    def pool_stat(method: str):
+        return lambda: getattr(pool, method)() if hasattr(pool, method) else 0
+
+    Gauge(
+        "db_pool_size",
+        "Connections kept open by the pool.",
+        function=pool_stat("size"),
+    )
+    Gauge(
+        "db_pool_checked_out",
+        "Pool connections currently in use.",
+        function=pool_stat("checkedout"),
+    )
+    Gauge(
+        "db_pool_overflow",
+        "Connections opened beyond the pool size.",
+        # QueuePool.overflow() is negative until the pool is full
+        function=lambda: max(0, pool_stat("overflow")()),
+    )
+
+
+def instrument_cache(name: str, cache) -> None:
+    """
+    Expose the hit and miss counts and size of a cache.TTLCache
+    """
+    Counter(
+        f"{name}_cache_hits_total",
+        f"Lookups served by the {name} cache.",
+        function=lambda: cache.hits,
+    )
+    Counter(
+        f"{name}_cache_misses_total",
+        f"Lookups missing the {name} cache.",
+        function=lambda: cache.misses,
+    )
+    Gauge(
+        f"{name}_cache_entries",
+        f"Entries in the {name} cache.",
+        function=lambda: len(cache),
+    )
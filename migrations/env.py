@@ -71,8 +71,12 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
+        # One transaction per migration, so revisions that build indexes
+        # CONCURRENTLY can leave it with op.get_context().autocommit_block()
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            transaction_per_migration=True,
         )
 
         with context.begin_transaction():
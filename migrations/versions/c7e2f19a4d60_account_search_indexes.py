@@ -0,0 +1,50 @@
+"""Account search indexes
+
+Revision ID: c7e2f19a4d60
+Revises: a4c1e7d2b9f3
+Create Date: 2026-10-19 11:40:27.905113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2f19a4d60'
+down_revision: Union[str, None] = 'a4c1e7d2b9f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_FIELDS = ('name', 'account_number', 'alias', 'description')
+
+
+def upgrade() -> None:
+    # Trigram and full-text indexes are Postgres only; other databases
+    # use the in-process index in search.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for field in SEARCH_FIELDS:
+        op.create_index(
+            f'ix_account_{field}_trgm',
+            'account',
+            [field],
+            postgresql_using='gin',
+            postgresql_ops={field: 'gin_trgm_ops'},
+        )
+    op.create_index(
+        'ix_account_description_fts',
+        'account',
+        [sa.text("to_tsvector('simple', coalesce(description, ''))")],
+        postgresql_using='gin',
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_account_description_fts', table_name='account')
+    for field in reversed(SEARCH_FIELDS):
+        op.drop_index(f'ix_account_{field}_trgm', table_name='account')
@@ -0,0 +1,46 @@
+"""Foreign key indexes
+
+Revision ID: e19b5a3c7f28
+Revises: c7e2f19a4d60
+Create Date: 2026-10-19 14:05:53.672390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e19b5a3c7f28'
+down_revision: Union[str, None] = 'c7e2f19a4d60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns); account.project_id is covered by the
+# leading column of ix_account_project_id_id
+INDEXES = [
+    ('ix_account_project_id_id', 'account', ['project_id', 'id']),
+    ('ix_account_bank_id', 'account', ['bank_id']),
+    ('ix_account_currency_id', 'account', ['currency_id']),
+    ('ix_account_country_id', 'account', ['country_id']),
+    ('ix_partner_account_id', 'partner', ['account_id']),
+    ('ix_project_owner_id', 'project', ['owner_id']),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name, table, columns, unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(
+                name, table_name=table, postgresql_concurrently=True
+            )
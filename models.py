@@ -1,7 +1,8 @@
 from typing import Optional, Annotated
-from datetime import datetime
+from datetime import date, datetime
 
 from decimal import Decimal
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field, Relationship
 
 
@@ -40,6 +41,8 @@ class UserBase(SQLModel):
 
 class User(UserBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
+    # Incremented by every update, exposed as the ETag
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
     password: Optional[str] = Field(default=None)
     token: Optional[str] = Field(default=None)
     is_active: bool = Field(default=True)
@@ -74,9 +77,11 @@ class ProjectBase(SQLModel):
 
 class Project(ProjectBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
+    # Incremented by every update, exposed as the ETag
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
     creation_date: datetime = Field(default=datetime.now())
     tree: Optional[str] = Field(default="")
-    owner_id: int = Field(default=None, foreign_key="user.id")
+    owner_id: int = Field(default=None, foreign_key="user.id", index=True)
     owner: User = Relationship(back_populates="projects")
     accounts: Optional[list["Account"]] = Relationship(
         back_populates="project"
@@ -100,7 +105,11 @@ class PartnerCreate(PartnerBase):
 
 class Partner(PartnerBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    account_id: int = Field(default=None, foreign_key="account.id")
+    # Incremented by every update, exposed as the ETag
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
+    account_id: int = Field(
+        default=None, foreign_key="account.id", index=True
+    )
     account: "Account" = Relationship(back_populates="partners")
 
 
@@ -125,13 +134,145 @@ class AccountCreate(AccountBase):
 
 
 class Account(AccountBase, table=True):
+    # (project_id, id) also serves every lookup by project_id alone
+    __table_args__ = (
+        Index("ix_account_project_id_id", "project_id", "id"),
+    )
     id: int | None = Field(default=None, primary_key=True)
+    # Incremented by every update, exposed as the ETag
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
     project_id: int = Field(foreign_key="project.id")
     project: Project = Relationship(back_populates="accounts")
-    bank_id: int = Field(foreign_key="bank.id")
+    bank_id: int = Field(foreign_key="bank.id", index=True)
     bank: Bank = Relationship()
-    currency_id: int = Field(foreign_key="currency.id")
+    currency_id: int = Field(foreign_key="currency.id", index=True)
     currency: Currency = Relationship()
-    country_id: int = Field(foreign_key="country.id")
+    country_id: int = Field(foreign_key="country.id", index=True)
     country: Country = Relationship()
     partners: Optional[list["Partner"]] = Relationship(back_populates="account")
+
+
+class ProjectSummary(SQLModel, table=True):
+    __tablename__ = "project_summary"
+    project_id: int = Field(foreign_key="project.id", primary_key=True)
+    account_count: int = Field(default=0)
+    partner_count: int = Field(default=0)
+    updated_at: datetime | None = Field(default=None)
+
+
+class ProjectCurrencyTotal(SQLModel, table=True):
+    __tablename__ = "project_currency_total"
+    project_id: int = Field(foreign_key="project.id", primary_key=True)
+    currency_id: int = Field(foreign_key="currency.id", primary_key=True)
+    account_count: int = Field(default=0)
+    amount: Annotated[Decimal, Field(
+                                default=0,
+                                max_digits=14,
+                                decimal_places=2
+                          )]
+
+
+class ProjectSummaryRead(SQLModel):
+    project_id: int
+    account_count: int = 0
+    partner_count: int = 0
+    updated_at: datetime | None = None
+    totals: list[ProjectCurrencyTotal] = []
+
+
+class LedgerEntry(SQLModel, table=True):
+    __tablename__ = "ledger_entry"
+    __table_args__ = (
+        Index(
+            "ix_ledger_entry_account_id_posted_at",
+            "account_id",
+            "posted_at",
+        ),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    account_id: int = Field(foreign_key="account.id")
+    project_id: int = Field(foreign_key="project.id", index=True)
+    amount: Annotated[Decimal, Field(
+                                default=0,
+                                max_digits=12,
+                                decimal_places=2
+                          )]
+    posted_at: datetime = Field(default_factory=datetime.now)
+    description: Optional[str] = Field(default=None)
+
+
+class BalanceSnapshot(SQLModel, table=True):
+    __tablename__ = "balance_snapshot"
+    __table_args__ = (
+        Index(
+            "ix_balance_snapshot_account_id_posted_at",
+            "account_id",
+            "posted_at",
+        ),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    account_id: int = Field(foreign_key="account.id")
+    entry_id: int = Field(foreign_key="ledger_entry.id")
+    posted_at: datetime
+    balance: Annotated[Decimal, Field(
+                                default=0,
+                                max_digits=14,
+                                decimal_places=2
+                          )]
+
+
+class AccountBalance(SQLModel):
+    account_id: int
+    at: datetime
+    balance: Decimal
+
+
+class BalancePoint(SQLModel):
+    period: date
+    currency_id: int
+    balance: Decimal
+
+
+class Transfer(SQLModel):
+    source_account_id: int
+    target_account_id: int
+    amount: Decimal = Field(gt=0, max_digits=12, decimal_places=2)
+    description: Optional[str] = Field(default=None)
+
+
+class TransferBatch(SQLModel):
+    transfers: list[Transfer]
+
+
+class IdTicket(SQLModel, table=True):
+    """
+    Next free id per table, allocated in blocks when sharding is enabled
+    """
+    __tablename__ = "id_ticket"
+    name: str = Field(primary_key=True)
+    next_id: int = Field(default=1)
+
+
+class ProjectShard(SQLModel, table=True):
+    """
+    Shard holding each project when sharding is enabled
+    """
+    __tablename__ = "project_shard"
+    project_id: int = Field(primary_key=True, sa_column_kwargs={
+        "autoincrement": False
+    })
+    shard: str = Field(index=True)
+    moving: bool = Field(default=False)
+
+
+class RateLimitBucket(SQLModel, table=True):
+    """
+    Token bucket of a rate limit key, for the database rate limit backend
+    """
+    __tablename__ = "rate_limit_bucket"
+    key: str = Field(primary_key=True)
+    tokens: float
+    # Epoch seconds of the last refill
+    updated: float
+    # Whether the last request took a token
+    allowed: bool = Field(default=True)
@@ -0,0 +1,99 @@
+from sqlalchemy import Engine, update
+from sqlmodel import Session, SQLModel, select
+from models import Country, Currency
+from database import dialect_insert, engine as default_engine
+from .countries_data import COUNTRIES
+from .currencies_data import CURRENCIES
+
+
+# Reference datasets keyed by name: (model, {code: name})
+DATASETS: dict[str, tuple[type[SQLModel], dict[str, str]]] = {
+    "countries": (Country, COUNTRIES),
+    "currencies": (Currency, CURRENCIES),
+}
+
+
+def register_dataset(
+    name: str, model: type[SQLModel], data: dict[str, str]
+) -> None:
+    """
+    Register a {code: name} dataset for a model with unique code and
+    name columns
+    """
+    DATASETS[name] = (model, data)
+
+
+def seed_dataset(name: str, engine: Engine | None = None) -> dict:
+    """
+    Upsert a reference dataset by code. Rows are diffed against the
+    table first and only missing or renamed ones are written, in one
+    multi-row INSERT ... ON CONFLICT (code) DO UPDATE statement. Names
+    are unique too: a row holding a dataset name without a code gets the
+    code, and entries whose name another row holds under a different
+    code are skipped.
+    """
+    model, data = DATASETS[name]
+    with Session(engine or default_engine) as session:
+        rows = session.exec(select(model.id, model.code, model.name)).all()
+        by_code = {code: value for _, code, value in rows if code is not None}
+        by_name = {value: (id, code) for id, code, value in rows}
+        changes = []
+        claimed = {}
+        skipped = []
+        for code, value in data.items():
+            if by_code.get(code) == value:
+                continue
+            holder = by_name.get(value)
+            if holder is None:
+                changes.append(code)
+            elif holder[1] is None and code not in by_code:
+                claimed[holder[0]] = code
+            else:
+                skipped.append(code)
+        inserted = [code for code in changes if code not in by_code]
+        if changes:
+            statement = dialect_insert(session, model).values(
+                [{"code": code, "name": data[code]} for code in changes]
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[model.code],
+                set_={"name": statement.excluded.name},
+            )
+            session.execute(statement)
+        for id, code in claimed.items():
+            session.execute(
+                update(model).where(model.id == id).values(code=code)
+            )
+        if changes or claimed:
+            session.commit()
+    return {
+        "dataset": name,
+        "inserted": len(inserted),
+        "updated": len(changes) - len(inserted) + len(claimed),
+        "unchanged": len(data) - len(changes) - len(claimed) - len(skipped),
+        "skipped": sorted(skipped),
+    }
+
+
+def seed_datasets(
+    names: list[str] | None = None, engine: Engine | None = None
+) -> list[dict]:
+    return [seed_dataset(name, engine) for name in names or DATASETS]
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Seed reference datasets")
+    parser.add_argument(
+        "datasets",
+        nargs="*",
+        help=f"datasets to seed ({', '.join(DATASETS)}), all by default",
+    )
+    args = parser.parse_args()
+    unknown = set(args.datasets) - set(DATASETS)
+    if unknown:
+        parser.error(f"unknown datasets: {', '.join(sorted(unknown))}")
+    for result in seed_datasets(args.datasets):
+        print(json.dumps(result))
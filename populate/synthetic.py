@@ -0,0 +1,283 @@
+import csv
+import io
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import Engine, Table, create_engine, func, select, text
+from sqlmodel import Session, SQLModel
+from models import (Account, Bank, Country, Currency, LedgerEntry, Partner,
+                    Project, User)
+from security import get_password_hash
+from summary import rebuild_summaries
+from .seed import seed_datasets
+
+
+# Fixed origin so the generated dates only depend on the seed
+EPOCH = datetime(2020, 1, 1)
+BANKS = 20
+
+
+def _skewed(rng: random.Random, mean: float, alpha: float) -> int:
+    """
+    Pareto distributed count with the given mean: most values are
+    small, a few are very large.
+    """
+    if mean <= 0:
+        return 0
+    scale = mean * (alpha - 1) / alpha
+    return int(scale * rng.paretovariate(alpha))
+
+
+def _next_id(connection, table: Table) -> int:
+    return (connection.scalar(select(func.max(table.c.id))) or 0) + 1
+
+
+def _copy(connection, table: Table, columns: list[str], rows: list[tuple]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f'COPY "{table.name}" ({", ".join(columns)}) '
+        "FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer,
+    )
+    cursor.close()
+
+
+class BulkLoader:
+    """
+    Buffers rows per table and writes them with COPY on Postgres or
+    batched executemany INSERTs elsewhere
+    """
+
+    def __init__(self, connection, batch_size: int):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.postgres = connection.dialect.name == "postgresql"
+        self.buffers = {}
+        self.counts = {}
+
+    def add(self, model: type[SQLModel], row: dict):
+        table = model.__table__
+        buffer = self.buffers.setdefault(table.name, (table, []))[1]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Tables are flushed in the order they were first added to, so
+        # parent rows reach the database before the rows pointing to them
+        for table, rows in self.buffers.values():
+            if not rows:
+                continue
+            if self.postgres:
+                columns = list(rows[0])
+                _copy(
+                    self.connection,
+                    table,
+                    columns,
+                    [tuple(row[column] for column in columns) for row in rows],
+                )
+            else:
+                self.connection.execute(table.insert(), rows)
+            self.counts[table.name] = self.counts.get(table.name, 0) + len(
+                rows
+            )
+            rows.clear()
+
+
+def _reference_ids(engine: Engine) -> tuple[list[int], list[int], list[int]]:
+    seed_datasets(engine=engine)
+    with engine.begin() as connection:
+        bank = Bank.__table__
+        existing = connection.scalar(select(func.count()).select_from(bank))
+        if existing < BANKS:
+            start = _next_id(connection, bank)
+            connection.execute(
+                bank.insert(),
+                [
+                    {
+                        "id": start + i,
+                        "name": f"Synthetic Bank {start + i}",
+                        "code": f"SYN{start + i}",
+                    }
+                    for i in range(BANKS - existing)
+                ],
+            )
+        return tuple(
+            list(connection.scalars(select(model.__table__.c.id)))
+            for model in (Bank, Currency, Country)
+        )
+
+
+def _reset_sequences(connection):
+    if connection.dialect.name != "postgresql":
+        return
+    for model in (User, Project, Account, Partner, LedgerEntry, Bank):
+        table = model.__table__.name
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f"(SELECT coalesce(max(id), 1) FROM \"{table}\"))"
+        ))
+
+
+def generate(
+    engine: Engine,
+    users: int = 100,
+    projects_per_user: float = 3,
+    accounts_per_project: float = 20,
+    partners_per_account: float = 1,
+    skew: float = 1.5,
+    seed: int = 0,
+    batch_size: int = 10000,
+    password: str = "synthetic",
+) -> dict:
+    """
+    Generate users, projects, accounts (with opening ledger entries)
+    and partners. Counts per parent follow a Pareto distribution with
+    the given means and shape (skew, lower is more skewed). The same
+    seed always produces the same rows, except for the password hash.
+    """
+    rng = random.Random(seed)
+    banks, currencies, countries = _reference_ids(engine)
+    password_hash = get_password_hash(password)
+    started = time.perf_counter()
+
+    with engine.begin() as connection:
+        loader = BulkLoader(connection, batch_size)
+        user_id = _next_id(connection, User.__table__)
+        project_id = _next_id(connection, Project.__table__)
+        account_id = _next_id(connection, Account.__table__)
+        partner_id = _next_id(connection, Partner.__table__)
+        entry_id = _next_id(connection, LedgerEntry.__table__)
+        tag = f"s{seed}"
+
+        for _ in range(users):
+            loader.add(User, {
+                "id": user_id,
+                "username": f"{tag}-user-{user_id}",
+                "name": f"Synthetic User {user_id}",
+                "email": f"{tag}-user-{user_id}@example.com",
+                "password": password_hash,
+                "token": None,
+                "is_active": True,
+                "is_superuser": False,
+            })
+            for _ in range(_skewed(rng, projects_per_user, skew)):
+                created = EPOCH + timedelta(minutes=rng.randrange(2_000_000))
+                loader.add(Project, {
+                    "id": project_id,
+                    "name": f"{tag}-project-{project_id}",
+                    "description": None,
+                    "creation_date": created,
+                    "tree": "",
+                    "owner_id": user_id,
+                })
+                for _ in range(_skewed(rng, accounts_per_project, skew)):
+                    amount = Decimal(
+                        round(rng.lognormvariate(8, 2), 2)
+                    ).quantize(Decimal("0.01"))
+                    amount = min(amount, Decimal("9999999999.99"))
+                    opened = created + timedelta(
+                        minutes=rng.randrange(500_000)
+                    )
+                    loader.add(Account, {
+                        "id": account_id,
+                        "name": f"{tag}-account-{account_id}",
+                        "description": rng.choice(
+                            [None, "Operating", "Savings", "Payroll"]
+                        ),
+                        "initial_date": opened,
+                        "account_number": f"{tag}-{account_id:012d}",
+                        "alias": f"acc{account_id}",
+                        "amount": amount,
+                        "project_id": project_id,
+                        "bank_id": rng.choice(banks),
+                        "currency_id": rng.choice(currencies),
+                        "country_id": rng.choice(countries),
+                    })
+                    if amount:
+                        loader.add(LedgerEntry, {
+                            "id": entry_id,
+                            "account_id": account_id,
+                            "project_id": project_id,
+                            "amount": amount,
+                            "posted_at": opened,
+                            "description": "Opening balance",
+                        })
+                        entry_id += 1
+                    partners = min(
+                        _skewed(rng, partners_per_account, skew), 10
+                    )
+                    for _ in range(partners):
+                        loader.add(Partner, {
+                            "id": partner_id,
+                            "name": f"{tag}-partner-{partner_id}",
+                            "description": None,
+                            "percentage": Decimal(rng.randrange(1, 5000))
+                            / 100,
+                            "account_id": account_id,
+                        })
+                        partner_id += 1
+                    account_id += 1
+                project_id += 1
+            user_id += 1
+        loader.flush()
+        _reset_sequences(connection)
+
+    elapsed = time.perf_counter() - started
+    with Session(engine) as session:
+        rebuild_summaries(session)
+    rows = sum(loader.counts.values())
+    return {
+        "seed": seed,
+        "rows": loader.counts,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": int(rows / elapsed) if elapsed else rows,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from settings import DATABASE_URL
+
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset for load testing"
+    )
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument(
+        "--create-schema",
+        action="store_true",
+        help="create missing tables first (for local SQLite files)",
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--projects-per-user", type=float, default=3)
+    parser.add_argument("--accounts-per-project", type=float, default=20)
+    parser.add_argument("--partners-per-account", type=float, default=1)
+    parser.add_argument("--skew", type=float, default=1.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--password", default="synthetic")
+    args = parser.parse_args()
+    if args.skew <= 1:
+        parser.error("--skew must be greater than 1")
+
+    engine = create_engine(args.database_url)
+    if args.create_schema:
+        SQLModel.metadata.create_all(engine)
+    print(json.dumps(generate(
+        engine,
+        users=args.users,
+        projects_per_user=args.projects_per_user,
+        accounts_per_project=args.accounts_per_project,
+        partners_per_account=args.partners_per_account,
+        skew=args.skew,
+        seed=args.seed,
+        batch_size=args.batch_size,
+        password=args.password,
+    )))
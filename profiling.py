@@ -0,0 +1,327 @@
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from urllib.parse import parse_qs
+from anyio import to_thread
+from jose import JWTError
+from sqlalchemy import Engine, event
+from security import decode_token, get_user
+from settings import (
+    PROFILE_DIR,
+    PROFILE_INTERVAL,
+    PROFILE_RETENTION,
+    PROFILE_SAMPLE_RATE,
+)
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+# Call tree nodes with a smaller share of the samples are dropped
+MIN_FRACTION = 0.005
+
+# Statements issued while profiling the current request
+_statements: ContextVar[list | None] = ContextVar(
+    "profile_statements", default=None
+)
+# Sampler of the current request
+_sampler: ContextVar["Sampler | None"] = ContextVar(
+    "profile_sampler", default=None
+)
+
+
+def _is_app_file(filename: str) -> bool:
+    return filename.startswith(ROOT) and "site-packages" not in filename
+
+
+def _describe(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(ROOT):
+        filename = filename[len(ROOT):]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """
+    Samples the stacks of the threads handling a request at a fixed
+    interval: the event loop thread that started it and the threadpool
+    workers that ran a statement in the request's context. Only stacks
+    running application code are kept, from the outermost application
+    frame down. Requests running on the event loop at the same time
+    show up in its samples, concurrency() tells how many there were.
+    """
+
+    def __init__(
+        self, interval: float = PROFILE_INTERVAL, concurrency=lambda: 1
+    ):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.threads = {threading.get_ident()}
+        self.samples = {}
+        self.count = 0
+        self.peak = concurrency()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.count += 1
+            self.peak = max(self.peak, self.concurrency())
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                stack = []
+                outermost = None
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    if _is_app_file(frame.f_code.co_filename):
+                        outermost = len(stack)
+                    frame = frame.f_back
+                if outermost is None:
+                    continue
+                key = tuple(reversed(stack[:outermost]))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def tree(self) -> list[dict]:
+        root = {"children": {}}
+        for stack, count in self.samples.items():
+            node = root
+            for code in stack:
+                node = node["children"].setdefault(
+                    code, {"samples": 0, "children": {}}
+                )
+                node["samples"] += count
+        total = sum(self.samples.values())
+        return _nodes(root["children"], max(1, total * MIN_FRACTION))
+
+
+def _nodes(children: dict, minimum: float) -> list[dict]:
+    nodes = []
+    for code, node in children.items():
+        if node["samples"] < minimum:
+            continue
+        nodes.append({
+            "function": _describe(code),
+            "samples": node["samples"],
+            "children": _nodes(node["children"], minimum),
+        })
+    nodes.sort(key=lambda node: -node["samples"])
+    return nodes
+
+
+def _caller() -> str | None:
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if _is_app_file(filename) and filename != __file__:
+            return f"{_describe(frame.f_code)} line {frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+def _before_execute(conn, cursor, statement, parameters, context, many):
+    sampler = _sampler.get()
+    if sampler is not None:
+        sampler.threads.add(threading.get_ident())
+    if _statements.get() is not None:
+        conn.info.setdefault("profile_started", []).append(
+            time.perf_counter()
+        )
+
+
+def _after_execute(conn, cursor, statement, parameters, context, many):
+    statements = _statements.get()
+    started = conn.info.get("profile_started")
+    if statements is None or not started:
+        return
+    statements.append({
+        "statement": statement,
+        "executemany": many,
+        "duration_ms": round((time.perf_counter() - started.pop()) * 1000, 3),
+        "caller": _caller(),
+    })
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Capture the statements issued while profiling a request
+    """
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+
+
+def _header(scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def requested(scope) -> bool:
+    """
+    Profiling asked for with an X-Profile header or ?profile=1
+    """
+    if _header(scope, b"x-profile") not in (None, "", "0"):
+        return True
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return query.get("profile", ["0"])[-1] not in ("", "0")
+
+
+def is_superuser(scope) -> bool:
+    authorization = _header(scope, b"authorization") or ""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        payload = decode_token(token)
+    except JWTError:
+        return False
+    if "superuser" not in payload.get("scopes", []):
+        return False
+    user = get_user(payload.get("sub"))
+    return bool(user and user.is_active and user.is_superuser)
+
+
+def _report(scope, sampler: Sampler, statements: list, status) -> dict:
+    route = scope.get("route")
+    return {
+        "method": scope["method"],
+        "path": scope["path"],
+        "route": getattr(route, "path", None),
+        "status_code": status,
+        "duration_ms": round(sampler.elapsed * 1000, 3),
+        "interval_ms": sampler.interval * 1000,
+        "samples": sampler.count,
+        "concurrent_requests": sampler.peak - 1,
+        "sql": statements,
+        "sql_ms": round(sum(item["duration_ms"] for item in statements), 3),
+        "tree": sampler.tree(),
+    }
+
+
+def save(report: dict, directory: str = PROFILE_DIR) -> str:
+    """
+    Write a report to the profile directory, keeping only the newest
+    PROFILE_RETENTION files
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", report["route"] or report["path"])
+    filename = os.path.join(
+        directory,
+        f"{datetime.now():%Y%m%dT%H%M%S%f}-{report['method']}{name}.json",
+    )
+    with open(filename, "w") as profile_file:
+        json.dump(report, profile_file)
+    profiles = sorted(
+        entry for entry in os.listdir(directory) if entry.endswith(".json")
+    )
+    for entry in profiles[:-PROFILE_RETENTION]:
+        try:
+            os.remove(os.path.join(directory, entry))
+        except FileNotFoundError:
+            pass
+    return filename
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests of superusers asking for it (X-Profile header or
+    ?profile=1), returning the report instead of the response body, and
+    1 in PROFILE_SAMPLE_RATE requests (0 disables) saved to directory
+    """
+
+    def __init__(
+        self,
+        app,
+        sample_rate: int = PROFILE_SAMPLE_RATE,
+        directory: str = PROFILE_DIR,
+    ):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.in_flight = 0
+        self._requests = itertools.count(1)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        self.in_flight += 1
+        try:
+            await self._handle(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    async def _handle(self, scope, receive, send):
+        on_demand = requested(scope) and await to_thread.run_sync(
+            is_superuser, scope
+        )
+        sampled = (
+            not on_demand
+            and self.sample_rate > 0
+            and next(self._requests) % self.sample_rate == 0
+        )
+        if not (on_demand or sampled):
+            await self.app(scope, receive, send)
+            return
+
+        messages = []
+        status_code = 500
+
+        async def capture(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            if on_demand:
+                messages.append(message)
+            else:
+                await send(message)
+
+        statements = []
+        sampler = Sampler(concurrency=lambda: self.in_flight)
+        tokens = _statements.set(statements), _sampler.set(sampler)
+        sampler.start()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            sampler.stop()
+            _statements.reset(tokens[0])
+            _sampler.reset(tokens[1])
+        report = _report(scope, sampler, statements, status_code)
+        if sampled:
+            await to_thread.run_sync(save, report, self.directory)
+            return
+
+        body = b"".join(
+            message.get("body", b"")
+            for message in messages
+            if message["type"] == "http.response.body"
+        )
+        try:
+            report["response"] = json.loads(body) if body else None
+        except ValueError:
+            report["response"] = body.decode("utf-8", "replace")
+        content = json.dumps(report).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(content)).encode()),
+                (b"x-profile-samples", str(sampler.count).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from settings import QUERY_CACHE_MAX_ROWS, QUERY_CACHE_TTL
+import cache
+import metrics
+
+
+# Session.info key of the tables written by the session's transaction
+WRITES = "query_cache_writes"
+
+lookups = metrics.Counter(
+    "query_cache_lookups_total",
+    "Query cache lookups by table read and outcome (hit or miss).",
+    ("table", "outcome"),
+)
+evictions = metrics.Counter(
+    "query_cache_evictions_total",
+    "Query cache entries evicted to stay within QUERY_CACHE_MAX_ROWS.",
+)
+
+# Channel message of a commit that wrote a table
+TABLE_MESSAGE = "table:"
+# Version of every entry, bumped when invalidations were lost
+EVERY_TABLE = "*"
+
+# Commits that wrote each table, entries remember the versions they read
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def _bump(tables) -> None:
+    with _versions_lock:
+        for table in tables:
+            _versions[table] = _versions.get(table, 0) + 1
+
+
+def _receive() -> None:
+    # Commits of the other workers sharing the cache backend
+    messages = cache.channel.receive()
+    if messages is None:
+        _bump([EVERY_TABLE])
+        return
+    _bump(
+        message[len(TABLE_MESSAGE):]
+        for message in messages
+        if message.startswith(TABLE_MESSAGE)
+    )
+
+
+def table_versions(tables) -> dict[str, int]:
+    _receive()
+    with _versions_lock:
+        return {
+            table: _versions.get(table, 0) for table in (*tables, EVERY_TABLE)
+        }
+
+
+def invalidate(tables) -> None:
+    """
+    Make the entries reading any of tables stale, in every worker
+    sharing the cache backend
+    """
+    tables = set(tables)
+    _bump(tables)
+    for table in tables:
+        cache.channel.publish(TABLE_MESSAGE + table)
+
+
+def _written(session) -> set:
+    return session.info.setdefault(WRITES, set())
+
+
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context) -> None:
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        _written(session).update(
+            table.name for table in inspect(instance).mapper.tables
+        )
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _do_orm_execute(orm_execute_state) -> None:
+    # insert(), update() and delete() statements bypass the flush
+    if (
+        orm_execute_state.is_insert
+        or orm_execute_state.is_update
+        or orm_execute_state.is_delete
+    ):
+        _written(orm_execute_state.session).add(
+            orm_execute_state.statement.table.name
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session) -> None:
+    invalidate(session.info.pop(WRITES, ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session) -> None:
+    session.info.pop(WRITES, None)
+
+
+class QueryCache:
+    """
+    Results of read statements keyed by their SQL, parameters, scope
+    and database. An entry is a miss once a commit wrote a table it
+    read or after ttl seconds; the least recently used entries go
+    beyond max_rows cached rows. Cached rows are detached instances
+    shared by the requests hitting the entry, so they must not be
+    modified.
+    """
+
+    def __init__(
+        self,
+        max_rows: int = QUERY_CACHE_MAX_ROWS,
+        ttl: float = QUERY_CACHE_TTL,
+    ):
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _drop(self, key) -> None:
+        rows, _, _ = self._entries.pop(key)
+        self.rows -= len(rows)
+
+    def fetch(
+        self, session: Session, statement, scope=None, load=None
+    ) -> list:
+        """
+        Rows of statement, cached per scope (the user whose permissions
+        shaped it, if any). load runs the statement on a miss, by
+        default session.exec(statement).all(). Sessions that wrote a
+        table the statement reads skip the cache until they commit.
+        """
+        if load is None:
+            def load():
+                return session.exec(statement).all()
+        tables = sorted({table.name for table in find_tables(statement)})
+        if session.autoflush:
+            # As running the statement would, so pending writes count
+            session.flush()
+        if self.ttl <= 0 or _written(session).intersection(tables):
+            return list(load())
+        bind = session.get_bind()
+        compiled = statement.compile(dialect=bind.dialect)
+        key = (
+            str(compiled),
+            repr(sorted(compiled.params.items())),
+            scope,
+            getattr(session.bind, "engine", session.bind),
+            getattr(session, "shard", None),
+        )
+        now = time.monotonic()
+        # Read before loading, a commit racing the load makes the new
+        # entry stale right away
+        versions = table_versions(tables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                rows, read, expires = entry
+                if expires > now and read == versions:
+                    self._entries.move_to_end(key)
+                else:
+                    self._drop(key)
+                    entry = None
+        for table in tables:
+            lookups.inc((table, "miss" if entry is None else "hit"))
+        if entry is not None:
+            return list(rows)
+        rows = list(load())
+        if len(rows) > self.max_rows:
+            return rows
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (rows, versions, now + self.ttl)
+            self.rows += len(rows)
+            while self.rows > self.max_rows:
+                self._drop(next(iter(self._entries)))
+                evictions.inc()
+        return list(rows)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.rows = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+query_cache = QueryCache()
+
+metrics.Gauge(
+    "query_cache_entries",
+    "Entries in the query cache.",
+    function=lambda: len(query_cache),
+)
+metrics.Gauge(
+    "query_cache_rows",
+    "Rows held by the query cache entries.",
+    function=lambda: query_cache.rows,
+)
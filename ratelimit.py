@@ -0,0 +1,199 @@
+import importlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request, Response
+from sqlalchemy import case, func
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+from database import dialect_insert, engine
+from models import RateLimitBucket
+from security import token_subject
+from settings import RATE_LIMIT_BACKEND, RATE_LIMITS
+import metrics
+
+
+# Limit of scopes without one of their own
+DEFAULT = "default"
+
+limited = metrics.Counter(
+    "rate_limited_requests_total",
+    "Requests rejected by the rate limiter by scope.",
+    ("scope",),
+)
+
+
+class Limit:
+    """
+    Token bucket holding up to requests tokens, refilled at requests
+    per seconds
+    """
+
+    def __init__(self, requests: int, seconds: float):
+        self.capacity = requests
+        self.seconds = seconds
+        self.rate = requests / seconds
+
+    def policy(self) -> str:
+        return f"{self.capacity};w={self.seconds:g}"
+
+
+def parse_limits(value: str) -> dict[str, Limit]:
+    """
+    Limits from "scope=requests/seconds,..." such as
+    "default=600/60,search=60/60"
+    """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        scope, _, rate = item.partition("=")
+        requests, _, seconds = rate.partition("/")
+        limits[scope.strip()] = Limit(int(requests), float(seconds or 1))
+    return limits
+
+
+class MemoryBackend:
+    """
+    Buckets in process memory, so each worker enforces its own limits.
+    The least recently used buckets beyond maxsize are dropped, which
+    refills them.
+    """
+    blocking = False
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key: str, limit: Limit) -> tuple[bool, float]:
+        """
+        Take a token from the bucket of key. Returns whether there was
+        one and the tokens left.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (limit.capacity, now))
+            tokens = min(
+                limit.capacity, tokens + (now - updated) * limit.rate
+            )
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+
+class DatabaseBackend:
+    """
+    Buckets in the rate_limit_bucket table, shared by every worker.
+    Each check is one INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
+    """
+    blocking = True
+
+    def __init__(self, bind=engine):
+        self.bind = bind
+
+    def take(self, key: str, limit: Limit) -> tuple[bool, float]:
+        table = RateLimitBucket.__table__
+        now = time.time()
+        least = func.min if self.bind.dialect.name == "sqlite" else func.least
+        refilled = least(
+            limit.capacity,
+            table.c.tokens + (now - table.c.updated) * limit.rate,
+        )
+        with Session(self.bind) as session:
+            statement = dialect_insert(session, RateLimitBucket).values(
+                key=key, tokens=limit.capacity - 1, updated=now, allowed=True
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.key],
+                set_={
+                    "tokens": case(
+                        (refilled >= 1, refilled - 1), else_=refilled
+                    ),
+                    "updated": now,
+                    "allowed": refilled >= 1,
+                },
+            ).returning(table.c.allowed, table.c.tokens)
+            allowed, tokens = session.execute(statement).one()
+            session.commit()
+        return allowed, tokens
+
+
+BACKENDS = {"memory": MemoryBackend, "database": DatabaseBackend}
+
+
+def load_backend(name: str):
+    """
+    Backend by name, or "module:Class" of a custom backend with the
+    take method and blocking attribute of the built-in ones
+    """
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    module, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module), attribute)()
+
+
+class RateLimiter:
+    def __init__(self, limits: dict[str, Limit], backend):
+        self.limits = limits
+        self.backend = backend
+
+    async def check(self, scope: str, key: str, response: Response) -> None:
+        """
+        Take a token for key in scope and set the RateLimit headers.
+        Raises a 429 when the bucket is empty.
+        """
+        limit = self.limits.get(scope) or self.limits.get(DEFAULT)
+        if limit is None:
+            return
+        bucket = f"{scope}:{key}"
+        if self.backend.blocking:
+            allowed, tokens = await run_in_threadpool(
+                self.backend.take, bucket, limit
+            )
+        else:
+            allowed, tokens = self.backend.take(bucket, limit)
+        headers = {
+            "RateLimit-Limit": str(limit.capacity),
+            "RateLimit-Remaining": str(math.floor(tokens)),
+            "RateLimit-Reset": str(
+                math.ceil((limit.capacity - tokens) / limit.rate)
+            ),
+            "RateLimit-Policy": limit.policy(),
+        }
+        if not allowed:
+            limited.inc((scope,))
+            headers["Retry-After"] = str(
+                math.ceil((1 - tokens) / limit.rate)
+            )
+            raise HTTPException(
+                status_code=429, detail="Too many requests", headers=headers
+            )
+        response.headers.update(headers)
+
+
+limiter = RateLimiter(
+    parse_limits(RATE_LIMITS), load_backend(RATE_LIMIT_BACKEND)
+)
+
+
+def rate_limit(scope: str, limiter: RateLimiter = limiter):
+    """
+    Dependency limiting the requests of each user to scope, or of each
+    client address when the request has no valid bearer token
+    """
+
+    async def dependency(request: Request, response: Response) -> None:
+        subject = token_subject(request.headers.get("authorization"))
+        if subject is not None:
+            key = f"user:{subject}"
+        else:
+            key = f"ip:{request.client.host if request.client else None}"
+        await limiter.check(scope, key, response)
+
+    return dependency
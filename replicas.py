@@ -0,0 +1,190 @@
+import itertools
+import threading
+import time
+from fastapi import Request
+from sqlalchemy import Engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import Session
+from cache import make_cache
+from database import engine, get_session, replica_engines, shard_engines
+from security import token_subject
+from settings import (
+    READ_YOUR_WRITES_SECONDS,
+    REPLICA_LAG_CHECK_INTERVAL,
+    REPLICA_MAX_LAG,
+    REPLICA_RETRY_SECONDS,
+    REPLICA_SELECTION,
+)
+import metrics
+
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+SELECTIONS = ("round_robin", "least_loaded")
+# Replay lag of a Postgres standby, 0 when it has replayed all it received
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM "
+    "now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+read_sessions = metrics.Counter(
+    "db_read_sessions_total",
+    "Read-only sessions handed out by target database.",
+    ("target",),
+)
+
+
+class Replica:
+    def __init__(self, name: str, engine: Engine):
+        self.name = name
+        self.engine = engine
+        self.lag = 0.0
+        self.checked = 0.0
+        self.failed_until = 0.0
+
+    def load(self) -> int:
+        pool = self.engine.pool
+        return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+
+class ReplicaSet:
+    """
+    Picks a replica for read-only sessions, skipping replicas that
+    failed recently or lag more than max_lag seconds behind the primary
+    """
+
+    def __init__(
+        self,
+        engines: list[Engine],
+        selection: str = REPLICA_SELECTION,
+        max_lag: float = REPLICA_MAX_LAG,
+        retry: float = REPLICA_RETRY_SECONDS,
+        lag_interval: float = REPLICA_LAG_CHECK_INTERVAL,
+    ):
+        if selection not in SELECTIONS:
+            raise ValueError(
+                f"selection must be one of {', '.join(SELECTIONS)}"
+            )
+        self.replicas = [
+            Replica(f"replica{number}", replica_engine)
+            for number, replica_engine in enumerate(engines)
+        ]
+        self.selection = selection
+        self.max_lag = max_lag
+        self.retry = retry
+        self.lag_interval = lag_interval
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+
+    def _refresh_lag(self, replica: Replica, now: float) -> None:
+        with self._lock:
+            if now - replica.checked < self.lag_interval:
+                return
+            replica.checked = now
+        if replica.engine.dialect.name != "postgresql":
+            return
+        try:
+            with replica.engine.connect() as connection:
+                replica.lag = float(connection.scalar(LAG_QUERY) or 0)
+        except DBAPIError:
+            self.mark_failed(replica)
+
+    def available(self) -> list[Replica]:
+        now = time.monotonic()
+        replicas = []
+        for replica in self.replicas:
+            if replica.failed_until > now:
+                continue
+            self._refresh_lag(replica, now)
+            if replica.failed_until <= now and replica.lag <= self.max_lag:
+                replicas.append(replica)
+        return replicas
+
+    def choose(self) -> Replica | None:
+        replicas = self.available()
+        if not replicas:
+            return None
+        if self.selection == "least_loaded":
+            return min(replicas, key=Replica.load)
+        return replicas[next(self._turn) % len(replicas)]
+
+    def mark_failed(self, replica: Replica) -> None:
+        replica.failed_until = time.monotonic() + self.retry
+
+
+replica_set = ReplicaSet(replica_engines)
+# Users who wrote recently, their reads stay on the primary
+recent_writers = make_cache(
+    "recent_writers", maxsize=100000, ttl=READ_YOUR_WRITES_SECONDS
+)
+
+
+def get_read_session(request: Request) -> Session:
+    """
+    Session for read-only handlers: bound to a replica when one is
+    healthy and the user has not written within the read-your-writes
+    window, otherwise to the primary. Sharded deployments read from
+    the shards.
+    """
+    if shard_engines:
+        yield from get_session(request)
+        return
+    replica = None
+    if request.method in SAFE_METHODS and replica_set.replicas:
+        key = token_subject(request.headers.get("authorization"))
+        if key is None or recent_writers.get(key) is None:
+            replica = replica_set.choose()
+    connection = None
+    if replica is not None:
+        try:
+            connection = replica.engine.connect()
+        except DBAPIError:
+            replica_set.mark_failed(replica)
+            replica = None
+    read_sessions.inc((replica.name if replica else "primary",))
+    if connection is None:
+        with Session(engine, expire_on_commit=False) as session:
+            yield session
+        return
+    try:
+        with Session(bind=connection, expire_on_commit=False) as session:
+            yield session
+    except DBAPIError as error:
+        # Lost mid-request, the next requests skip it for a while
+        if error.connection_invalidated:
+            replica_set.mark_failed(replica)
+        raise
+    finally:
+        connection.close()
+
+
+class ReadYourWritesMiddleware:
+    """
+    Pure ASGI middleware remembering users who sent a write request
+    (any method but GET, HEAD and OPTIONS) for READ_YOUR_WRITES_SECONDS
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] in SAFE_METHODS
+            or not replica_set.replicas
+        ):
+            await self.app(scope, receive, send)
+            return
+        authorization = None
+        for key, value in scope["headers"]:
+            if key == b"authorization":
+                authorization = value.decode("latin-1")
+        writer = token_subject(authorization)
+        if writer is not None:
+            recent_writers.set(writer, True)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The window starts over once the write has committed
+            if writer is not None:
+                recent_writers.set(writer, True)
@@ -1,16 +1,27 @@
+from decimal import Decimal
 from typing import Annotated
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, Header, HTTPException, Response
 from sqlmodel import select, Session
-from database import get_session
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import Account, AccountBase, AccountCreate, User, Project
+from query_cache import query_cache
 from security import oauth2_scheme, get_current_active_user
+import coalesce
+import ledger
+import summary
+import versioning
 
 
 router = APIRouter(
     prefix="/accounts",
     tags=["accounts"],
     responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("accounts"))],
 )
+# Concurrent identical reads of a project's accounts share one query
+account_reads = coalesce.SingleFlight("accounts")
 
 
 def verify_project_user(
@@ -24,6 +35,10 @@ def verify_project_user(
     return True
 
 
+def owned_projects(user_id: int):
+    return select(Project.id).filter(Project.owner_id == user_id)
+
+
 def verify_account_project_user(
     account_id: int, project_id: int, user_id: int, session: Session
 ) -> bool:
@@ -40,23 +55,36 @@ def verify_account_project_user(
     return True
 
 
+def _read_accounts(
+    session: Session, project_id: int, user_id: int | None
+) -> bytes:
+    if user_id is not None:
+        if verify_project_user(project_id, user_id, session):
+            raise HTTPException(status_code=403, detail="Not allowed")
+    statement = select(Account).filter(Account.project_id == project_id)
+    accounts = query_cache.fetch(session, statement, user_id)
+    if not accounts:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return coalesce.serialize(list[Account], accounts)
+
+
 @router.get("/{project_id}", response_model=list[Account])
 async def get_accounts(
     project_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    response: Response,
+    session: Session = Depends(get_read_session),
 ):
-    statement = select(Account).filter(Account.project_id == project_id)
-
-    if not current_user.is_superuser:
-        if verify_project_user(project_id, current_user.id, session):
-            raise HTTPException(status_code=403, detail="Not allowed")
-
-    accounts = session.exec(statement).all()
-    if not accounts:
-        raise HTTPException(status_code=404, detail="Account not found")
-    return accounts
+    user_id = None if current_user.is_superuser else current_user.id
+    body = await account_reads.do(
+        coalesce.read_key(session, user_id, project_id),
+        _read_accounts,
+        session,
+        project_id,
+        user_id,
+    )
+    return coalesce.json_response(response, body)
 
 
 @router.post("/{project_id}", response_model=Account)
@@ -70,10 +98,6 @@ async def create_account(
     if not current_user.is_superuser:
         if verify_project_user(project_id, current_user.id, session):
             raise HTTPException(status_code=403, detail="Not allowed")
-    statement = select(Account).filter(Account.name == account.name)
-    account_exist = session.exec(statement).first()
-    if account_exist:
-        raise HTTPException(status_code=400, detail="Account already exists")
     account = Account(
         name=account.name,
         description=account.description,
@@ -86,9 +110,15 @@ async def create_account(
         country_id=account.country_id,
         project_id=project_id,
     )
-    session.add(account)
+    account = insert_unique(session, account)
+    if not account:
+        raise HTTPException(status_code=400, detail="Account already exists")
+    summary.account_created(session, account)
+    if account.amount:
+        ledger.record_movement(
+            session, account, account.amount, "Opening balance"
+        )
     session.commit()
-    session.refresh(account)
     return account
 
 
@@ -98,7 +128,8 @@ async def get_account(
     account_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    response: Response,
+    session: Session = Depends(get_read_session),
 ):
     statement = select(Account).filter(
         Account.id == account_id, Account.project_id == project_id
@@ -111,6 +142,7 @@ async def get_account(
     account = session.exec(statement).first()
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
+    versioning.set_etag(response, account)
     return account
 
 
@@ -121,25 +153,37 @@ async def update_account(
     account: AccountBase,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
     session: Session = Depends(get_session),
 ):
-    statement = select(Account).filter(
-        Account.id == account_id, Account.project_id == project_id
-    )
+    where = [Account.id == account_id, Account.project_id == project_id]
     if not current_user.is_superuser:
-        if verify_account_project_user(
-            account_id, project_id, current_user.id, session
-        ):
-            raise HTTPException(status_code=403, detail="Not allowed")
-    db_account = session.exec(statement).first()
-    if not db_account:
-        raise HTTPException(status_code=404, detail="Account not found")
+        where.append(Account.project_id.in_(owned_projects(current_user.id)))
     account_data = account.model_dump(exclude_unset=True)
-    for key, value in account_data.items():
-        setattr(db_account, key, value)
-    session.add(db_account)
+    old_amount = None
+    if "amount" in account_data:
+        # The summary needs the previous amount, lock the row to read it
+        statement = select(Account.amount).filter(*where).with_for_update()
+        old_amount = session.exec(statement).first()
+    versions = versioning.if_match_versions(if_match)
+    db_account = update_returning(
+        session, Account, account_data, *where, versions=versions
+    )
+    if not db_account:
+        raise versioning.not_updated(
+            session, Account, versions, "Account not found", *where
+        )
+    if old_amount is not None and old_amount != db_account.amount:
+        summary.account_amount_changed(session, db_account, old_amount)
+        ledger.record_movement(
+            session,
+            db_account,
+            Decimal(db_account.amount) - Decimal(old_amount),
+            "Balance adjustment",
+        )
     session.commit()
-    session.refresh(db_account)
+    versioning.set_etag(response, db_account)
     return db_account
 
 
@@ -162,6 +206,8 @@ async def delete_account(
     account = session.exec(statement).first()
     if not account:
         raise HTTPException(status_code=404, detail="account not found")
+    summary.account_deleted(session, account)
+    ledger.delete_account_ledger(session, account_id)
     session.delete(account)
     session.commit()
     return {"ok": True}
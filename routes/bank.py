@@ -2,7 +2,9 @@
 from typing import Annotated
 from fastapi import Depends, APIRouter, HTTPException
 from sqlmodel import select, Session
-from database import get_session
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import Bank, BankBase, User
 from security import oauth2_scheme, get_current_active_user
 
@@ -10,7 +12,8 @@ from security import oauth2_scheme, get_current_active_user
 router = APIRouter(
     prefix="/banks",
     tags=["banks"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("banks"))],
 )
 
 
@@ -20,7 +23,7 @@ async def get_banks(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     banks = session.exec(select(Bank)).all()
     return banks
@@ -35,14 +38,12 @@ async def create_bank(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    statement = select(Bank).where(Bank.name == bank.name)
-    bank_exist = session.exec(statement).first()
-    if bank_exist:
+    bank = insert_unique(
+        session, Bank(name=bank.name, code=bank.code)
+    )
+    if not bank:
         raise HTTPException(status_code=400, detail="Bank already exists")
-    bank = Bank(name=bank.name, code=bank.code)
-    session.add(bank)
     session.commit()
-    session.refresh(bank)
     return bank
 
 
@@ -53,7 +54,7 @@ async def get_bank(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     bank = session.get(Bank, bank_id)
     if not bank:
@@ -71,15 +72,15 @@ async def update_bank(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    db_bank = session.get(Bank, bank_id)
+    db_bank = update_returning(
+        session,
+        Bank,
+        bank.model_dump(exclude_unset=True),
+        Bank.id == bank_id,
+    )
     if not db_bank:
         raise HTTPException(status_code=404, detail="Bank not found")
-    bank_data = bank.model_dump(exclude_unset=True)
-    for key, value in bank_data.items():
-        setattr(db_bank, key, value)
-    session.add(db_bank)
     session.commit()
-    session.refresh(db_bank)
     return db_bank
 
 
@@ -2,7 +2,10 @@
 from typing import Annotated
 from fastapi import Depends, APIRouter, HTTPException
 from sqlmodel import select, Session
-from database import get_session
+from starlette.concurrency import run_in_threadpool
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import Country, CountryBase, User
 from security import (oauth2_scheme,
                       get_current_active_user,
@@ -12,7 +15,8 @@ from security import (oauth2_scheme,
 router = APIRouter(
     prefix="/countries",
     tags=["countries"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("countries"))],
 )
 
 
@@ -22,7 +26,7 @@ async def get_countries(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     countries = session.exec(select(Country)).all()
     return countries
@@ -37,14 +41,12 @@ async def create_country(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    statement = select(Country).where(Country.name == country.name)
-    country_exist = session.exec(statement).first()
-    if country_exist:
+    country = insert_unique(
+        session, Country(name=country.name, code=country.code)
+    )
+    if not country:
         raise HTTPException(status_code=400, detail="Country already exists")
-    country = Country(name=country.name, code=country.code)
-    session.add(country)
     session.commit()
-    session.refresh(country)
     return country
 
 
@@ -55,7 +57,7 @@ async def get_country(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     country = session.get(Country, country_id)
     if not country:
@@ -73,15 +75,15 @@ async def update_country(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    db_country = session.get(Country, country_id)
+    db_country = update_returning(
+        session,
+        Country,
+        country.model_dump(exclude_unset=True),
+        Country.id == country_id,
+    )
     if not db_country:
         raise HTTPException(status_code=404, detail="Country not found")
-    country_data = country.model_dump(exclude_unset=True)
-    for key, value in country_data.items():
-        setattr(db_country, key, value)
-    session.add(db_country)
     session.commit()
-    session.refresh(db_country)
     return db_country
 
 
@@ -108,12 +110,9 @@ async def populate_initial_countries(
             current_user: Annotated[
                             User,
                             Depends(get_current_super_user)],
-            session: Session = Depends(get_session)
           ):
-    from populate.countries import populate_countries
-    countries = session.exec(select(Country)).all()
-    if not countries:
-        populate_countries()
-        return {"message": "Countries populated"}
-    else:
-        return {"message": "Countries already populated"}
+    from populate.seed import seed_dataset
+    result = await run_in_threadpool(seed_dataset, "countries")
+    if result["inserted"] or result["updated"]:
+        return {"message": "Countries populated", **result}
+    return {"message": "Countries already populated", **result}
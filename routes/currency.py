@@ -2,7 +2,10 @@
 from typing import Annotated
 from fastapi import Depends, APIRouter, HTTPException
 from sqlmodel import select, Session
-from database import get_session
+from starlette.concurrency import run_in_threadpool
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import Currency, CurrencyBase, User
 from security import (oauth2_scheme,
                       get_current_active_user,
@@ -12,7 +15,8 @@ from security import (oauth2_scheme,
 router = APIRouter(
     prefix="/currencies",
     tags=["currencies"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("currencies"))],
 )
 
 
@@ -22,7 +26,7 @@ async def get_currencies(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     currencies = session.exec(select(Currency)).all()
     return currencies
@@ -37,14 +41,12 @@ async def create_currency(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    statement = select(Currency).where(Currency.name == currency.name)
-    currency_exist = session.exec(statement).first()
-    if currency_exist:
+    currency = insert_unique(
+        session, Currency(name=currency.name, code=currency.code)
+    )
+    if not currency:
         raise HTTPException(status_code=400, detail="Currency already exists")
-    currency = Currency(name=currency.name, code=currency.code)
-    session.add(currency)
     session.commit()
-    session.refresh(currency)
     return currency
 
 
@@ -55,7 +57,7 @@ async def get_currency(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     currency = session.get(Currency, currency_id)
     if not currency:
@@ -73,15 +75,15 @@ async def update_currency(
                             Depends(get_current_active_user)],
             session: Session = Depends(get_session)
           ):
-    db_currency = session.get(Currency, currency_id)
+    db_currency = update_returning(
+        session,
+        Currency,
+        currency.model_dump(exclude_unset=True),
+        Currency.id == currency_id,
+    )
     if not db_currency:
         raise HTTPException(status_code=404, detail="Currency not found")
-    currency_data = currency.model_dump(exclude_unset=True)
-    for key, value in currency_data.items():
-        setattr(db_currency, key, value)
-    session.add(db_currency)
     session.commit()
-    session.refresh(db_currency)
     return db_currency
 
 
@@ -108,12 +110,9 @@ async def populate_initial_currencies(
             current_user: Annotated[
                             User,
                             Depends(get_current_super_user)],
-            session: Session = Depends(get_session)
           ):
-    from populate.currencies import populate_currencies
-    currencies = session.exec(select(Currency)).all()
-    if not currencies:
-        populate_currencies()
-        return {"message": "Currencies populated"}
-    else:
-        return {"message": "Currencies already populated"}
+    from populate.seed import seed_dataset
+    result = await run_in_threadpool(seed_dataset, "currencies")
+    if result["inserted"] or result["updated"]:
+        return {"message": "Currencies populated", **result}
+    return {"message": "Currencies already populated", **result}
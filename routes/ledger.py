@@ -0,0 +1,98 @@
+from datetime import date, datetime
+from typing import Annotated
+from fastapi import Depends, APIRouter, HTTPException, Query
+from sqlmodel import select, Session
+from ratelimit import rate_limit
+from replicas import get_read_session
+from models import (Account, AccountBalance, BalancePoint, LedgerEntry,
+                    Project, User)
+from security import oauth2_scheme, get_current_active_user
+import ledger
+
+
+router = APIRouter(
+    prefix="/accounts/ledger",
+    tags=["accounts"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("accounts"))],
+)
+
+
+def get_project_accounts(
+    project_id: int,
+    account_id: int | None,
+    current_user: User,
+    session: Session,
+) -> list[Account]:
+    statement = select(Project.id).filter(Project.id == project_id)
+    if not current_user.is_superuser:
+        statement = statement.filter(Project.owner_id == current_user.id)
+    if session.exec(statement).first() is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    statement = select(Account).filter(Account.project_id == project_id)
+    if account_id is not None:
+        statement = statement.filter(Account.id == account_id)
+    accounts = session.exec(statement).all()
+    if account_id is not None and not accounts:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return accounts
+
+
+@router.get("/{project_id}/series", response_model=list[BalancePoint])
+async def get_balance_series(
+    project_id: int,
+    start: date,
+    end: date,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    interval: Annotated[str, Query(pattern="^(day|month)$")] = "day",
+    account_id: int | None = None,
+    session: Session = Depends(get_read_session),
+):
+    accounts = get_project_accounts(
+        project_id, account_id, current_user, session
+    )
+    try:
+        return ledger.balance_series(session, accounts, start, end, interval)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+
+@router.get("/{project_id}/{account_id}", response_model=list[LedgerEntry])
+async def get_ledger_entries(
+    project_id: int,
+    account_id: int,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    limit: Annotated[int, Query(ge=1, le=500)] = 100,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    session: Session = Depends(get_read_session),
+):
+    get_project_accounts(project_id, account_id, current_user, session)
+    statement = (
+        select(LedgerEntry)
+        .filter(LedgerEntry.account_id == account_id)
+        .order_by(LedgerEntry.id.desc())
+        .offset(offset)
+        .limit(limit)
+    )
+    return session.exec(statement).all()
+
+
+@router.get(
+    "/{project_id}/{account_id}/balance", response_model=AccountBalance
+)
+async def get_account_balance(
+    project_id: int,
+    account_id: int,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    at: datetime | None = None,
+    session: Session = Depends(get_read_session),
+):
+    get_project_accounts(project_id, account_id, current_user, session)
+    at = at or datetime.now()
+    balances = ledger.balances_at(session, [account_id], at)
+    return AccountBalance(
+        account_id=account_id, at=at, balance=balances[account_id]
+    )
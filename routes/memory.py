@@ -0,0 +1,111 @@
+from typing import Annotated, Literal
+from fastapi import Depends, APIRouter, HTTPException, Query
+from starlette.concurrency import run_in_threadpool
+from models import User
+from ratelimit import rate_limit
+from security import oauth2_scheme, get_current_super_user
+import memory
+
+
+router = APIRouter(
+    prefix="/admin/memory",
+    tags=["admin"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("admin"))],
+)
+
+GroupBy = Literal["lineno", "filename", "traceback"]
+
+
+@router.get("/tracemalloc")
+async def get_tracing_status(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    return memory.tracing_status()
+
+
+@router.post("/tracemalloc/start")
+async def start_tracing(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+    frames: Annotated[int, Query(ge=1, le=100)] = 1,
+):
+    return memory.start_tracing(frames)
+
+
+@router.post("/tracemalloc/stop")
+async def stop_tracing(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    return memory.stop_tracing()
+
+
+@router.get("/snapshots")
+async def get_snapshots(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    return await run_in_threadpool(memory.list_snapshots)
+
+
+@router.post("/snapshots")
+async def take_snapshot(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    try:
+        return await run_in_threadpool(memory.take_snapshot)
+    except RuntimeError as error:
+        raise HTTPException(status_code=409, detail=str(error))
+
+
+@router.delete("/snapshots")
+async def clear_snapshots(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    memory.clear_snapshots()
+    return {"ok": True}
+
+
+@router.get("/snapshots/{snapshot_id}")
+async def get_snapshot(
+    snapshot_id: int,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+    group_by: GroupBy = "lineno",
+    limit: Annotated[int, Query(ge=1, le=500)] = 20,
+):
+    try:
+        return await run_in_threadpool(
+            memory.top_allocations, snapshot_id, group_by, limit
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+
+
+@router.get("/snapshots/{first_id}/diff/{second_id}")
+async def diff_snapshots(
+    first_id: int,
+    second_id: int,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+    group_by: GroupBy = "lineno",
+    limit: Annotated[int, Query(ge=1, le=500)] = 20,
+):
+    try:
+        return await run_in_threadpool(
+            memory.compare_snapshots, first_id, second_id, group_by, limit
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+
+
+@router.get("/objects")
+async def get_live_objects(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+):
+    return await run_in_threadpool(memory.live_objects)
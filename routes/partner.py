@@ -1,16 +1,21 @@
 from typing import Annotated
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, Header, HTTPException, Response
 from sqlmodel import select, Session
-from database import get_session
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import Partner, PartnerBase, PartnerCreate, User, Account
 from security import oauth2_scheme, get_current_active_user
-from routes.account import verify_account_project_user
+from routes.account import verify_account_project_user, owned_projects
+import summary
+import versioning
 
 
 router = APIRouter(
     prefix="/accounts/partners",
     tags=["accounts"],
     responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("accounts"))],
 )
 
 
@@ -20,7 +25,7 @@ async def get_partners(
     account_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_read_session),
 ):
     statement = select(Account).filter(Account.id == account_id)
 
@@ -56,18 +61,19 @@ async def create_partner(
     account = session.exec(statement).first()
     if not account or account.project.id != project_id:
         raise HTTPException(status_code=404, detail="Account not found")
-    partner_exist = session.exec(statement).first()
-    if partner_exist:
-        raise HTTPException(status_code=400, detail="Partner already exists")
-    partner = Partner(
-        name=partner.name,
-        description=partner.description,
-        percentage=partner.percentage,
-        account_id=account_id,
+    partner = insert_unique(
+        session,
+        Partner(
+            name=partner.name,
+            description=partner.description,
+            percentage=partner.percentage,
+            account_id=account_id,
+        ),
     )
-    session.add(partner)
+    if not partner:
+        raise HTTPException(status_code=400, detail="Partner already exists")
+    summary.apply_summary_delta(session, project_id, partners=1)
     session.commit()
-    session.refresh(partner)
     return partner
 
 
@@ -78,7 +84,8 @@ async def get_partner(
     partner_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    response: Response,
+    session: Session = Depends(get_read_session),
 ):
     statement = select(Account).filter(Account.id == account_id)
 
@@ -92,11 +99,13 @@ async def get_partner(
     if not account or account.project.id != project_id:
         raise HTTPException(status_code=404, detail="Account not found")
     statement = select(Partner).filter(
+        Partner.id == partner_id,
         Partner.account_id == account_id,
     )
     partner = session.exec(statement).first()
     if not partner:
         raise HTTPException(status_code=404, detail="Partner not found")
+    versioning.set_etag(response, partner)
     return partner
 
 
@@ -108,31 +117,32 @@ async def update_partner(
     partner: PartnerBase,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
     session: Session = Depends(get_session),
 ):
-    statement = select(Account).filter(Account.id == account_id)
-
+    accounts = select(Account.id).filter(
+        Account.id == account_id, Account.project_id == project_id
+    )
     if not current_user.is_superuser:
-        if verify_account_project_user(
-            account_id, project_id, current_user.id, session
-        ):
-            raise HTTPException(status_code=403, detail="Not allowed")
-
-    account = session.exec(statement).first()
-    if not account or account.project.id != project_id:
-        raise HTTPException(status_code=404, detail="Account not found")
-    statement = select(Partner).filter(
-        Partner.account_id == account_id,
+        accounts = accounts.filter(
+            Account.project_id.in_(owned_projects(current_user.id))
+        )
+    where = [Partner.id == partner_id, Partner.account_id.in_(accounts)]
+    versions = versioning.if_match_versions(if_match)
+    db_partner = update_returning(
+        session,
+        Partner,
+        partner.model_dump(exclude_unset=True),
+        *where,
+        versions=versions,
     )
-    db_partner = session.exec(statement).first()
     if not db_partner:
-        raise HTTPException(status_code=404, detail="Partner not found")
-    partner_data = partner.model_dump(exclude_unset=True)
-    for key, value in partner_data.items():
-        setattr(db_partner, key, value)
-    session.add(db_partner)
+        raise versioning.not_updated(
+            session, Partner, versions, "Partner not found", *where
+        )
     session.commit()
-    session.refresh(db_partner)
+    versioning.set_etag(response, db_partner)
     return db_partner
 
 
@@ -156,9 +166,14 @@ async def delete_partner(
     account = session.exec(statement).first()
     if not account or account.project.id != project_id:
         raise HTTPException(status_code=404, detail="Account not found")
+    statement = select(Partner).filter(
+        Partner.id == partner_id,
+        Partner.account_id == account_id,
+    )
     partner = session.exec(statement).first()
     if not partner:
         raise HTTPException(status_code=404, detail="Partner not found")
     session.delete(partner)
+    summary.apply_summary_delta(session, project_id, partners=-1)
     session.commit()
     return {"ok": True}
@@ -1,29 +1,48 @@
 from typing import Annotated
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, Header, HTTPException, Response
 from sqlmodel import select, Session
-from database import get_session
-from models import Project, ProjectBase, User
-from security import oauth2_scheme, get_current_active_user
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
+from models import Project, ProjectBase, ProjectSummaryRead, User
+from query_cache import query_cache
+from security import (oauth2_scheme,
+                      get_current_active_user,
+                      get_current_super_user)
+import coalesce
+import sharding
+import summary
+import versioning
 
 
 router = APIRouter(
     prefix="/projects",
     tags=["projects"],
     responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("projects"))],
 )
+# Concurrent identical reads of a project share one query
+project_reads = coalesce.SingleFlight("project")
 
 
 @router.get("/", response_model=list[Project])
 async def get_projects(
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_read_session),
 ):
     if current_user.is_superuser:
         statement = select(Project)
+        scope = None
     else:
         statement = select(Project).filter(Project.owner_id == current_user.id)
-    projects = session.exec(statement).all()
+        scope = current_user.id
+    projects = query_cache.fetch(
+        session,
+        statement,
+        scope,
+        load=lambda: sharding.exec_all(session, statement),
+    )
     return projects
 
 
@@ -34,44 +53,51 @@ async def create_project(
     current_user: Annotated[User, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
-    if current_user.is_superuser:
-        statement = select(Project).filter(Project.name == project.name)
-    else:
-        statement = select(Project).filter(
-            Project.name == project.name,
-            Project.owner_id == current_user.id
-        )
-    project_exist = session.exec(statement).first()
-    if project_exist:
-        raise HTTPException(status_code=400, detail="Project already exists")
-    project = Project(
-        name=project.name,
-        description=project.description,
-        owner_id=current_user.id
+    project = insert_unique(
+        session,
+        Project(
+            id=sharding.new_project_id(session),
+            name=project.name,
+            description=project.description,
+            owner_id=current_user.id
+        ),
     )
-    session.add(project)
+    if not project:
+        raise HTTPException(status_code=400, detail="Project already exists")
     session.commit()
-    session.refresh(project)
     return project
 
 
+def _read_project(
+    session: Session, project_id: int, user_id: int | None
+) -> tuple[bytes, int]:
+    statement = select(Project).filter(Project.id == project_id)
+    if user_id is not None:
+        statement = statement.filter(Project.owner_id == user_id)
+    project = session.exec(statement).first()
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return coalesce.serialize(Project, project), project.version
+
+
 @router.get("/{project_id}", response_model=Project)
 async def get_project(
     project_id: int,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    response: Response,
+    session: Session = Depends(get_read_session),
 ):
-    if current_user.is_superuser:
-        statement = select(Project).filter(Project.id == project_id)
-    else:
-        statement = select(Project).filter(
-            Project.id == project_id, Project.owner_id == current_user.id
-        )
-    project = session.exec(statement).first()
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    return project
+    user_id = None if current_user.is_superuser else current_user.id
+    body, version = await project_reads.do(
+        coalesce.read_key(session, user_id, project_id),
+        _read_project,
+        session,
+        project_id,
+        user_id,
+    )
+    response.headers["ETag"] = versioning.etag(version)
+    return coalesce.json_response(response, body)
 
 
 @router.patch("/{project_id}")
@@ -80,23 +106,27 @@ async def update_project(
     project: ProjectBase,
     token: Annotated[str, Depends(oauth2_scheme)],
     current_user: Annotated[User, Depends(get_current_active_user)],
+    response: Response,
+    if_match: Annotated[str | None, Header()] = None,
     session: Session = Depends(get_session),
 ):
-    if current_user.is_superuser:
-        statement = select(Project).filter(Project.id == project_id)
-    else:
-        statement = select(Project).filter(
-            Project.id == project_id, Project.owner_id == current_user.id
-        )
-    db_project = session.exec(statement).first()
+    where = [Project.id == project_id]
+    if not current_user.is_superuser:
+        where.append(Project.owner_id == current_user.id)
+    versions = versioning.if_match_versions(if_match)
+    db_project = update_returning(
+        session,
+        Project,
+        project.model_dump(exclude_unset=True),
+        *where,
+        versions=versions,
+    )
     if not db_project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    project_data = project.model_dump(exclude_unset=True)
-    for key, value in project_data.items():
-        setattr(db_project, key, value)
-    session.add(db_project)
+        raise versioning.not_updated(
+            session, Project, versions, "Project not found", *where
+        )
     session.commit()
-    session.refresh(db_project)
+    versioning.set_etag(response, db_project)
     return db_project
 
 
@@ -116,6 +146,55 @@ async def delete_project(
     project = session.exec(statement).first()
     if not project:
         raise HTTPException(status_code=404, detail="project not found")
+    summary.delete_project_summary(session, project_id)
     session.delete(project)
+    sharding.forget_project(session, project_id)
     session.commit()
     return {"ok": True}
+
+
+@router.get("/{project_id}/summary", response_model=ProjectSummaryRead)
+async def get_project_summary(
+    project_id: int,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    session: Session = Depends(get_read_session),
+):
+    if current_user.is_superuser:
+        statement = select(Project.id).filter(Project.id == project_id)
+    else:
+        statement = select(Project.id).filter(
+            Project.id == project_id, Project.owner_id == current_user.id
+        )
+    if session.exec(statement).first() is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return summary.get_project_summary(session, project_id)
+
+
+@router.post("/admin/summary/rebuild")
+async def rebuild_project_summaries(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+    project_id: int | None = None,
+    session: Session = Depends(get_session),
+):
+    result = {"projects": 0, "totals": 0}
+    for _ in sharding.for_each_shard(session):
+        for key, count in summary.rebuild_summaries(
+            session, project_id
+        ).items():
+            result[key] += count
+    return result
+
+
+@router.get("/admin/summary/check")
+async def check_project_summaries(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_super_user)],
+    project_id: int | None = None,
+    session: Session = Depends(get_session),
+):
+    mismatches = []
+    for _ in sharding.for_each_shard(session):
+        mismatches.extend(summary.check_summaries(session, project_id))
+    return {"ok": not mismatches, "mismatches": mismatches}
@@ -0,0 +1,40 @@
+from typing import Annotated
+from fastapi import Depends, APIRouter, HTTPException, Query
+from sqlmodel import select, Session
+from ratelimit import rate_limit
+from replicas import get_read_session
+from models import Account, Project, User
+from security import oauth2_scheme, get_current_active_user
+import search
+import sharding
+
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("search"))],
+)
+
+
+@router.get("/accounts", response_model=list[Account])
+async def search_accounts(
+    q: Annotated[str, Query(min_length=1, max_length=100)],
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    project_id: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    session: Session = Depends(get_read_session),
+):
+    project_ids = None if project_id is None else [project_id]
+    if not current_user.is_superuser:
+        statement = select(Project.id).filter(
+            Project.owner_id == current_user.id
+        )
+        owned = sharding.exec_all(session, statement)
+        if project_id is None:
+            project_ids = owned
+        elif project_id not in owned:
+            raise HTTPException(status_code=403, detail="Not allowed")
+    return search.search_accounts(session, q, project_ids, limit, offset)
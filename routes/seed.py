@@ -0,0 +1,38 @@
+from typing import Annotated
+from fastapi import Depends, APIRouter, HTTPException
+from starlette.concurrency import run_in_threadpool
+from models import User
+from populate.seed import DATASETS, seed_dataset
+from ratelimit import rate_limit
+from security import oauth2_scheme, get_current_super_user
+
+
+router = APIRouter(
+    prefix="/admin/seed",
+    tags=["admin"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("admin"))],
+)
+
+
+@router.get("/")
+async def get_datasets(
+            token: Annotated[str, Depends(oauth2_scheme)],
+            current_user: Annotated[
+                            User,
+                            Depends(get_current_super_user)],
+          ):
+    return {"datasets": list(DATASETS)}
+
+
+@router.post("/{dataset}")
+async def seed(
+            dataset: str,
+            token: Annotated[str, Depends(oauth2_scheme)],
+            current_user: Annotated[
+                            User,
+                            Depends(get_current_super_user)],
+          ):
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail="Dataset not found")
+    return await run_in_threadpool(seed_dataset, dataset)
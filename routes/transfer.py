@@ -0,0 +1,41 @@
+from typing import Annotated
+from fastapi import Depends, APIRouter, HTTPException
+from sqlmodel import select, Session
+from database import get_session
+from models import Account, Project, TransferBatch, User
+from ratelimit import rate_limit
+from security import oauth2_scheme, get_current_active_user
+import transfers
+
+
+router = APIRouter(
+    prefix="/accounts/transfers",
+    tags=["accounts"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("accounts"))],
+)
+
+
+@router.post("/{project_id}", response_model=list[Account])
+async def create_transfers(
+    project_id: int,
+    batch: TransferBatch,
+    token: Annotated[str, Depends(oauth2_scheme)],
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    session: Session = Depends(get_session),
+):
+    statement = select(Project.id).filter(Project.id == project_id)
+    if not current_user.is_superuser:
+        statement = statement.filter(Project.owner_id == current_user.id)
+    if session.exec(statement).first() is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    try:
+        accounts = transfers.apply_transfers(
+            session, project_id, batch.transfers
+        )
+    except LookupError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    session.commit()
+    return accounts
@@ -1,17 +1,21 @@
 from typing import Annotated
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, Header, HTTPException, APIRouter, Response
 from sqlmodel import Session, select
-from database import get_session
+from database import get_session, insert_unique, update_returning
+from ratelimit import rate_limit
+from replicas import get_read_session
 from models import (User, UserBase, UserRead, UserCreate, UserPassword,
                     UserActive, UserSuperuser)
 from security import (oauth2_scheme, get_password_hash,
                       get_current_active_user,
                       get_current_super_user)
+import versioning
 
 router = APIRouter(
     prefix="/admin/users",
     tags=["admin"],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit("admin"))],
 )
 
 
@@ -21,7 +25,7 @@ async def get_users(
             current_user: Annotated[
                             User,
                             Depends(get_current_super_user)],
-            session: Session = Depends(get_session)
+            session: Session = Depends(get_read_session)
           ):
     users = session.exec(select(User)).all()
     return users
@@ -36,19 +40,23 @@ async def create_User(
                             Depends(get_current_super_user)],
             session: Session = Depends(get_session)
           ):
-    statement = select(User).where(User.username == user.username)
-    user_exist = session.exec(statement).first()
-    if user_exist:
+    # Spares the password hash for duplicates, insert_unique still
+    # settles concurrent creations
+    statement = select(User.id).where(User.username == user.username)
+    if session.exec(statement).first() is not None:
         raise HTTPException(status_code=400, detail="User already exists")
-    user = User(
-        username=user.username,
-        email=user.email,
-        name=user.name,
-        password=get_password_hash(user.password),
+    user = insert_unique(
+        session,
+        User(
+            username=user.username,
+            email=user.email,
+            name=user.name,
+            password=get_password_hash(user.password),
+        ),
     )
-    session.add(user)
+    if not user:
+        raise HTTPException(status_code=400, detail="User already exists")
     session.commit()
-    session.refresh(user)
     return user
 
 
@@ -59,11 +67,13 @@ async def get_User(
             current_user: Annotated[
                             User,
                             Depends(get_current_super_user)],
-            session: Session = Depends(get_session)
+            response: Response,
+            session: Session = Depends(get_read_session)
           ):
     user = session.get(User, user_id)
-    if not User:
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    versioning.set_etag(response, user)
     return user
 
 
@@ -75,20 +85,27 @@ async def update_User(
             current_user: Annotated[
                             User,
                             Depends(get_current_active_user)],
+            response: Response,
+            if_match: Annotated[str | None, Header()] = None,
             session: Session = Depends(get_session)
           ):
     if (not current_user.is_superuser) and current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    db_user = session.get(User, user_id)
+    versions = versioning.if_match_versions(if_match)
+    db_user = update_returning(
+        session,
+        User,
+        user.model_dump(exclude_unset=True),
+        User.id == user_id,
+        versions=versions,
+    )
     if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    user_data = user.model_dump(exclude_unset=True)
-    for key, value in user_data.items():
-        setattr(db_user, key, value)
-    session.add(db_user)
+        raise versioning.not_updated(
+            session, User, versions, "User not found", User.id == user_id
+        )
     session.commit()
-    session.refresh(db_user)
+    versioning.set_etag(response, db_user)
     return db_user
 
 
@@ -121,13 +138,15 @@ def change_password(
      ):
     if (not current_user.is_superuser) and current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
-    user = session.get(User, user_id)
-    if not User:
+    user = update_returning(
+        session,
+        User,
+        {"password": get_password_hash(password.password)},
+        User.id == user_id,
+    )
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    user.password = get_password_hash(password.password)
-    session.add(user)
     session.commit()
-    session.refresh(user)
     return {"ok": True}
 
 
@@ -141,13 +160,12 @@ def change_active(
                             Depends(get_current_super_user)],
       session: Session = Depends(get_session)
      ):
-    user = session.get(User, user_id)
-    if not User:
+    user = update_returning(
+        session, User, {"is_active": active.is_active}, User.id == user_id
+    )
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    user.is_active = active.is_active
-    session.add(user)
     session.commit()
-    session.refresh(user)
     return {"ok": True}
 
 
@@ -161,13 +179,15 @@ def change_superuser(
                             Depends(get_current_super_user)],
       session: Session = Depends(get_session)
      ):
-    user = session.get(User, user_id)
-    if not User:
+    user = update_returning(
+        session,
+        User,
+        {"is_superuser": superuser.is_superuser},
+        User.id == user_id,
+    )
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    user.is_superuser = superuser.is_superuser
-    session.add(user)
     session.commit()
-    session.refresh(user)
     return {"ok": True}
 
 
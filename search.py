@@ -0,0 +1,225 @@
+import threading
+from collections import defaultdict
+from sqlalchemy import case, func, or_
+from sqlmodel import Session, select
+from models import Account
+from query_cache import table_versions
+import sharding
+
+
+SEARCH_FIELDS = ("name", "account_number", "alias", "description")
+# Relative weight of a match in each field when ranking results
+FIELD_WEIGHTS = {"name": 4, "account_number": 3, "alias": 2, "description": 1}
+
+
+def _trigrams(value: str) -> set[str]:
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def _escape_like(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    )
+
+
+class AccountSearchIndex:
+    """
+    In-process trigram index over the account search fields, used
+    when the database has no trigram support (local SQLite files).
+    It reloads once a commit of this worker, or of any worker sharing
+    the cache backend, wrote the account table since it loaded; with
+    the "memory" CACHE_BACKEND, commits of other workers go unseen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Versions of the account table the index was loaded at
+        self._versions = None
+        self._documents = {}
+        self._by_project = defaultdict(set)
+        self._postings = defaultdict(set)
+
+    def _index(self, account_id: int, project_id: int, fields: dict):
+        self._remove(account_id)
+        document = {
+            field: (value or "").lower() for field, value in fields.items()
+        }
+        self._documents[account_id] = (project_id, document)
+        self._by_project[project_id].add(account_id)
+        for value in document.values():
+            for trigram in _trigrams(value):
+                self._postings[trigram].add(account_id)
+
+    def _remove(self, account_id: int):
+        entry = self._documents.pop(account_id, None)
+        if entry is None:
+            return
+        project_id, document = entry
+        self._by_project[project_id].discard(account_id)
+        for value in document.values():
+            for trigram in _trigrams(value):
+                posting = self._postings.get(trigram)
+                if posting is not None:
+                    posting.discard(account_id)
+                    if not posting:
+                        del self._postings[trigram]
+
+    def load(self, session: Session) -> None:
+        # Before reading, so commits racing the load trigger another
+        versions = table_versions([Account.__tablename__])
+        statement = select(
+            Account.id,
+            Account.project_id,
+            *[getattr(Account, field) for field in SEARCH_FIELDS],
+        )
+        rows = sharding.exec_all(session, statement)
+        with self._lock:
+            self._documents.clear()
+            self._by_project.clear()
+            self._postings.clear()
+            for account_id, project_id, *values in rows:
+                self._index(
+                    account_id, project_id, dict(zip(SEARCH_FIELDS, values))
+                )
+            self._versions = versions
+
+    def search(
+        self,
+        session: Session,
+        query: str,
+        project_ids: list[int] | None,
+        limit: int,
+        offset: int,
+    ) -> list[int]:
+        if self._versions != table_versions([Account.__tablename__]):
+            self.load(session)
+        query = query.lower()
+        with self._lock:
+            if project_ids is None:
+                scope = set(self._documents)
+            else:
+                scope = set().union(
+                    *[self._by_project.get(id, ()) for id in project_ids]
+                )
+            trigrams = _trigrams(query)
+            if trigrams:
+                candidates = set.intersection(*[
+                    self._postings.get(trigram, set()) for trigram in trigrams
+                ])
+                candidates &= scope
+            else:
+                candidates = scope
+            ranked = []
+            for account_id in candidates:
+                document = self._documents[account_id][1]
+                score = _score(document, query, trigrams)
+                if score:
+                    ranked.append((-score, account_id))
+        ranked.sort()
+        return [account_id for _, account_id in ranked[offset:offset + limit]]
+
+
+def _score(document: dict, query: str, trigrams: set[str]) -> float:
+    score = 0.0
+    for field, weight in FIELD_WEIGHTS.items():
+        value = document[field]
+        if value == query:
+            score += 3 * weight
+        elif value.startswith(query):
+            score += 2 * weight
+        elif query in value:
+            score += weight
+        else:
+            continue
+        if trigrams:
+            value_trigrams = _trigrams(value)
+            score += weight * len(trigrams & value_trigrams) / len(
+                trigrams | value_trigrams
+            )
+    return score
+
+
+index = AccountSearchIndex()
+
+
+def _ranked_statement(query: str, project_ids: list[int] | None):
+    """
+    select(Account, score) of the accounts matching query, best first
+    """
+    escaped = _escape_like(query)
+    matches = []
+    rank = []
+    for field in SEARCH_FIELDS:
+        column = getattr(Account, field)
+        weight = FIELD_WEIGHTS[field]
+        matches.append(column.ilike(f"%{escaped}%", escape="\\"))
+        rank.append(
+            case(
+                (func.lower(column) == query.lower(), 3 * weight),
+                (column.ilike(f"{escaped}%", escape="\\"), 2 * weight),
+                (column.ilike(f"%{escaped}%", escape="\\"), weight),
+                else_=0,
+            )
+            + weight * func.coalesce(func.similarity(column, query), 0)
+        )
+    document = func.to_tsvector(
+        "simple", func.coalesce(Account.description, "")
+    )
+    terms = func.plainto_tsquery("simple", query)
+    matches.append(document.op("@@")(terms))
+    rank.append(func.ts_rank(document, terms))
+    score = sum(rank[1:], rank[0])
+
+    statement = select(Account, score).filter(or_(*matches))
+    if project_ids is not None:
+        statement = statement.filter(Account.project_id.in_(project_ids))
+    return statement.order_by(score.desc(), Account.id)
+
+
+def _search_postgres(
+    session: Session,
+    query: str,
+    project_ids: list[int] | None,
+    limit: int,
+    offset: int,
+) -> list[Account]:
+    if not sharding.enabled:
+        statement = _ranked_statement(query, project_ids)
+        rows = session.exec(statement.offset(offset).limit(limit)).all()
+        return [account for account, _ in rows]
+    # Top offset + limit of every shard holding the projects, merged
+    if project_ids is None:
+        shards = {shard: None for shard in sharding.shard_engines}
+    else:
+        shards = sharding.project_shards(session, project_ids)
+    ranked = []
+    for shard, shard_project_ids in shards.items():
+        statement = _ranked_statement(query, shard_project_ids)
+        with sharding.use_shard(session, shard):
+            rows = session.exec(statement.limit(offset + limit)).all()
+        ranked.extend(rows)
+    ranked.sort(key=lambda row: (-row[1], row[0].id))
+    return [account for account, _ in ranked[offset:offset + limit]]
+
+
+def search_accounts(
+    session: Session,
+    query: str,
+    project_ids: list[int] | None = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> list[Account]:
+    """
+    Rank accounts matching query by prefix or substring on name,
+    account number, alias and description. project_ids=None searches
+    every project.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return _search_postgres(session, query, project_ids, limit, offset)
+    ids = index.search(session, query, project_ids, limit, offset)
+    if not ids:
+        return []
+    statement = select(Account).filter(Account.id.in_(ids))
+    accounts = sharding.exec_all(session, statement)
+    by_id = {account.id: account for account in accounts}
+    return [by_id[id] for id in ids if id in by_id]
@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, timedelta
 from typing import Annotated
 from fastapi import Depends, HTTPException, status, Security
@@ -5,8 +6,9 @@ from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from sqlmodel import Session, select
 from pydantic import BaseModel, ValidationError
 from pwdlib import PasswordHash
-from settings import settings
+from settings import settings, AUTH_CACHE_SIZE, AUTH_CACHE_TTL
 from database import engine
+from cache import make_cache
 from models import User
 from jose import jwt, JWTError
 
@@ -15,6 +17,11 @@ ALGORITHM = settings['ALGORITHM']
 ACCESS_TOKEN_EXPIRE_MINUTES = settings['ACCESS_TOKEN_EXPIRE_MINUTES']
 ATEM = ACCESS_TOKEN_EXPIRE_MINUTES
 
+# Decoded payloads of recently seen tokens, until they expire
+token_cache = make_cache(
+    "auth_token", maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL
+)
+
 
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="token",
@@ -86,6 +93,31 @@ def create_user_access_token(data: dict) -> str:
     return access_token
 
 
+def decode_token(token: str) -> dict:
+    """
+    Verified payload of an access token, raises JWTError when invalid
+    """
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.set(token, payload, payload.get("exp", 0) - time.time())
+    return payload
+
+
+def token_subject(authorization: str | None) -> str | None:
+    """
+    Subject of the bearer token in an Authorization header value, None
+    when it is missing or invalid
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return decode_token(token).get("sub")
+    except JWTError:
+        return None
+
+
 def get_current_user(
       security_scopes: SecurityScopes,
       token: Annotated[str, Depends(oauth2_scheme)]
@@ -100,7 +132,7 @@ def get_current_user(
         headers={"WWW-Authenticate": authenticate_value},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -137,5 +169,5 @@ async def get_current_super_user(
                             Security(get_current_user, scopes=["superuser"])],
           ):
     if not current_user.is_superuser:
-        raise HTTPException(status_code=400, detail="Not superuser")
+        raise HTTPException(status_code=403, detail="Not superuser")
     return current_user
@@ -1,18 +1,133 @@
+import os
 from dotenv import dotenv_values, find_dotenv
 
 env_file = find_dotenv('.env')
 
 settings = dotenv_values(dotenv_path=env_file)
 
-DB_USER = settings["DB_USER"]
-DB_PASSWORD = settings["DB_PASSWORD"]
-DB_HOST = settings["DB_HOST"]
-DB_PORT = settings["DB_PORT"]
-DB_DB = settings["DB_DB"]
+DB_USER = settings.get("DB_USER")
+DB_PASSWORD = settings.get("DB_PASSWORD")
+DB_HOST = settings.get("DB_HOST")
+DB_PORT = settings.get("DB_PORT")
+DB_DB = settings.get("DB_DB")
 
-DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_DB}"
+# DATABASE_URL (environment or .env) overrides the DB_* values,
+# e.g. sqlite:///local.db for local test databases
+DATABASE_URL = os.environ.get(
+    "DATABASE_URL",
+    settings.get("DATABASE_URL")
+    or f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}"
+    f"@{DB_HOST}:{DB_PORT}/{DB_DB}"
+)
+
+# Comma separated read replica URLs, GET handlers using get_read_session
+# read from them
+DATABASE_REPLICA_URLS = [
+    url.strip()
+    for url in os.environ.get(
+        "DATABASE_REPLICA_URLS", settings.get("DATABASE_REPLICA_URLS") or ""
+    ).split(",")
+    if url.strip()
+]
+# round_robin or least_loaded
+REPLICA_SELECTION = settings.get("REPLICA_SELECTION", "round_robin")
+# Seconds a replica may lag behind before reads go to the primary
+REPLICA_MAX_LAG = float(settings.get("REPLICA_MAX_LAG", 5))
+REPLICA_LAG_CHECK_INTERVAL = float(
+    settings.get("REPLICA_LAG_CHECK_INTERVAL", 5)
+)
+# Seconds a failed replica is skipped
+REPLICA_RETRY_SECONDS = float(settings.get("REPLICA_RETRY_SECONDS", 30))
+# Reads of a user stay on the primary this long after their writes
+READ_YOUR_WRITES_SECONDS = float(settings.get("READ_YOUR_WRITES_SECONDS", 5))
+
+# Comma separated shard URLs enable sharding: projects and their rows
+# live on one shard each, users and reference data on DATABASE_URL
+SHARD_URLS = [
+    url.strip()
+    for url in os.environ.get(
+        "SHARD_URLS", settings.get("SHARD_URLS") or ""
+    ).split(",")
+    if url.strip()
+]
+# Ids reserved per id_ticket round trip when sharding
+SHARD_ID_BLOCK = int(settings.get("SHARD_ID_BLOCK", 100))
 
 APP_NAME = settings["APP_NAME"]
 APP_VERSION = settings["APP_VERSION"]
 APP_SUMMARY = settings["APP_SUMMARY"]
-APP_DESCRIPTION = settings["APP_DESCRIPTION"]
\ No newline at end of file
+APP_DESCRIPTION = settings["APP_DESCRIPTION"]
+
+# Ledger entries between two balance snapshots of an account
+LEDGER_SNAPSHOT_INTERVAL = int(settings.get("LEDGER_SNAPSHOT_INTERVAL", 100))
+
+# Decoded access tokens cached in process (entries, seconds)
+AUTH_CACHE_SIZE = int(settings.get("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL = float(settings.get("AUTH_CACHE_TTL", 300))
+
+# Request profiling: 1 in PROFILE_SAMPLE_RATE requests (0 disables) is
+# profiled to PROFILE_DIR, which keeps the newest PROFILE_RETENTION files
+PROFILE_SAMPLE_RATE = int(settings.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = settings.get("PROFILE_DIR", "profiles")
+PROFILE_RETENTION = int(settings.get("PROFILE_RETENTION", 100))
+PROFILE_INTERVAL = float(settings.get("PROFILE_INTERVAL", 0.001))
+
+# Event loop stalls longer than LOOP_LAG_THRESHOLD seconds are reported,
+# LOOP_STRICT fails the requests causing them (for test runs)
+LOOP_LAG_THRESHOLD = float(settings.get("LOOP_LAG_THRESHOLD", 0.1))
+LOOP_STRICT = settings.get("LOOP_STRICT", "False").lower() == "true"
+
+# Responses stored for Idempotency-Key replays (entries, seconds)
+IDEMPOTENCY_CACHE_SIZE = int(settings.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_TTL = float(settings.get("IDEMPOTENCY_TTL", 86400))
+
+# Token bucket limits per route scope as "scope=requests/seconds,...",
+# "default" applies to scopes without their own, empty disables limits.
+# RATE_LIMIT_BACKEND is memory (per worker), database (shared) or
+# module:Class of a custom backend.
+RATE_LIMITS = settings.get("RATE_LIMITS", "")
+RATE_LIMIT_BACKEND = settings.get("RATE_LIMIT_BACKEND", "memory")
+
+# Adaptive concurrency limit per worker: starts at CONCURRENCY_INITIAL
+# within [CONCURRENCY_MIN, CONCURRENCY_MAX] and shrinks when requests
+# take longer than CONCURRENCY_LATENCY_TARGET seconds. Up to
+# CONCURRENCY_QUEUE_SIZE requests wait CONCURRENCY_QUEUE_TIMEOUT seconds
+# for a slot before getting a 503.
+CONCURRENCY_INITIAL = int(settings.get("CONCURRENCY_INITIAL", 20))
+CONCURRENCY_MIN = int(settings.get("CONCURRENCY_MIN", 4))
+CONCURRENCY_MAX = int(settings.get("CONCURRENCY_MAX", 200))
+CONCURRENCY_LATENCY_TARGET = float(
+    settings.get("CONCURRENCY_LATENCY_TARGET", 0.5)
+)
+CONCURRENCY_QUEUE_SIZE = int(settings.get("CONCURRENCY_QUEUE_SIZE", 50))
+CONCURRENCY_QUEUE_TIMEOUT = float(
+    settings.get("CONCURRENCY_QUEUE_TIMEOUT", 1.0)
+)
+
+# Time budget of a request in seconds, pushed down to the database as
+# statement timeouts. ROUTE_TIMEOUTS overrides it per route template as
+# "/accounts/{project_id}=10,...", an X-Request-Timeout header per
+# request up to REQUEST_TIMEOUT_MAX.
+REQUEST_TIMEOUT = float(settings.get("REQUEST_TIMEOUT", 30))
+REQUEST_TIMEOUT_MAX = float(settings.get("REQUEST_TIMEOUT_MAX", 120))
+ROUTE_TIMEOUTS = settings.get("ROUTE_TIMEOUTS", "")
+
+# Query-result cache of project and account lists: entries live up to
+# QUERY_CACHE_TTL seconds (0, the default, disables it) unless a commit
+# writes one of their tables first, and the least recently used go beyond
+# QUERY_CACHE_MAX_ROWS cached rows. Commits of other workers only reach
+# a worker through a shared CACHE_BACKEND, so with several workers and
+# the "memory" backend lists stay stale for up to QUERY_CACHE_TTL.
+QUERY_CACHE_TTL = float(settings.get("QUERY_CACHE_TTL", 0))
+QUERY_CACHE_MAX_ROWS = int(settings.get("QUERY_CACHE_MAX_ROWS", 100000))
+
+# Cache tier of the auth token, idempotency and read-your-writes caches
+# and of query cache invalidations: "memory" (each worker its own),
+# "mmap" (shared by the workers of a host through the CACHE_MMAP_PATH
+# file of CACHE_MMAP_SLOTS slots of CACHE_MMAP_SLOT_SIZE bytes), "redis"
+# (shared by every host through CACHE_URL) or "module:Class".
+CACHE_BACKEND = settings.get("CACHE_BACKEND", "memory")
+CACHE_MMAP_PATH = settings.get("CACHE_MMAP_PATH", "/dev/shm/fasb-cache")
+CACHE_MMAP_SLOTS = int(settings.get("CACHE_MMAP_SLOTS", 8192))
+CACHE_MMAP_SLOT_SIZE = int(settings.get("CACHE_MMAP_SLOT_SIZE", 4096))
+CACHE_URL = settings.get("CACHE_URL", "redis://localhost:6379/0")
@@ -0,0 +1,495 @@
+import threading
+from contextlib import contextmanager
+from fastapi import HTTPException, Request
+from sqlalchemy import (
+    MetaData,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.sql.util import find_tables
+from sqlmodel import Session
+from database import dialect_insert, engine, shard_engines
+from models import (
+    Account,
+    BalanceSnapshot,
+    IdTicket,
+    LedgerEntry,
+    Partner,
+    Project,
+    ProjectCurrencyTotal,
+    ProjectShard,
+    ProjectSummary,
+)
+from settings import SHARD_ID_BLOCK
+
+
+# Tables stored on the shard of their project, parents first. User and
+# the reference tables stay on the global database (DATABASE_URL).
+SHARDED_MODELS = (
+    Project,
+    ProjectSummary,
+    ProjectCurrencyTotal,
+    Account,
+    Partner,
+    LedgerEntry,
+    BalanceSnapshot,
+)
+SHARDED_TABLES = {model.__tablename__ for model in SHARDED_MODELS}
+# Tables whose ids come from id_ticket, so they are unique across shards
+# and rows keep their ids when a project moves
+ALLOCATED_MODELS = (Project, Account, Partner, LedgerEntry, BalanceSnapshot)
+ALLOCATED_TABLES = {model.__tablename__ for model in ALLOCATED_MODELS}
+
+enabled = bool(shard_engines)
+# Session.info key set once the session's transaction locked its project
+PROJECT_LOCKED = "shard_project_locked"
+
+
+class ShardNotSelected(RuntimeError):
+    pass
+
+
+class IdAllocator:
+    """
+    Hands out ids from blocks of SHARD_ID_BLOCK reserved in the global
+    id_ticket table
+    """
+
+    def __init__(self, block: int = SHARD_ID_BLOCK):
+        self.block = block
+        self._lock = threading.Lock()
+        self._ranges = {}
+
+    def _reserve(self, name: str) -> list[int]:
+        statement = (
+            update(IdTicket)
+            .where(IdTicket.name == name)
+            .values(next_id=IdTicket.next_id + self.block)
+            .returning(IdTicket.next_id)
+        )
+        with Session(engine) as session:
+            end = session.execute(statement).scalar()
+            if end is None:
+                session.execute(
+                    dialect_insert(session, IdTicket)
+                    .values(name=name, next_id=1)
+                    .on_conflict_do_nothing()
+                )
+                end = session.execute(statement).scalar()
+            session.commit()
+        return [end - self.block, end]
+
+    def next(self, name: str) -> int:
+        with self._lock:
+            current = self._ranges.get(name)
+            if current is None or current[0] >= current[1]:
+                current = self._ranges[name] = self._reserve(name)
+            value = current[0]
+            current[0] += 1
+            return value
+
+
+allocator = IdAllocator()
+
+
+def _is_sharded(mapper, clause) -> bool:
+    if mapper is not None:
+        return inspect(mapper).local_table.name in SHARDED_TABLES
+    if clause is None:
+        return False
+    table = getattr(clause, "table", None)
+    if table is not None:
+        return table.name in SHARDED_TABLES
+    return any(
+        getattr(table, "name", None) in SHARDED_TABLES
+        for table in find_tables(clause, include_crud=True)
+    )
+
+
+class ShardSession(Session):
+    """
+    Session binding the sharded tables to the engine of its current
+    shard and everything else to the global engine
+    """
+
+    def __init__(self, shard: str | None = None, **kwargs):
+        super().__init__(engine, **kwargs)
+        self.shard = shard
+        # Project whose writes are checked against move_project
+        self.project_id = None
+
+    def get_bind(self, mapper=None, *, clause=None, **kwargs):
+        if _is_sharded(mapper, clause):
+            if self.shard is None:
+                raise ShardNotSelected("No shard selected for this session")
+            return shard_engines[self.shard]
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+
+def _lock_project(session: ShardSession) -> None:
+    """
+    Before the first write of a transaction, lock the project row on the
+    session's shard and check the directory still points there. Writes
+    either commit before move_project locks the row to copy it or find
+    the project moving. SQLite ignores the lock, so writes racing a move
+    of a project on a SQLite shard may still be lost.
+    """
+    if session.project_id is None or session.info.get(PROJECT_LOCKED):
+        return
+    session.info[PROJECT_LOCKED] = True
+    session.execute(
+        select(Project.id)
+        .where(Project.id == session.project_id)
+        .with_for_update()
+    )
+    entry = session.execute(
+        select(ProjectShard.shard, ProjectShard.moving).where(
+            ProjectShard.project_id == session.project_id
+        )
+    ).one_or_none()
+    if entry is not None and (entry.moving or entry.shard != session.shard):
+        raise HTTPException(
+            status_code=503,
+            detail="Project is being moved, retry shortly",
+            headers={"Retry-After": "5"},
+        )
+
+
+@event.listens_for(ShardSession, "after_commit")
+@event.listens_for(ShardSession, "after_rollback")
+def _unlock_project(session) -> None:
+    session.info.pop(PROJECT_LOCKED, None)
+
+
+@event.listens_for(ShardSession, "before_flush")
+def _before_flush(session, flush_context, instances) -> None:
+    _lock_project(session)
+    for instance in session.new:
+        if isinstance(instance, ALLOCATED_MODELS) and instance.id is None:
+            instance.id = allocator.next(instance.__tablename__)
+
+
+@event.listens_for(ShardSession, "do_orm_execute")
+def _do_orm_execute(orm_execute_state) -> None:
+    # insert(), update() and delete() statements bypass the flush
+    if not (
+        orm_execute_state.is_insert
+        or orm_execute_state.is_update
+        or orm_execute_state.is_delete
+    ):
+        return
+    statement = orm_execute_state.statement
+    name = statement.table.name
+    if name in SHARDED_TABLES:
+        _lock_project(orm_execute_state.session)
+    if not orm_execute_state.is_insert or name not in ALLOCATED_TABLES:
+        return
+    parameters = orm_execute_state.parameters or {}
+    if isinstance(parameters, list):
+        raise ValueError(f"Inserts of several {name} rows need their ids")
+    if "id" not in statement.compile(column_keys=list(parameters)).params:
+        orm_execute_state.statement = statement.values(
+            id=allocator.next(name)
+        )
+
+
+@contextmanager
+def use_shard(session: ShardSession, shard: str):
+    previous = session.shard
+    session.shard = shard
+    try:
+        yield session
+    finally:
+        session.shard = previous
+
+
+def get_shard_session(request: Request) -> ShardSession:
+    """
+    Session on the shard of the request's project_id path parameter.
+    Unknown projects get the first shard, where they are not found
+    either; routes without a project pick shards themselves.
+    """
+    with ShardSession(expire_on_commit=False) as session:
+        project_id = request.path_params.get("project_id")
+        if project_id is not None:
+            try:
+                project_id = int(project_id)
+            except ValueError:
+                raise HTTPException(
+                    status_code=422, detail="project_id must be an integer"
+                )
+            session.project_id = project_id
+            entry = session.get(ProjectShard, project_id)
+            if entry is not None and entry.moving:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Project is being moved, retry shortly",
+                    headers={"Retry-After": "5"},
+                )
+            session.shard = entry.shard if entry else next(iter(shard_engines))
+        yield session
+
+
+def exec_all(session: Session, statement) -> list:
+    """
+    Run a select on every shard and concatenate the results, or just
+    run it when sharding is disabled
+    """
+    if not enabled:
+        return session.exec(statement).all()
+    results = []
+    for shard in shard_engines:
+        with use_shard(session, shard):
+            results.extend(session.exec(statement).all())
+    return results
+
+
+def for_each_shard(session: Session):
+    """
+    Yield once per shard with the session switched to it, or once
+    when sharding is disabled
+    """
+    if not enabled:
+        yield None
+        return
+    for shard in shard_engines:
+        with use_shard(session, shard):
+            yield shard
+
+
+def project_shards(session: Session, project_ids: list[int]) -> dict:
+    """
+    {shard: [project ids]} of the given projects
+    """
+    statement = select(ProjectShard.shard, ProjectShard.project_id).filter(
+        ProjectShard.project_id.in_(project_ids)
+    )
+    shards = {}
+    for shard, project_id in session.execute(statement):
+        shards.setdefault(shard, []).append(project_id)
+    return shards
+
+
+def choose_shard(session: Session) -> str:
+    statement = select(ProjectShard.shard, func.count()).group_by(
+        ProjectShard.shard
+    )
+    counts = {shard: 0 for shard in shard_engines}
+    for shard, count in session.execute(statement):
+        if shard in counts:
+            counts[shard] = count
+    return min(counts, key=counts.get)
+
+
+def new_project_id(session: Session) -> int | None:
+    """
+    Allocate the id of a new project and register it on the least
+    populated shard, selecting that shard for the session. Returns None
+    when sharding is disabled.
+    """
+    if not enabled:
+        return None
+    project_id = allocator.next(Project.__tablename__)
+    shard = choose_shard(session)
+    session.execute(
+        insert(ProjectShard).values(project_id=project_id, shard=shard)
+    )
+    session.shard = shard
+    return project_id
+
+
+def forget_project(session: Session, project_id: int) -> None:
+    if enabled:
+        session.execute(
+            delete(ProjectShard).where(ProjectShard.project_id == project_id)
+        )
+
+
+def shard_metadata() -> MetaData:
+    """
+    Sharded tables without the foreign keys to global tables
+    """
+    metadata = MetaData()
+    for model in SHARDED_MODELS:
+        table = model.__table__.to_metadata(metadata)
+        for constraint in list(table.foreign_key_constraints):
+            target = constraint.elements[0].target_fullname.split(".")[0]
+            if target in SHARDED_TABLES:
+                continue
+            table.constraints.discard(constraint)
+            for element in constraint.elements:
+                element.parent.foreign_keys.discard(element)
+                table.foreign_keys.discard(element)
+    return metadata
+
+
+def init_shards() -> dict:
+    """
+    Create the sharded tables on every shard and move the id tickets
+    past the ids already in use anywhere
+    """
+    metadata = shard_metadata()
+    maximums = {model.__tablename__: 0 for model in ALLOCATED_MODELS}
+    for shard_engine in [engine, *shard_engines.values()]:
+        if shard_engine is not engine:
+            metadata.create_all(shard_engine)
+        with shard_engine.connect() as connection:
+            for model in ALLOCATED_MODELS:
+                table = model.__table__
+                value = connection.scalar(select(func.max(table.c.id))) or 0
+                maximums[table.name] = max(maximums[table.name], value)
+    # Tickets never move backwards
+    greatest = func.max if engine.dialect.name == "sqlite" else func.greatest
+    with Session(engine) as session:
+        for name, maximum in maximums.items():
+            statement = dialect_insert(session, IdTicket).values(
+                name=name, next_id=maximum + 1
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[IdTicket.name],
+                set_={
+                    "next_id": greatest(
+                        IdTicket.next_id, statement.excluded.next_id
+                    )
+                },
+            )
+            session.execute(statement)
+        session.commit()
+    return {"shards": list(shard_engines), "next_ids": {
+        name: maximum + 1 for name, maximum in maximums.items()
+    }}
+
+
+def shard_status() -> dict:
+    with Session(engine) as session:
+        statement = select(ProjectShard.shard, func.count()).group_by(
+            ProjectShard.shard
+        )
+        projects = dict(session.execute(statement).all())
+    status = {}
+    for shard, shard_engine in shard_engines.items():
+        with shard_engine.connect() as connection:
+            accounts = connection.scalar(
+                select(func.count()).select_from(Account.__table__)
+            )
+        status[shard] = {
+            "projects": projects.get(shard, 0),
+            "accounts": accounts,
+        }
+    return status
+
+
+def _project_rows(project_id: int) -> list:
+    """
+    (table, criteria) selecting a project's rows, parents first
+    """
+    accounts = select(Account.__table__.c.id).where(
+        Account.__table__.c.project_id == project_id
+    )
+    rows = []
+    for model in SHARDED_MODELS:
+        table = model.__table__
+        if model is Project:
+            criteria = table.c.id == project_id
+        elif "project_id" in table.c:
+            criteria = table.c.project_id == project_id
+        else:
+            criteria = table.c.account_id.in_(accounts)
+        rows.append((table, criteria))
+    return rows
+
+
+def move_project(project_id: int, target: str) -> dict:
+    """
+    Copy a project's rows to the target shard, point the directory to
+    it and delete them from the source. Requests for the project get a
+    503 while it moves. The project row stays locked on the source from
+    before copying until the rows are deleted, so writes of requests
+    that resolved the source shard either finish before the copy or wait
+    and find the project moved (see _lock_project).
+    """
+    if target not in shard_engines:
+        raise ValueError(f"Unknown shard {target}")
+    with Session(engine) as session:
+        entry = session.get(ProjectShard, project_id)
+        if entry is None:
+            raise LookupError(f"Project {project_id} is not in the directory")
+        if entry.shard == target:
+            return {"project_id": project_id, "shard": target, "rows": {}}
+        if entry.moving:
+            raise RuntimeError(f"Project {project_id} is already moving")
+        source = entry.shard
+        entry.moving = True
+        session.add(entry)
+        session.commit()
+
+    def finish(shard: str) -> None:
+        with Session(engine) as session:
+            session.execute(
+                update(ProjectShard)
+                .where(ProjectShard.project_id == project_id)
+                .values(shard=shard, moving=False)
+            )
+            session.commit()
+
+    copied = {}
+    with shard_engines[source].begin() as source_connection:
+        try:
+            source_connection.execute(
+                select(Project.__table__.c.id)
+                .where(Project.__table__.c.id == project_id)
+                .with_for_update()
+            )
+            with shard_engines[target].begin() as target_connection:
+                for table, criteria in _project_rows(project_id):
+                    rows = source_connection.execute(
+                        select(table).where(criteria)
+                    ).mappings().all()
+                    if rows:
+                        target_connection.execute(
+                            insert(table), [dict(row) for row in rows]
+                        )
+                    copied[table.name] = len(rows)
+        except Exception:
+            finish(source)
+            raise
+        finish(target)
+        for table, criteria in reversed(_project_rows(project_id)):
+            source_connection.execute(delete(table).where(criteria))
+    return {
+        "project_id": project_id,
+        "source": source,
+        "shard": target,
+        "rows": copied,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Shard maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="create shard schemas and id tickets")
+    commands.add_parser("status", help="projects and accounts per shard")
+    move = commands.add_parser("move", help="move a project to a shard")
+    move.add_argument("project_id", type=int)
+    move.add_argument("shard")
+    args = parser.parse_args()
+    if not enabled:
+        parser.error("sharding is disabled, set SHARD_URLS")
+
+    if args.command == "init":
+        print(json.dumps(init_shards()))
+    elif args.command == "status":
+        print(json.dumps(shard_status(), indent=2))
+    else:
+        try:
+            print(json.dumps(move_project(args.project_id, args.shard)))
+        except (LookupError, ValueError, RuntimeError) as error:
+            parser.error(str(error))
@@ -0,0 +1,301 @@
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import delete, func, insert
+from sqlmodel import Session, select
+from database import dialect_insert
+from models import (
+    Account,
+    Partner,
+    Project,
+    ProjectSummary,
+    ProjectCurrencyTotal,
+    ProjectSummaryRead,
+)
+
+
+def apply_summary_delta(
+    session: Session,
+    project_id: int,
+    accounts: int = 0,
+    partners: int = 0,
+) -> None:
+    """
+    Add deltas to the project summary row, creating it when missing.
+    Runs inside the caller's transaction, before its commit.
+    """
+    table = ProjectSummary.__table__
+    statement = dialect_insert(session, ProjectSummary).values(
+        project_id=project_id,
+        account_count=accounts,
+        partner_count=partners,
+        updated_at=datetime.now(),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.project_id],
+        set_={
+            "account_count": table.c.account_count
+            + statement.excluded.account_count,
+            "partner_count": table.c.partner_count
+            + statement.excluded.partner_count,
+            "updated_at": statement.excluded.updated_at,
+        },
+    )
+    session.execute(statement)
+
+
+def apply_total_delta(
+    session: Session,
+    project_id: int,
+    currency_id: int,
+    accounts: int = 0,
+    amount: Decimal = Decimal(0),
+) -> None:
+    table = ProjectCurrencyTotal.__table__
+    statement = dialect_insert(session, ProjectCurrencyTotal).values(
+        project_id=project_id,
+        currency_id=currency_id,
+        account_count=accounts,
+        amount=amount,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.project_id, table.c.currency_id],
+        set_={
+            "account_count": table.c.account_count
+            + statement.excluded.account_count,
+            "amount": table.c.amount + statement.excluded.amount,
+        },
+    )
+    session.execute(statement)
+
+
+def account_created(session: Session, account: Account) -> None:
+    apply_summary_delta(session, account.project_id, accounts=1)
+    apply_total_delta(
+        session,
+        account.project_id,
+        account.currency_id,
+        accounts=1,
+        amount=account.amount,
+    )
+
+
+def account_amount_changed(
+    session: Session, account: Account, old_amount: Decimal
+) -> None:
+    apply_summary_delta(session, account.project_id)
+    apply_total_delta(
+        session,
+        account.project_id,
+        account.currency_id,
+        amount=Decimal(account.amount) - Decimal(old_amount),
+    )
+
+
+def account_deleted(session: Session, account: Account) -> None:
+    apply_summary_delta(
+        session,
+        account.project_id,
+        accounts=-1,
+        partners=-len(account.partners or []),
+    )
+    apply_total_delta(
+        session,
+        account.project_id,
+        account.currency_id,
+        accounts=-1,
+        amount=-Decimal(account.amount),
+    )
+
+
+def get_project_summary(
+    session: Session, project_id: int
+) -> ProjectSummaryRead:
+    summary = session.get(ProjectSummary, project_id)
+    statement = select(ProjectCurrencyTotal).filter(
+        ProjectCurrencyTotal.project_id == project_id
+    )
+    totals = session.exec(statement).all()
+    if not summary:
+        return ProjectSummaryRead(project_id=project_id, totals=totals)
+    return ProjectSummaryRead(
+        project_id=project_id,
+        account_count=summary.account_count,
+        partner_count=summary.partner_count,
+        updated_at=summary.updated_at,
+        totals=totals,
+    )
+
+
+def delete_project_summary(session: Session, project_id: int) -> None:
+    session.execute(
+        delete(ProjectCurrencyTotal).where(
+            ProjectCurrencyTotal.project_id == project_id
+        )
+    )
+    session.execute(
+        delete(ProjectSummary).where(ProjectSummary.project_id == project_id)
+    )
+
+
+def compute_summaries(
+    session: Session, project_id: int | None = None
+) -> tuple[dict, dict]:
+    """
+    Aggregate summaries from the base tables. Returns
+    ({project_id: (accounts, partners)},
+     {(project_id, currency_id): (accounts, amount)}).
+    """
+    projects = select(Project.id)
+    accounts = select(
+        Account.project_id,
+        Account.currency_id,
+        func.count(Account.id),
+        func.coalesce(func.sum(Account.amount), 0),
+    ).group_by(Account.project_id, Account.currency_id)
+    partners = (
+        select(Account.project_id, func.count(Partner.id))
+        .join(Partner, Partner.account_id == Account.id)
+        .group_by(Account.project_id)
+    )
+    if project_id is not None:
+        projects = projects.filter(Project.id == project_id)
+        accounts = accounts.filter(Account.project_id == project_id)
+        partners = partners.filter(Account.project_id == project_id)
+
+    summaries = {id: [0, 0] for id in session.exec(projects).all()}
+    totals = {}
+    for project, currency, count, amount in session.execute(accounts):
+        summaries.setdefault(project, [0, 0])[0] += count
+        totals[(project, currency)] = (count, Decimal(amount))
+    for project, count in session.execute(partners):
+        summaries.setdefault(project, [0, 0])[1] = count
+    summaries = {key: tuple(value) for key, value in summaries.items()}
+    return summaries, totals
+
+
+def rebuild_summaries(
+    session: Session, project_id: int | None = None
+) -> dict:
+    summaries, totals = compute_summaries(session, project_id)
+    clear_totals = delete(ProjectCurrencyTotal)
+    clear_summaries = delete(ProjectSummary)
+    if project_id is not None:
+        clear_totals = clear_totals.where(
+            ProjectCurrencyTotal.project_id == project_id
+        )
+        clear_summaries = clear_summaries.where(
+            ProjectSummary.project_id == project_id
+        )
+    session.execute(clear_totals)
+    session.execute(clear_summaries)
+    now = datetime.now()
+    if summaries:
+        session.execute(
+            insert(ProjectSummary),
+            [
+                {
+                    "project_id": project,
+                    "account_count": accounts,
+                    "partner_count": partners,
+                    "updated_at": now,
+                }
+                for project, (accounts, partners) in summaries.items()
+            ],
+        )
+    if totals:
+        session.execute(
+            insert(ProjectCurrencyTotal),
+            [
+                {
+                    "project_id": project,
+                    "currency_id": currency,
+                    "account_count": accounts,
+                    "amount": amount,
+                }
+                for (project, currency), (accounts, amount) in totals.items()
+            ],
+        )
+    session.commit()
+    return {"projects": len(summaries), "totals": len(totals)}
+
+
+def check_summaries(
+    session: Session, project_id: int | None = None
+) -> list[dict]:
+    """
+    Compare stored summaries with freshly aggregated ones and
+    return one entry per mismatching row.
+    """
+    summaries, totals = compute_summaries(session, project_id)
+    stored_summaries = select(ProjectSummary)
+    stored_totals = select(ProjectCurrencyTotal)
+    if project_id is not None:
+        stored_summaries = stored_summaries.filter(
+            ProjectSummary.project_id == project_id
+        )
+        stored_totals = stored_totals.filter(
+            ProjectCurrencyTotal.project_id == project_id
+        )
+    stored = {
+        row.project_id: (row.account_count, row.partner_count)
+        for row in session.exec(stored_summaries).all()
+    }
+    stored_amounts = {
+        (row.project_id, row.currency_id): (row.account_count, row.amount)
+        for row in session.exec(stored_totals).all()
+    }
+
+    mismatches = []
+    for project in summaries.keys() | stored.keys():
+        expected = summaries.get(project, (0, 0))
+        actual = stored.get(project, (0, 0))
+        if expected != actual:
+            mismatches.append({
+                "project_id": project,
+                "expected": {
+                    "account_count": expected[0],
+                    "partner_count": expected[1],
+                },
+                "actual": {
+                    "account_count": actual[0],
+                    "partner_count": actual[1],
+                },
+            })
+    for key in totals.keys() | stored_amounts.keys():
+        expected = totals.get(key, (0, Decimal(0)))
+        actual = stored_amounts.get(key, (0, Decimal(0)))
+        if expected[0] != actual[0] or Decimal(expected[1]) != actual[1]:
+            mismatches.append({
+                "project_id": key[0],
+                "currency_id": key[1],
+                "expected": {
+                    "account_count": expected[0],
+                    "amount": str(expected[1]),
+                },
+                "actual": {
+                    "account_count": actual[0],
+                    "amount": str(actual[1]),
+                },
+            })
+    return mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from database import engine
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild or check the project summary tables"
+    )
+    parser.add_argument("command", choices=["rebuild", "check"])
+    parser.add_argument("--project", type=int, default=None)
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        if args.command == "rebuild":
+            print(json.dumps(rebuild_summaries(session, args.project)))
+        else:
+            mismatches = check_summaries(session, args.project)
+            print(json.dumps(mismatches, indent=2))
+            raise SystemExit(1 if mismatches else 0)
@@ -1,5 +1,7 @@
 from fastapi.testclient import TestClient
+import asyncio
 import warnings
+from contextlib import contextmanager
 
 from main import app
 
@@ -7,8 +9,1176 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", module="passlib")
 
 client = TestClient(app)
+# Bearer token for routes whose user is overridden by app_database
+AUTH = {"Authorization": "Bearer test"}
+
+
+def memory_engine():
+    """
+    Engine on an in-memory SQLite database with every table
+    """
+    from sqlalchemy.pool import StaticPool
+    from sqlmodel import SQLModel, create_engine
+
+    memory = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    SQLModel.metadata.create_all(memory)
+    return memory
+
+
+@contextmanager
+def app_database(memory=None):
+    """
+    The app on an in-memory database holding an owner and another user,
+    a project of the owner and reference data. Requests are made as
+    users["current"], the owner to begin with.
+    """
+    from sqlmodel import Session
+    from database import get_session
+    from models import Bank, Country, Currency, Project, User
+    from replicas import get_read_session
+    from security import get_current_active_user
+
+    memory = memory or memory_engine()
+    with Session(memory, expire_on_commit=False) as session:
+        users = {
+            "owner": User(username="owner", password="x"),
+            "other": User(username="other", password="x"),
+        }
+        session.add_all(users.values())
+        session.add_all([
+            Bank(name="Bank"),
+            Country(name="Country"),
+            Currency(name="Peso", code="MXN"),
+            Currency(name="Dollar", code="USD"),
+        ])
+        session.flush()
+        session.add(Project(id=1, name="Books", owner_id=users["owner"].id))
+        session.commit()
+    users["current"] = users["owner"]
+
+    def memory_session():
+        with Session(memory, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = memory_session
+    app.dependency_overrides[get_read_session] = memory_session
+    app.dependency_overrides[get_current_active_user] = (
+        lambda: users["current"]
+    )
+    try:
+        yield memory, users
+    finally:
+        app.dependency_overrides.clear()
+
+
+def new_account(name: str, amount: str, currency_id: int = 1) -> dict:
+    return {
+        "name": name,
+        "account_number": name,
+        "alias": name,
+        "amount": amount,
+        "project_id": 1,
+        "bank_id": 1,
+        "currency_id": currency_id,
+        "country_id": 1,
+    }
+
 
 def test_ping():
     response = client.get("/ping")
     assert response.status_code == 200
     assert response.json() == {"ping": "pong"}
+
+
+def test_metrics():
+    client.get("/ping")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert (
+        'http_requests_total{method="GET",route="/ping",status="200"}'
+        in response.text
+    )
+    assert "http_request_duration_seconds_bucket" in response.text
+
+
+def test_loop_monitor_strict():
+    import time
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI
+    from loop_monitor import LoopMonitor, LoopMonitorMiddleware
+
+    monitor = LoopMonitor(threshold=0.05, strict=True)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await monitor.start()
+        yield
+        await monitor.stop()
+
+    blocking_app = FastAPI(lifespan=lifespan)
+    blocking_app.add_middleware(LoopMonitorMiddleware, monitor=monitor)
+
+    @blocking_app.get("/blocking")
+    async def blocking():
+        time.sleep(0.3)
+        return {"ok": True}
+
+    @blocking_app.get("/sleeping")
+    async def sleeping():
+        await asyncio.sleep(0.3)
+        return {"ok": True}
+
+    with TestClient(blocking_app) as blocking_client:
+        assert blocking_client.get("/sleeping").status_code == 200
+        assert blocking_client.get("/blocking").status_code == 500
+
+
+def test_idempotency_key():
+    from fastapi import FastAPI, HTTPException
+    from cache import TTLCache
+    from idempotency import IdempotencyMiddleware
+    import deadlines
+    from security import create_user_access_token
+
+    class LeaseCache(TTLCache):
+        def add(self, key, value, ttl=None):
+            leases.append(ttl)
+            return super().add(key, value, ttl)
+
+    created = []
+    leases = []
+    store = LeaseCache(ttl=86400)
+    idempotent_app = FastAPI()
+    idempotent_app.add_middleware(IdempotencyMiddleware, store=store)
+
+    @idempotent_app.post("/items")
+    async def create_item(item: dict):
+        created.append(item)
+        return {"id": len(created)}
+
+    attempts = []
+
+    @idempotent_app.post("/limited")
+    async def limited_item():
+        attempts.append(True)
+        if len(attempts) == 1:
+            raise HTTPException(status_code=429, detail="Too many requests")
+        return {"ok": True}
+
+    token = create_user_access_token({"sub": "someone", "scopes": ["me"]})
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "k1"}
+    with TestClient(idempotent_app) as retry_client:
+        first = retry_client.post("/items", json={"a": 1}, headers=headers)
+        retry = retry_client.post("/items", json={"a": 1}, headers=headers)
+        other = retry_client.post("/items", json={"a": 2}, headers=headers)
+        headers["Idempotency-Key"] = "k2"
+        limited = retry_client.post("/limited", headers=headers)
+        after_limit = retry_client.post("/limited", headers=headers)
+    assert first.json() == retry.json() == {"id": 1}
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert other.status_code == 422
+    assert len(created) == 1
+    # In-flight markers get a short lease, responses the full ttl
+    assert max(leases) <= deadlines.longest_budget() < store.ttl
+    # The 429 is not replayed, the retry runs the request
+    assert limited.status_code == 429
+    assert after_limit.status_code == 200
+    assert "idempotent-replayed" not in after_limit.headers
+
+
+def test_rate_limit():
+    from fastapi import Depends, FastAPI
+    from ratelimit import Limit, MemoryBackend, RateLimiter, rate_limit
+
+    limiter = RateLimiter({"default": Limit(2, 60)}, MemoryBackend())
+    limited_app = FastAPI()
+
+    @limited_app.get(
+        "/limited", dependencies=[Depends(rate_limit("test", limiter))]
+    )
+    async def limited():
+        return {"ok": True}
+
+    with TestClient(limited_app) as limited_client:
+        first = limited_client.get("/limited")
+        limited_client.get("/limited")
+        rejected = limited_client.get("/limited")
+    assert first.status_code == 200
+    assert first.headers["ratelimit-limit"] == "2"
+    assert first.headers["ratelimit-remaining"] == "1"
+    assert rejected.status_code == 429
+    assert rejected.headers["retry-after"] == "30"
+
+
+def test_load_shedding():
+    import pytest
+    from load_shedding import (
+        AdaptiveLimiter, BULK, CRITICAL, EXEMPT, NORMAL, Overloaded, classify,
+    )
+
+    assert classify({"path": "/ping", "method": "GET"}) == EXEMPT
+    assert classify({"path": "/token", "method": "POST"}) == CRITICAL
+
+    async def scenario():
+        limiter = AdaptiveLimiter(
+            initial=2, minimum=1, queue_size=1, queue_timeout=0.1
+        )
+        await limiter.acquire(NORMAL)
+        await limiter.acquire(BULK)
+        waiting = asyncio.create_task(limiter.acquire(NORMAL))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await limiter.acquire(BULK)
+        limiter.release(BULK, 0.01, False)
+        await waiting
+        grown = limiter.limit
+        limiter.release(NORMAL, 1.0, False)
+        assert limiter.limit < grown
+
+        # Logins count against the limit but go ahead of queued requests
+        limiter = AdaptiveLimiter(
+            initial=1, minimum=1, maximum=1, queue_size=2
+        )
+        await limiter.acquire(NORMAL)
+        normal = asyncio.create_task(limiter.acquire(NORMAL))
+        await asyncio.sleep(0)
+        login = asyncio.create_task(limiter.acquire(CRITICAL))
+        await asyncio.sleep(0)
+        assert not login.done()
+        limiter.release(NORMAL, 0.01, False)
+        await login
+        assert not normal.done()
+        limiter.release(CRITICAL, 0.01, False)
+        await normal
+
+    asyncio.run(scenario())
+
+
+def test_single_flight():
+    import threading
+    from coalesce import SingleFlight
+
+    calls = []
+    release = threading.Event()
+
+    def read(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    async def scenario():
+        flight = SingleFlight("test")
+        reads = [
+            asyncio.create_task(flight.do(("key",), read, 21))
+            for _ in range(5)
+        ]
+        other = asyncio.create_task(flight.do(("other",), read, 1))
+        await asyncio.sleep(0.1)
+        release.set()
+        assert await asyncio.gather(*reads) == [42] * 5
+        assert await other == 2
+        assert flight.in_flight() == 0
+
+    asyncio.run(scenario())
+    assert sorted(calls) == [1, 21]
+
+
+def test_query_cache():
+    from sqlalchemy.pool import StaticPool
+    from sqlmodel import Session, SQLModel, create_engine, select
+    from models import Project, User
+    from query_cache import QueryCache
+
+    memory_engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    SQLModel.metadata.create_all(
+        memory_engine, tables=[User.__table__, Project.__table__]
+    )
+    cache = QueryCache(max_rows=10, ttl=60)
+    statement = select(Project)
+    with Session(memory_engine) as session:
+        session.add(User(username="owner", password="x"))
+        session.add(Project(name="first", owner_id=1))
+        session.commit()
+    with Session(memory_engine) as session:
+        first = cache.fetch(session, statement)
+        assert cache.fetch(session, statement) == first
+        assert len(cache) == 1
+    with Session(memory_engine) as session:
+        session.add(Project(name="second", owner_id=1))
+        # Pending writes of the session bypass the cache
+        assert len(cache.fetch(session, statement)) == 2
+        session.commit()
+    with Session(memory_engine) as session:
+        assert len(cache.fetch(session, statement)) == 2
+
+
+def test_shared_cache(tmp_path):
+    from cache import (
+        Channel, LocalBackend, MmapBackend, RedisBackend, SharedCache
+    )
+
+    for backend in (
+        LocalBackend(),
+        MmapBackend(str(tmp_path / "cache"), slots=64, slot_size=512),
+    ):
+        shared = SharedCache("test", backend, ttl=60)
+        shared.set(("user", 1), {"sub": "admin"})
+        assert shared.get(("user", 1)) == {"sub": "admin"}
+        assert not shared.add(("user", 1), None)
+        assert shared.pop(("user", 1)) == {"sub": "admin"}
+        assert shared.get(("user", 1)) is None
+        assert shared.add(("user", 1), "in-flight")
+        assert len(shared) == 1
+        shared.clear()
+        assert len(shared) == 0
+
+        # Each Channel stands for a worker
+        worker, other = Channel(backend), Channel(backend)
+        other.publish("table:project")
+        worker.publish("table:account")
+        assert worker.receive() == ["table:project"]
+        assert worker.receive() == []
+
+    # Stream commands of the Redis client, with exact trimming
+    class StreamClient:
+        def __init__(self):
+            self.entries = []
+            self.sequence = 0
+
+        def xadd(self, name, fields, maxlen, approximate):
+            self.sequence += 1
+            entry_id = f"1-{self.sequence}".encode()
+            self.entries.append((entry_id, fields, self.sequence))
+            del self.entries[:-maxlen]
+
+        def xrange(self, name, count):
+            return [entry[:2] for entry in self.entries[:count]]
+
+        def xrevrange(self, name, count):
+            return [entry[:2] for entry in self.entries[::-1][:count]]
+
+        def xread(self, streams):
+            after = int(streams[RedisBackend.CHANNEL].split(b"-")[1])
+            entries = [
+                entry[:2] for entry in self.entries if entry[2] > after
+            ]
+            return [(RedisBackend.CHANNEL, entries)] if entries else []
+
+    backend = RedisBackend(channel_size=3, client=StreamClient())
+    backend.publish(b"start")
+    worker, other = Channel(backend), Channel(backend)
+    other.publish("table:project")
+    worker.publish("table:account")
+    assert worker.receive() == ["table:project"]
+    assert worker.receive() == []
+    for _ in range(3):
+        other.publish("table:account")
+    # The stream dropped messages the worker had not read
+    assert worker.receive() is None
+    assert worker.receive() == []
+    other.publish("table:partner")
+    assert worker.receive() == ["table:partner"]
+
+    # A second mapping of the file sees the entries of the first
+    first = MmapBackend(str(tmp_path / "cache"), slots=64, slot_size=512)
+    SharedCache("test", first).set("token", "payload")
+    second = MmapBackend(str(tmp_path / "cache"), slots=64, slot_size=512)
+    assert SharedCache("test", second).get("token") == "payload"
+
+
+def test_request_deadline():
+    import time
+    from fastapi import FastAPI
+    from sqlalchemy import text
+    from sqlmodel import Session, create_engine
+    import deadlines
+
+    slow_engine = create_engine("sqlite://")
+    deadlines.instrument_engine(slow_engine)
+    deadline_app = FastAPI()
+    deadline_app.add_middleware(deadlines.DeadlineMiddleware)
+
+    @deadline_app.get("/slow")
+    def slow():
+        with Session(slow_engine) as session:
+            return session.execute(text(
+                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL "
+                "SELECT i + 1 FROM n WHERE i < 100000000) "
+                "SELECT count(*) FROM n"
+            )).scalar()
+
+    with TestClient(deadline_app) as deadline_client:
+        start = time.monotonic()
+        response = deadline_client.get(
+            "/slow", headers={"X-Request-Timeout": "0.2"}
+        )
+    assert response.status_code == 504
+    assert time.monotonic() - start < 2
+
+
+def test_deadline_work_after_response():
+    import deadlines
+
+    finished = []
+
+    async def slow_tail(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200})
+        await send({"type": "http.response.body", "body": b"ok"})
+        # Like a sampled profile report saved after the response
+        await asyncio.sleep(0.05)
+        finished.append(True)
+
+    async def scenario():
+        complete = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b""}
+            # uvicorn reports a disconnect once the response is complete
+            await complete.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                complete.set()
+
+        scope = {"type": "http", "method": "GET", "path": "/", "headers": []}
+        await deadlines.DeadlineMiddleware(slow_tail)(scope, receive, send)
+
+    asyncio.run(scenario())
+    assert finished == [True]
+    assert deadlines.expired_requests.value(("disconnect",)) == 0
+
+
+def test_profiling(monkeypatch, tmp_path):
+    import json
+    import threading
+    import time
+    from fastapi import FastAPI
+    from sqlalchemy import text
+    from sqlmodel import Session, create_engine
+    from models import User
+    import profiling
+    from security import create_user_access_token
+
+    profiled_engine = create_engine("sqlite://")
+    profiling.instrument_engine(profiled_engine)
+    profiled_app = FastAPI()
+
+    @profiled_app.get("/count", status_code=201)
+    def count():
+        with Session(profiled_engine) as session:
+            return {"count": session.execute(text("SELECT 1")).scalar()}
+
+    @profiled_app.get("/busy")
+    def busy():
+        with Session(profiled_engine) as session:
+            session.execute(text("SELECT 1"))
+        spin(0.2)
+
+    def spin(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    users = {
+        name: User(username=name, password="x", is_superuser=superuser)
+        for name, superuser in (("admin", True), ("user", False))
+    }
+    monkeypatch.setattr(profiling, "get_user", users.get)
+
+    def headers(name, scopes):
+        token = create_user_access_token({"sub": name, "scopes": scopes})
+        return {"Authorization": f"Bearer {token}", "X-Profile": "1"}
+
+    on_demand = profiling.ProfilingMiddleware(profiled_app, sample_rate=0)
+    with TestClient(on_demand) as profiled_client:
+        # Everyone else gets the normal response
+        for name, scopes in (("user", ["superuser"]), ("admin", ["me"])):
+            response = profiled_client.get(
+                "/count", headers=headers(name, scopes)
+            )
+            assert response.status_code == 201
+            assert response.json() == {"count": 1}
+        response = profiled_client.get(
+            "/count", headers=headers("admin", ["superuser"])
+        )
+    assert response.status_code == 201
+    report = response.json()
+    assert report["response"] == {"count": 1}
+    assert (report["method"], report["route"]) == ("GET", "/count")
+    assert report["status_code"] == 201
+    assert report["concurrent_requests"] == 0
+    assert [item["statement"] for item in report["sql"]] == ["SELECT 1"]
+    assert "count (test_api.py" in report["sql"][0]["caller"]
+    assert isinstance(report["tree"], list)
+    assert set(report) >= {"duration_ms", "samples", "sql_ms"}
+
+    def functions(nodes):
+        for node in nodes:
+            yield node["function"].split(" ")[0]
+            yield from functions(node["children"])
+
+    # Only the threads of the request are sampled
+    def distract():
+        spin(1)
+
+    distraction = threading.Thread(target=distract)
+    distraction.start()
+    with TestClient(on_demand) as profiled_client:
+        response = profiled_client.get(
+            "/busy", headers=headers("admin", ["superuser"])
+        )
+    distraction.join()
+    names = set(functions(response.json()["tree"]))
+    assert "busy" in names and "spin" in names
+    assert "distract" not in names
+
+    monkeypatch.setattr(profiling, "PROFILE_RETENTION", 2)
+    sampled = profiling.ProfilingMiddleware(
+        profiled_app, sample_rate=2, directory=str(tmp_path)
+    )
+    with TestClient(sampled) as profiled_client:
+        for _ in range(6):
+            response = profiled_client.get("/count")
+            assert response.json() == {"count": 1}
+    # 3 of the 6 requests saved, the newest 2 kept
+    profiles = sorted(tmp_path.iterdir())
+    assert len(profiles) == 2
+    with open(profiles[-1]) as profile_file:
+        assert json.load(profile_file)["route"] == "/count"
+
+
+def test_memory_diagnostics():
+    import tracemalloc
+    from models import User
+    import memory
+    from security import get_current_user
+
+    user = User(username="admin", password="x", is_superuser=True)
+    app.dependency_overrides[get_current_user] = lambda: user
+    try:
+        response = client.post("/admin/memory/tracemalloc/start", headers=AUTH)
+        assert response.json()["tracing"] is True
+        first = client.post("/admin/memory/snapshots", headers=AUTH).json()
+        retained = [bytearray(1024) for _ in range(1000)]
+        second = client.post("/admin/memory/snapshots", headers=AUTH).json()
+        assert [
+            snapshot["id"]
+            for snapshot in client.get(
+                "/admin/memory/snapshots", headers=AUTH
+            ).json()
+        ][-2:] == [first["id"], second["id"]]
+        diff = client.get(
+            f"/admin/memory/snapshots/{first['id']}/diff/{second['id']}",
+            params={"limit": 5},
+            headers=AUTH,
+        ).json()
+        assert diff[0]["size_diff"] >= 1024 * 1000
+        assert "test_api.py" in diff[0]["site"][0]
+        assert client.get(
+            f"/admin/memory/snapshots/{second['id'] + 1}", headers=AUTH
+        ).status_code == 404
+        objects = client.get("/admin/memory/objects", headers=AUTH).json()
+        assert "User" in objects["instances"]
+        response = client.post("/admin/memory/tracemalloc/stop", headers=AUTH)
+        assert response.json() == {"tracing": False}
+        # Snapshots need tracemalloc running
+        assert client.post(
+            "/admin/memory/snapshots", headers=AUTH
+        ).status_code == 409
+        del retained
+
+        user.is_superuser = False
+        for method, path in (
+            ("post", "/admin/memory/tracemalloc/start"),
+            ("get", "/admin/memory/snapshots"),
+            ("get", "/admin/memory/objects"),
+        ):
+            response = getattr(client, method)(path, headers=AUTH)
+            assert response.status_code == 403
+        assert not tracemalloc.is_tracing()
+    finally:
+        app.dependency_overrides.clear()
+        memory.stop_tracing()
+        memory.clear_snapshots()
+
+
+def test_project_summaries():
+    from decimal import Decimal
+    from sqlmodel import Session
+    from models import ProjectCurrencyTotal, ProjectSummary
+    import summary
+
+    with app_database() as (memory, users):
+        for account in (
+            new_account("cash", "100"),
+            new_account("bank", "50"),
+            new_account("dollars", "10", currency_id=2),
+        ):
+            assert client.post(
+                "/accounts/1", json=account, headers=AUTH
+            ).status_code == 200
+        for name in ("ana", "luis"):
+            assert client.post(
+                "/accounts/partners/1/1",
+                json={"name": name, "percentage": "50"},
+                headers=AUTH,
+            ).status_code == 200
+        client.patch("/accounts/1/2", json={"amount": "70"}, headers=AUTH)
+        client.patch(
+            "/accounts/partners/1/1/1",
+            json={"description": "no summary change"},
+            headers=AUTH,
+        )
+        client.delete("/accounts/partners/1/1/1", headers=AUTH)
+        client.delete("/accounts/1/3", headers=AUTH)
+
+        with Session(memory) as session:
+            assert summary.check_summaries(session) == []
+            stored = session.get(ProjectSummary, 1)
+            assert (stored.account_count, stored.partner_count) == (2, 1)
+            pesos = session.get(ProjectCurrencyTotal, (1, 1))
+            assert (pesos.account_count, pesos.amount) == (2, Decimal(170))
+            dollars = session.get(ProjectCurrencyTotal, (1, 2))
+            assert (dollars.account_count, dollars.amount) == (0, 0)
+
+            session.delete(stored)
+            session.commit()
+            assert summary.check_summaries(session) != []
+            assert summary.rebuild_summaries(session) == {
+                "projects": 1, "totals": 1,
+            }
+            assert summary.check_summaries(session) == []
+
+
+def test_insert_unique():
+    import pytest
+    from sqlalchemy import create_mock_engine
+    from sqlmodel import Session, func, select
+    from database import check_dialects, insert_unique
+    from models import Bank
+
+    memory = memory_engine()
+    with Session(memory) as session:
+        assert insert_unique(session, Bank(name="Bank", code="B1")).id
+        assert insert_unique(session, Bank(name="Bank", code="B2")) is None
+        session.commit()
+        assert session.exec(select(func.count(Bank.id))).one() == 1
+
+    with pytest.raises(ValueError):
+        check_dialects([create_mock_engine("mysql://db/app", None)])
+
+
+def test_create_user_conflict(monkeypatch):
+    from models import User
+    import routes.user
+    from security import get_current_user
+
+    hashed = []
+    monkeypatch.setattr(
+        routes.user, "get_password_hash",
+        lambda password: hashed.append(password) or "hash",
+    )
+    with app_database():
+        app.dependency_overrides[get_current_user] = lambda: User(
+            username="admin", password="x", is_superuser=True
+        )
+        for status in (200, 400):
+            response = client.post(
+                "/admin/users/",
+                json={"username": "ana", "password": "secret"},
+                headers=AUTH,
+            )
+            assert response.status_code == status
+    # The duplicate is refused before hashing its password
+    assert hashed == ["secret"]
+
+
+def test_update_returning_account():
+    with app_database() as (memory, users):
+        client.post("/accounts/1", json=new_account("cash", "5"), headers=AUTH)
+        change = {"description": "petty cash"}
+
+        users["current"] = users["other"]
+        for headers in (AUTH, {**AUTH, "If-Match": '"1"'}):
+            response = client.patch(
+                "/accounts/1/1", json=change, headers=headers
+            )
+            # Rows of other owners are not found, whatever the version
+            assert response.status_code == 404
+        assert client.get("/accounts/1/1", headers=AUTH).status_code == 403
+
+        users["current"] = users["owner"]
+        stale = client.patch(
+            "/accounts/1/1", json=change, headers={**AUTH, "If-Match": '"7"'}
+        )
+        assert stale.status_code == 412
+        missing = client.patch(
+            "/accounts/1/9", json=change, headers={**AUTH, "If-Match": '"1"'}
+        )
+        assert missing.status_code == 404
+        updated = client.patch(
+            "/accounts/1/1", json=change, headers={**AUTH, "If-Match": '"1"'}
+        )
+        assert updated.status_code == 200
+        assert updated.headers["ETag"] == '"2"'
+        assert updated.json()["version"] == 2
+        assert updated.json()["description"] == "petty cash"
+
+
+def test_ledger_balances(monkeypatch):
+    import time
+    from datetime import datetime
+    from decimal import Decimal
+    from sqlmodel import Session, func, select
+    from models import Account, BalanceSnapshot
+    import ledger
+
+    monkeypatch.setattr(ledger, "LEDGER_SNAPSHOT_INTERVAL", 3)
+    with app_database() as (memory, users):
+        client.post("/accounts/1", json=new_account("cash", "0"), headers=AUTH)
+        with Session(memory) as session:
+            account = session.get(Account, 1)
+            moments = []
+            for _ in range(7):
+                account.amount += 1
+                ledger.record_movement(session, account, Decimal(1))
+                time.sleep(0.001)
+                moments.append(datetime.now())
+                time.sleep(0.001)
+            session.commit()
+            # Snapshots after the 3rd and 6th movements
+            snapshots = select(func.count(BalanceSnapshot.id))
+            assert session.exec(snapshots).one() == 2
+            for movements, moment in enumerate(moments, start=1):
+                assert ledger.balances_at(session, [1], moment) == {
+                    1: Decimal(movements)
+                }
+
+
+def test_balance_series():
+    from datetime import date, timedelta
+
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    with app_database():
+        client.post(
+            "/accounts/1", json=new_account("cash", "100"), headers=AUTH
+        )
+        client.patch("/accounts/1/1", json={"amount": "130"}, headers=AUTH)
+        series = client.get(
+            "/accounts/ledger/1/series",
+            params={"start": str(yesterday), "end": str(today)},
+            headers=AUTH,
+        )
+        assert series.status_code == 200
+        assert [
+            (point["period"], point["currency_id"], float(point["balance"]))
+            for point in series.json()
+        ] == [(str(yesterday), 1, 0.0), (str(today), 1, 130.0)]
+        backwards = client.get(
+            "/accounts/ledger/1/series",
+            params={"start": str(today), "end": str(yesterday)},
+            headers=AUTH,
+        )
+        assert backwards.status_code == 400
+
+
+def test_transfers_are_atomic():
+    from sqlmodel import Session, func, select
+    from models import Account, LedgerEntry, Project
+    import summary
+
+    with app_database() as (memory, users):
+        with Session(memory) as session:
+            session.add(
+                Project(id=2, name="Other", owner_id=users["other"].id)
+            )
+            session.commit()
+        for account in (
+            new_account("cash", "100"),
+            new_account("bank", "50"),
+            new_account("dollars", "20", currency_id=2),
+            {**new_account("foreign", "10"), "project_id": 2},
+        ):
+            project_id = account["project_id"]
+            users["current"] = users["owner" if project_id == 1 else "other"]
+            client.post(f"/accounts/{project_id}", json=account, headers=AUTH)
+        users["current"] = users["owner"]
+
+        def state():
+            with Session(memory) as session:
+                return (
+                    [
+                        str(account.amount)
+                        for account in session.exec(
+                            select(Account).order_by(Account.id)
+                        ).all()
+                    ],
+                    session.exec(select(func.count(LedgerEntry.id))).one(),
+                    summary.get_project_summary(session, 1).model_dump(),
+                )
+
+        before = state()
+        valid = {"source_account_id": 1, "target_account_id": 2, "amount": "5"}
+        for invalid, status in (
+            ({**valid, "target_account_id": 99}, 404),
+            ({**valid, "target_account_id": 4}, 404),
+            ({**valid, "target_account_id": 3}, 400),
+        ):
+            response = client.post(
+                "/accounts/transfers/1",
+                json={"transfers": [valid, invalid]},
+                headers=AUTH,
+            )
+            assert response.status_code == status
+            assert state() == before
+
+        response = client.post(
+            "/accounts/transfers/1", json={"transfers": [valid]}, headers=AUTH
+        )
+        assert response.status_code == 200
+        amounts, entries, after = state()
+        assert amounts[:2] == ["95.00", "55.00"]
+        assert entries == before[1] + 2
+        assert after["totals"] == before[2]["totals"]
+        with Session(memory) as session:
+            assert summary.check_summaries(session) == []
+
+
+def test_sharding(monkeypatch):
+    import pytest
+    from decimal import Decimal
+    from fastapi import HTTPException, Request
+    from sqlalchemy.pool import StaticPool
+    from sqlmodel import Session, create_engine, select
+    import database
+    import ledger
+    import sharding
+    from models import (
+        Account, IdTicket, LedgerEntry, Project, ProjectShard, User
+    )
+
+    memory = memory_engine()
+    shards = {
+        name: create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        for name in ("shard0", "shard1")
+    }
+    monkeypatch.setattr(sharding, "engine", memory)
+    monkeypatch.setattr(sharding, "enabled", True)
+    for name, shard_engine in shards.items():
+        monkeypatch.setitem(database.shard_engines, name, shard_engine)
+    sharding.init_shards()
+
+    with sharding.ShardSession(expire_on_commit=False) as session:
+        with pytest.raises(sharding.ShardNotSelected):
+            session.get_bind(Account)
+        assert session.get_bind(User) is memory
+        project_id = sharding.new_project_id(session)
+        assert session.shard == "shard0"
+        assert session.get_bind(Account) is shards["shard0"]
+        assert session.get_bind(clause=select(Account)) is shards["shard0"]
+        with sharding.use_shard(session, "shard1"):
+            assert session.get_bind(LedgerEntry) is shards["shard1"]
+        session.add(Project(id=project_id, name="Books", owner_id=1))
+        account = Account(
+            **{**new_account("cash", "100"), "project_id": project_id}
+        )
+        session.add(account)
+        session.flush()
+        ledger.record_movement(session, account, account.amount)
+        session.commit()
+    # Ids come from blocks reserved in the global tickets
+    with Session(memory) as session:
+        assert session.get(ProjectShard, project_id).shard == "shard0"
+        for name in ("account", "ledger_entry"):
+            assert session.get(IdTicket, name).next_id > account.id
+
+    def shard_session(project_id: str):
+        request = Request({
+            "type": "http", "path_params": {"project_id": project_id}
+        })
+        return next(sharding.get_shard_session(request))
+
+    assert shard_session(str(project_id)).shard == "shard0"
+    with pytest.raises(HTTPException) as error:
+        shard_session("abc")
+    assert error.value.status_code == 422
+
+    # Resolved the source shard before the move, writes after it
+    stale = shard_session(str(project_id))
+    stale_account = stale.get(Account, account.id)
+    moved = sharding.move_project(project_id, "shard1")
+    assert moved["source"] == "shard0"
+    assert moved["rows"]["account"] == moved["rows"]["ledger_entry"] == 1
+    with shards["shard0"].connect() as connection:
+        assert connection.scalar(select(Account.id)) is None
+    session = shard_session(str(project_id))
+    assert session.shard == "shard1"
+    assert session.get(Account, account.id).amount == Decimal("100")
+    assert session.exec(
+        select(LedgerEntry.account_id)
+    ).all() == [account.id]
+    stale_account.amount = Decimal("1")
+    with pytest.raises(HTTPException) as error:
+        stale.commit()
+    assert error.value.status_code == 503
+    session.get(Account, account.id).amount = Decimal("90")
+    session.commit()
+    with shards["shard1"].connect() as connection:
+        assert connection.scalar(select(Account.amount)) == Decimal("90")
+    assert sharding.move_project(project_id, "shard1")["rows"] == {}
+    with pytest.raises(ValueError):
+        sharding.move_project(project_id, "shard2")
+
+
+def test_search_accounts(monkeypatch):
+    from sqlmodel import Session
+    from models import Account, Project
+    import search
+
+    monkeypatch.setattr(search, "index", search.AccountSearchIndex())
+    with app_database() as (memory, users):
+        with Session(memory) as session:
+            session.add(
+                Project(id=2, name="Other", owner_id=users["other"].id)
+            )
+            session.commit()
+        for account in (
+            new_account("petty cash", "1"),
+            new_account("cashbox", "1"),
+            new_account("cash", "1"),
+            {**new_account("CASH", "1"), "project_id": 2},
+        ):
+            project_id = account["project_id"]
+            users["current"] = users["owner" if project_id == 1 else "other"]
+            response = client.post(
+                f"/accounts/{project_id}", json=account, headers=AUTH
+            )
+            assert response.status_code == 200
+
+        def search_names(**params):
+            response = client.get(
+                "/search/accounts", params={"q": "cash", **params},
+                headers=AUTH,
+            )
+            assert response.status_code == 200
+            return [
+                (account["project_id"], account["name"])
+                for account in response.json()
+            ]
+
+        # Exact matches first, then prefixes, then substrings
+        assert search_names() == [(2, "CASH")]
+        users["current"] = users["owner"]
+        assert search_names() == [
+            (1, "cash"), (1, "cashbox"), (1, "petty cash")
+        ]
+        assert search_names(limit=1, offset=1) == [(1, "cashbox")]
+        assert search_names(project_id=1)[0] == (1, "cash")
+        response = client.get(
+            "/search/accounts", params={"q": "cash", "project_id": 2},
+            headers=AUTH,
+        )
+        assert response.status_code == 403
+
+        # Written without the routes, as another worker would
+        with Session(memory) as session:
+            session.add(Account(**new_account("cash desk", "1")))
+            session.commit()
+        assert (1, "cash desk") in search_names()
+
+
+def test_seed_datasets():
+    from sqlmodel import Session, func, select
+    from models import Country, Currency
+    from populate.seed import DATASETS, seed_datasets
+
+    memory = memory_engine()
+
+    def counts():
+        with Session(memory) as session:
+            return [
+                session.exec(select(func.count()).select_from(model)).one()
+                for model in (Country, Currency)
+            ]
+
+    # Created by admins: a dataset name without a code, and a dataset
+    # name under another code
+    countries, currencies = DATASETS["countries"][1], DATASETS["currencies"][1]
+    country_code, currency_code = next(iter(countries)), next(iter(currencies))
+    with Session(memory) as session:
+        session.add(Country(name=countries[country_code]))
+        session.add(Currency(name=currencies[currency_code], code="XXY"))
+        session.commit()
+
+    first = seed_datasets(engine=memory)
+    assert counts() == [len(countries), len(currencies)]
+    assert [
+        (result["inserted"], result["updated"], result["skipped"])
+        for result in first
+    ] == [
+        (len(countries) - 1, 1, []),
+        (len(currencies) - 1, 0, [currency_code]),
+    ]
+    with Session(memory) as session:
+        assert session.exec(
+            select(Country.code).filter(
+                Country.name == countries[country_code]
+            )
+        ).one() == country_code
+    before = counts()
+    second = seed_datasets(engine=memory)
+    assert counts() == before
+    assert [(result["inserted"], result["updated"]) for result in second] == [
+        (0, 0), (0, 0)
+    ]
+    assert second[1]["skipped"] == [currency_code]
+
+    # Renamed rows are restored, nothing is added
+    with Session(memory) as session:
+        country = session.exec(select(Country)).first()
+        country.name = "Renamed"
+        session.add(country)
+        session.commit()
+    assert seed_datasets(["countries"], engine=memory)[0]["updated"] == 1
+    assert counts() == before
+
+
+def test_etag_preconditions():
+    from models import User
+    from security import get_current_user
+
+    with app_database() as (memory, users):
+        client.post("/accounts/1", json=new_account("cash", "1"), headers=AUTH)
+        client.post(
+            "/accounts/partners/1/1",
+            json={"name": "ana", "percentage": "50"},
+            headers=AUTH,
+        )
+        for path, change in (
+            ("/projects/1", {"description": "Ledger"}),
+            ("/accounts/partners/1/1/1", {"description": "Founder"}),
+        ):
+            response = client.get(path, headers=AUTH)
+            assert response.status_code == 200
+            assert response.headers["ETag"] == '"1"'
+
+            for stale in ('"2"', 'W/"1"', "1"):
+                response = client.patch(
+                    path, json=change, headers={**AUTH, "If-Match": stale}
+                )
+                assert response.status_code == 412
+
+            response = client.patch(
+                path, json=change, headers={**AUTH, "If-Match": '"1"'}
+            )
+            assert response.status_code == 200
+            assert response.headers["ETag"] == '"2"'
+            assert response.json()["version"] == 2
+            response = client.get(path, headers=AUTH)
+            assert response.headers["ETag"] == '"2"'
+            assert response.json()["description"] == change["description"]
+
+            # Without a precondition any version is updated
+            response = client.patch(path, json=change, headers=AUTH)
+            assert response.headers["ETag"] == '"3"'
+
+        # Admin changes of a user invalidate its ETag too
+        app.dependency_overrides[get_current_user] = lambda: User(
+            username="admin", password="x", is_superuser=True
+        )
+        path = f"/admin/users/{users['owner'].id}"
+        etag = client.get(path, headers=AUTH).headers["ETag"]
+        for change_path, change in (
+            ("active", {"is_active": True}),
+            ("superuser", {"is_superuser": False}),
+            ("password", {"password": "secret"}),
+        ):
+            response = client.post(
+                f"/admin/users/{change_path}/{users['owner'].id}",
+                json=change,
+                headers=AUTH,
+            )
+            assert response.status_code == 200
+            response = client.patch(
+                path, json={"name": "Owner"},
+                headers={**AUTH, "If-Match": etag},
+            )
+            assert response.status_code == 412
+            etag = client.get(path, headers=AUTH).headers["ETag"]
+        assert etag == '"4"'
+        assert client.post(
+            "/admin/users/active/99", json={"is_active": False}, headers=AUTH
+        ).status_code == 404
+
+
+def test_read_replicas(monkeypatch):
+    import pytest
+    from sqlalchemy.exc import DBAPIError
+    from sqlmodel import Session
+    from starlette.requests import Request
+    from models import Project
+    import replicas
+    from security import create_user_access_token
+
+    replica = memory_engine()
+    with app_database() as (memory, users):
+        with Session(replica) as session:
+            session.add(
+                Project(id=1, name="Copy", owner_id=users["owner"].id)
+            )
+            session.commit()
+        del app.dependency_overrides[replicas.get_read_session]
+        monkeypatch.setattr(replicas, "engine", memory)
+        monkeypatch.setattr(
+            replicas, "replica_set", replicas.ReplicaSet([replica])
+        )
+        replicas.recent_writers.clear()
+        headers = {
+            "Authorization": "Bearer "
+            + create_user_access_token({"sub": users["owner"].username})
+        }
+
+        def read_name():
+            return client.get("/projects/1", headers=headers).json()["name"]
+
+        assert read_name() == "Copy"
+        assert client.patch(
+            "/projects/1", json={"description": "Ledger"}, headers=headers
+        ).status_code == 200
+        # The writer reads its write from the primary for a while
+        assert read_name() == "Books"
+        replicas.recent_writers.clear()
+        assert read_name() == "Copy"
+
+        # A replica lost mid-request is skipped by the next requests
+        reads = replicas.get_read_session(Request({
+            "type": "http", "method": "GET", "headers": [],
+        }))
+        next(reads)
+        with pytest.raises(DBAPIError):
+            reads.throw(DBAPIError(
+                "SELECT 1", None, Exception("gone"),
+                connection_invalidated=True,
+            ))
+        assert replicas.replica_set.choose() is None
+        assert read_name() == "Books"
+        replicas.recent_writers.clear()
@@ -0,0 +1,99 @@
+from decimal import Decimal
+from sqlalchemy import bindparam, update
+from sqlmodel import Session, select
+from models import Account, Transfer
+import ledger
+
+
+MAX_TRANSFERS = 100
+
+
+def apply_transfers(
+    session: Session, project_id: int, transfers: list[Transfer]
+) -> list[Account]:
+    """
+    Move amounts between accounts of one project inside the caller's
+    transaction. Every account involved is locked with a single
+    SELECT ... ORDER BY id FOR UPDATE, so concurrent batches always
+    acquire their locks in the same order and cannot deadlock.
+    Raises LookupError for unknown accounts and ValueError for invalid
+    transfers.
+    """
+    if not transfers:
+        raise ValueError("No transfers given")
+    if len(transfers) > MAX_TRANSFERS:
+        raise ValueError(f"At most {MAX_TRANSFERS} transfers per batch")
+    for transfer in transfers:
+        if transfer.source_account_id == transfer.target_account_id:
+            raise ValueError("Source and target account must differ")
+
+    ids = sorted({
+        id
+        for transfer in transfers
+        for id in (transfer.source_account_id, transfer.target_account_id)
+    })
+    statement = (
+        select(
+            Account.id,
+            Account.project_id,
+            Account.currency_id,
+            Account.amount,
+        )
+        .filter(Account.id.in_(ids))
+        .order_by(Account.id)
+        .with_for_update()
+    )
+    # Detached copies: balances are applied with amount = amount + delta,
+    # never by flushing these objects
+    accounts = {
+        row.id: Account(
+            id=row.id,
+            project_id=row.project_id,
+            currency_id=row.currency_id,
+            amount=Decimal(row.amount),
+        )
+        for row in session.exec(statement).all()
+    }
+    for id in ids:
+        if id not in accounts or accounts[id].project_id != project_id:
+            raise LookupError(f"Account {id} not found")
+
+    deltas = {id: Decimal(0) for id in ids}
+    for transfer in transfers:
+        source = accounts[transfer.source_account_id]
+        target = accounts[transfer.target_account_id]
+        if source.currency_id != target.currency_id:
+            raise ValueError(
+                "Cannot transfer between accounts in different currencies"
+            )
+        description = transfer.description or (
+            f"Transfer {source.id} -> {target.id}"
+        )
+        for account, amount in (
+            (source, -transfer.amount),
+            (target, transfer.amount),
+        ):
+            account.amount += amount
+            deltas[account.id] += amount
+            ledger.record_movement(session, account, amount, description)
+
+    changes = [
+        {"account_id": id, "delta": delta}
+        for id, delta in deltas.items()
+        if delta
+    ]
+    if changes:
+        table = Account.__table__
+        session.execute(
+            update(table)
+            .where(table.c.id == bindparam("account_id"))
+            .values(
+                amount=table.c.amount + bindparam("delta"),
+                version=table.c.version + 1,
+            ),
+            changes,
+        )
+    statement = select(Account).filter(Account.id.in_(ids)).order_by(
+        Account.id
+    )
+    return session.exec(statement).all()
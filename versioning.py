@@ -0,0 +1,46 @@
+from fastapi import HTTPException, Response
+from sqlmodel import Session, SQLModel, select
+
+
+def etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def set_etag(response: Response, instance: SQLModel) -> None:
+    response.headers["ETag"] = etag(instance.version)
+
+
+def if_match_versions(if_match: str | None) -> list[int] | None:
+    """
+    Versions listed in an If-Match header, None when any version will
+    do (no header or *). Weak and malformed tags never match.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+def not_updated(
+    session: Session,
+    model: type[SQLModel],
+    versions: list[int] | None,
+    detail: str,
+    *where,
+) -> HTTPException:
+    """
+    Error for a versioned update that matched no row: 412 when the row
+    exists at a version If-Match did not list, 404 otherwise
+    """
+    if versions is not None:
+        statement = select(model.id).where(*where)
+        if session.exec(statement).first() is not None:
+            return HTTPException(
+                status_code=412,
+                detail=f"{model.__name__} was modified, fetch it again",
+            )
+    return HTTPException(status_code=404, detail=detail)